@@ -15,12 +15,16 @@ members_bp = _safe_import("app.members.routes_v1")   or _safe_import("app.member
 mass_bp  = _safe_import("app.mass.routes_v1")     or _safe_import("app.mass.routes")
 media_bp = _safe_import("app.media.routes_v1")    or _safe_import("app.media.routes")
 wecom_bp = _safe_import("app.wecom.routes_v1")    or _safe_import("app.wecom.routes")
+jobs_bp  = _safe_import("app.jobs.routes_v1")
 
 # /api/v1/health
 health_bp = Blueprint("health_api", __name__, url_prefix="/api/v1")
 @health_bp.get("/health")
 def health():
-    payload = {"ok": True, "data": {"status": "OK"}, "trace_id": getattr(g, "trace_id", "")}
+    from app.common import cache
+    from app.core.db import pool_stats
+    data = {"status": "OK", "cache": cache.stats(), "mysql_pool": pool_stats()}
+    payload = {"ok": True, "data": data, "trace_id": getattr(g, "trace_id", "")}
     resp = jsonify(payload)
     resp.headers["X-Request-Id"] = payload["trace_id"]
     return resp, 200
@@ -46,6 +50,7 @@ def register_v1_blueprints(app):
         (members_bp, "/api/v1/members"),
         (media_bp, "/api/v1/media"),
         (wecom_bp, "/api/v1/wecom"),
+        (jobs_bp,  "/api/v1/jobs"),
     ]
     for bp, prefix in mapping:
         if bp and not has_prefix(prefix):
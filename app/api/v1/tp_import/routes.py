@@ -1,51 +1,82 @@
 from flask import Blueprint, request
 from app.common.response import ok, err
-import csv, io, secrets, time
+from app.core.redis import get_redis
+import csv, io, os, secrets, time
 
 bp = Blueprint("tp_import", __name__, url_prefix="/import")
 
-# 简单内存缓存：生产可改成落盘或入库，这里满足联调
-_UPLOAD_CACHE = {}  # token -> {"user_names":[...], "created_at":...}
+# 上传结果存 Redis 集合（去重 + TTL），多 worker 共享，过期自动清理
+_KEY = "tp:upload:{}"
+_TTL_S = int(os.getenv("TP_UPLOAD_TTL_SEC", "86400"))
+_BATCH = 5000
+
+def _key(token: str) -> str:
+    return _KEY.format(token)
+
+def _iter_user_names(stream):
+    """逐行解析 CSV：表头含 user_name 时取该列，否则取第一列（首行若是 user_name 视为表头）。"""
+    reader = csv.reader(io.TextIOWrapper(stream, encoding="utf-8-sig", errors="ignore", newline=""))
+    first = next(reader, None)
+    if first is None:
+        return
+    header = [c.strip() for c in first]
+    if "user_name" in header:
+        col = header.index("user_name")
+    else:
+        col = 0
+        val = header[0] if header else ""
+        if val and val.lower() != "user_name":
+            yield val
+    for row in reader:
+        if len(row) > col:
+            val = (row[col] or "").strip()
+            if val:
+                yield val
+
+def _store(key: str, names) -> int:
+    """分批管道 SADD，内存只保留一批；返回读到的非空行数。"""
+    r = get_redis()
+    rows, buf = 0, []
+    for name in names:
+        buf.append(name)
+        rows += 1
+        if len(buf) >= _BATCH:
+            r.pipeline(transaction=False).sadd(key, *buf).expire(key, _TTL_S).execute()
+            buf = []
+    if buf:
+        r.pipeline(transaction=False).sadd(key, *buf).expire(key, _TTL_S).execute()
+    return rows
 
 @bp.route("/usernames/upload", methods=["POST"])
 def upload_usernames():
     """
-    支持 multipart/form-data 上传 CSV：
+    上传 CSV（流式解析，不整体读入内存）：
+    - multipart/form-data 的 file 字段，或直接以 text/csv 作为请求体
     - 表头含 user_name 或第一列视为 user_name
-    - 返回 upload_token，后续在 targets_spec.mode=by_upload_token 使用
+    - 返回 upload_token（有效期 TP_UPLOAD_TTL_SEC），后续在 targets_spec.mode=by_upload_token 使用
     """
-    if "file" not in request.files:
+    if request.mimetype == "multipart/form-data":
+        if "file" not in request.files:
+            return err("BAD_REQUEST", "missing file", 400)
+        stream = request.files["file"].stream
+    elif request.mimetype in ("text/csv", "text/plain", "application/octet-stream"):
+        stream = request.stream
+    else:
         return err("BAD_REQUEST", "missing file", 400)
 
-    f = request.files["file"]
-    content = f.read().decode("utf-8", errors="ignore")
-    reader = csv.DictReader(io.StringIO(content))
-    user_names = []
+    token = f"U{int(time.time())}-{secrets.token_hex(8)}"
+    key = _key(token)
+    try:
+        rows = _store(key, _iter_user_names(stream))
+    except Exception:
+        get_redis().delete(key)
+        raise
 
-    if reader.fieldnames and "user_name" in [c.strip() for c in reader.fieldnames]:
-        col = [c for c in reader.fieldnames if c.strip() == "user_name"][0]
-        for row in reader:
-            val = (row.get(col) or "").strip()
-            if val:
-                user_names.append(val)
-    else:
-        # 没有表头时，按第一列
-        reader2 = csv.reader(io.StringIO(content))
-        for row in reader2:
-            if not row: continue
-            val = (row[0] or "").strip()
-            if val and val.lower() != "user_name":
-                user_names.append(val)
-
-    if not user_names:
+    if not rows:
         return err("BAD_DATA", "no valid user_name in file", 422)
 
-    token = f"U{int(time.time())}-{secrets.token_hex(8)}"
-    _UPLOAD_CACHE[token] = {"user_names": list(dict.fromkeys(user_names)),
-                            "created_at": int(time.time())}
-
-    return ok({"upload_token": token, "count": len(user_names)})
+    return ok({"upload_token": token, "count": int(get_redis().scard(key)), "rows": rows})
 
-def take_usernames_by_token(upload_token: str):
-    v = _UPLOAD_CACHE.get(upload_token)
-    return (v or {}).get("user_names") or []
+def take_usernames_by_token(upload_token: str, batch: int = 1000):
+    """SSCAN 逐批迭代去重后的 user_name；token 不存在或已过期时不产出任何值。"""
+    yield from get_redis().sscan_iter(_key(upload_token), count=batch)
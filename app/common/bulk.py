@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""按表缓冲的批量写入器：攒够 chunk_size 行后一次 executemany（PyMySQL 会改写为多行 VALUES）。"""
+from typing import Dict, Sequence, Tuple
+
+from app.core.config import settings
+
+
+class BulkUpserter:
+    """
+    用法：
+        writer = BulkUpserter(cur)
+        writer.register("ext_tag", ["tag_id", "name"], update=["name"])
+        writer.add("ext_tag", ("t1", "VIP"))
+        writer.flush()      # 或 with BulkUpserter(cur) as writer: ...
+    - update 非空：INSERT ... ON DUPLICATE KEY UPDATE col=VALUES(col)，不像 REPLACE 那样先删后插、重建二级索引
+    - update 为空：INSERT IGNORE
+    - 任一表攒满即整体 flush，在显式事务里提交；written 记录各表已写入行数
+    - delete(table, columns, key)：按主键缓冲删除，flush 时在同一事务里先删后写（删后重建关系不留空窗）；
+      须在对应的新行 add 之前调用，自动 flush 时删除才不会落在新行之后
+    注意：VALUES 里只能是纯 %s 占位符（时间戳等请先在 Python 侧转换），否则 PyMySQL 会退化成逐行执行。
+    """
+
+    def __init__(self, cur, chunk_size: int | None = None):
+        self.cur = cur
+        self.conn = cur.connection
+        self.chunk_size = max(1, int(chunk_size or settings.sync_write_chunk))
+        self._sql: Dict[str, str] = {}
+        self._buf: Dict[str, list] = {}
+        self._del: Dict[Tuple[str, Tuple[str, ...]], list] = {}
+        self.written: Dict[str, int] = {}
+
+    def register(self, table: str, columns: Sequence[str], update: Sequence[str] | None = None):
+        cols = ", ".join(columns)
+        placeholders = ", ".join(["%s"] * len(columns))
+        if update:
+            sets = ", ".join(f"{c}=VALUES({c})" for c in update)
+            sql = f"INSERT INTO {table} ({cols}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {sets}"
+        else:
+            sql = f"INSERT IGNORE INTO {table} ({cols}) VALUES ({placeholders})"
+        self._sql[table] = sql
+        self._buf.setdefault(table, [])
+        self.written.setdefault(table, 0)
+        return self
+
+    def add(self, table: str, row: Sequence):
+        buf = self._buf[table]
+        buf.append(tuple(row))
+        if len(buf) >= self.chunk_size:
+            # 任一表攒满就整体 flush，同一批次的跨表数据（主表/关系/哈希）落在同一事务
+            self.flush()
+
+    def delete(self, table: str, columns: Sequence[str], key: Sequence):
+        """缓冲一条按 columns 定位的删除，下一次 flush 时在写入之前执行。"""
+        self._del.setdefault((table, tuple(columns)), []).append(tuple(key))
+
+    def _delete_sql(self, table: str, columns: Tuple[str, ...], n: int) -> str:
+        if len(columns) == 1:
+            return f"DELETE FROM {table} WHERE {columns[0]} IN ({', '.join(['%s'] * n)})"
+        one = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        return f"DELETE FROM {table} WHERE ({', '.join(columns)}) IN ({', '.join([one] * n)})"
+
+    def flush(self, table: str | None = None):
+        tables = [table] if table else list(self._buf)
+        pending = [(t, self._buf[t]) for t in tables if self._buf[t]]
+        deletes = [(k, keys) for k, keys in self._del.items() if keys and (not table or k[0] == table)]
+        if not pending and not deletes:
+            return
+        self.conn.begin()
+        try:
+            for (t, columns), keys in deletes:
+                for i in range(0, len(keys), self.chunk_size):
+                    part = keys[i:i + self.chunk_size]
+                    self.cur.execute(self._delete_sql(t, columns, len(part)), [v for key in part for v in key])
+            for t, rows in pending:
+                self.cur.executemany(self._sql[t], rows)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        for k, _ in deletes:
+            self._del[k] = []
+        for t, rows in pending:
+            self.written[t] += len(rows)
+            self._buf[t] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        return False
@@ -1,36 +1,211 @@
-import os, json, time
-import redis as _redis
+"""
+两级 stale-while-revalidate 缓存：
+- L1：进程内 LRU（CACHE_L1_SIZE 条），命中即返回，不走网络
+- L2：Redis 单 key 存 {"v": 值, "ts": 写入时间, "soft": 软 TTL}，EX=硬 TTL
+- 软过期后先返回旧值，刷新丢给后台线程池（带上调用方的 contextvars，如 use_replica 的读副本开关）；
+  同一 key 跨进程只有一个刷新者（SET NX 随机 token 锁，比较后删除，不会误删别人的锁）
+- Redis 不可用时 L1 旧值只在硬 TTL 内使用，超过硬 TTL 直接加载
+- 冷 key 只有一个加载者，其余调用方轮询等待（有上限），超时后自己加载，绝不返回 null
+- 软/硬 TTL 乘以 [cache_jitter_min, cache_jitter_max] 的随机因子，避免同批 key 同时过期
+- 命中/未命中/刷新等计数见 stats()
+"""
+import contextvars, json, time, random, logging, threading, os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from redis.exceptions import RedisError
+from app.common.idempotency import acquire_lock, release_lock
+from app.core.config import settings
+from app.core.redis import get_redis
+
+log = logging.getLogger(__name__)
+
+# 代际（generation）命名空间：数据变更方 bump，读方把代际号拼进缓存 key，旧 key 自然过期
+GEN_MEMBERS = "members"
+
+_L1_SIZE = int(os.getenv("CACHE_L1_SIZE", "1024"))
+_REFRESH_WORKERS = int(os.getenv("CACHE_REFRESH_WORKERS", "4"))
+_LOCK_TTL_S = 30
+_WAIT_S = float(os.getenv("CACHE_WAIT_SEC", "3"))
 
 def _r():
-    return _redis.Redis(host=os.getenv("REDIS_HOST","127.0.0.1"),
-                        port=int(os.getenv("REDIS_PORT","6379")),
-                        db=int(os.getenv("REDIS_DB","0")),
-                        decode_responses=True)
+    # 复用 app.core.redis 的进程级连接池，不再每次调用新建连接
+    return get_redis()
+
+def generation(ns):
+    return int(_r().get(f"cache:gen:{ns}") or 0)
+
+def bump_generation(ns):
+    """数据变更后调用；Redis 不可用时只记日志，不影响写库主流程（缓存靠 TTL 兜底）。"""
+    try:
+        return int(_r().incr(f"cache:gen:{ns}"))
+    except RedisError as e:
+        log.warning("cache generation bump failed ns=%s err=%s", ns, e)
+        return None
+
+
+# -------------------------
+# 计数
+# -------------------------
+_counters = {}
+_counters_lock = threading.Lock()
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] = _counters.get(name, 0) + 1
+
+def stats():
+    """l1_hit / hit / stale / miss / wait_hit / wait_timeout / refresh / refresh_error / redis_error"""
+    with _counters_lock:
+        return dict(_counters)
+
+
+# -------------------------
+# L1：进程内 LRU
+# -------------------------
+_l1 = OrderedDict()
+_l1_lock = threading.Lock()
+
+def _l1_get(key):
+    with _l1_lock:
+        env = _l1.get(key)
+        if env is not None:
+            _l1.move_to_end(key)
+        return env
+
+def _l1_put(key, env):
+    with _l1_lock:
+        _l1[key] = env
+        _l1.move_to_end(key)
+        while len(_l1) > _L1_SIZE:
+            _l1.popitem(last=False)
+
+def _l1_clear():
+    with _l1_lock:
+        _l1.clear()
+
+
+# -------------------------
+# L2：Redis 单 key 信封
+# -------------------------
+def _jitter(ttl):
+    lo, hi = settings.cache_jitter_min, settings.cache_jitter_max
+    return max(1, int(ttl * random.uniform(min(lo, hi), max(lo, hi))))
 
+def _age(env, now):
+    return now - env["ts"]
+
+def _l2_get(r, key):
+    raw = r.get(key)
+    if not raw:
+        return None
+    try:
+        env = json.loads(raw)
+        return env if isinstance(env, dict) and "ts" in env and "v" in env else None
+    except ValueError:
+        return None
+
+def _load_and_store(r, key, loader, soft_ttl_s, hard_ttl_s):
+    value = loader()
+    soft, hard = _jitter(soft_ttl_s), _jitter(hard_ttl_s)
+    env = {"v": value, "ts": time.time(), "soft": min(soft, hard), "hard": hard}
+    r.set(key, json.dumps(env, ensure_ascii=False, default=str), ex=hard)
+    _l1_put(key, env)
+    return value
+
+
+# -------------------------
+# 后台刷新
+# -------------------------
+_pool = None
+_pool_lock = threading.Lock()
+_inflight = set()
+
+def _executor():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=_REFRESH_WORKERS, thread_name_prefix="cache-refresh")
+    return _pool
+
+def _refresh(key, loader, soft_ttl_s, hard_ttl_s):
+    r = _r()
+    try:
+        token = acquire_lock(key + ":lock", _LOCK_TTL_S, r)
+        if token is None:
+            return  # 其他进程正在刷新
+        try:
+            _load_and_store(r, key, loader, soft_ttl_s, hard_ttl_s)
+            _count("refresh")
+        finally:
+            release_lock(key + ":lock", token, r)
+    except Exception:
+        _count("refresh_error")
+        log.exception("cache background refresh failed key=%s", key)
+    finally:
+        with _pool_lock:
+            _inflight.discard(key)
+
+def _schedule_refresh(key, loader, soft_ttl_s, hard_ttl_s):
+    # 同一进程内同一 key 只排一个刷新任务
+    with _pool_lock:
+        if key in _inflight:
+            return
+        _inflight.add(key)
+    # loader 可能依赖调用方的 contextvars（如 use_replica 的读副本开关），复制一份带到线程池
+    _executor().submit(contextvars.copy_context().run, _refresh, key, loader, soft_ttl_s, hard_ttl_s)
+
+
+# -------------------------
+# 入口
+# -------------------------
 def get_with_singleflight(key, loader, soft_ttl_s=300, hard_ttl_s=900):
-    r = _r(); now = int(time.time()); mk = key+":meta"
-    val = r.get(key); meta = r.get(mk)
-    if val and meta:
-        meta = json.loads(meta)
-        age = now - meta["ts"]
-        if age < hard_ttl_s:
-            if age > soft_ttl_s and r.setnx(key+":lock","1"):
-                r.expire(key+":lock", 30)
-                try:
-                    fresh = loader()
-                    r.set(key, json.dumps(fresh), ex=hard_ttl_s)
-                    r.set(mk, json.dumps({"ts": now}), ex=hard_ttl_s)
-                finally:
-                    r.delete(key+":lock")
-            return json.loads(val)
-    if r.setnx(key+":lock","1"):
-        r.expire(key+":lock", 30)
+    now = time.time()
+    env = _l1_get(key)
+    if env is not None and _age(env, now) < env["soft"]:
+        _count("l1_hit")
+        return env["v"]
+
+    try:
+        r = _r()
+        env = _l2_get(r, key)
+    except RedisError as e:
+        # Redis 不可用：本地旧值在硬 TTL 内就用旧值，否则直接加载
+        _count("redis_error")
+        log.warning("cache redis unavailable key=%s err=%s", key, e)
+        if env is not None and _age(env, now) < env.get("hard", hard_ttl_s):
+            return env["v"]
+        return loader()
+
+    if env is not None:
+        _l1_put(key, env)
+        if _age(env, now) < env["soft"]:
+            _count("hit")
+        else:
+            _count("stale")
+            _schedule_refresh(key, loader, soft_ttl_s, hard_ttl_s)
+        return env["v"]
+
+    _count("miss")
+    token = acquire_lock(key + ":lock", _LOCK_TTL_S, r)
+    if token is not None:
         try:
-            fresh = loader()
-            r.set(key, json.dumps(fresh), ex=hard_ttl_s)
-            r.set(mk, json.dumps({"ts": now}), ex=hard_ttl_s)
-            return fresh
+            return _load_and_store(r, key, loader, soft_ttl_s, hard_ttl_s)
         finally:
-            r.delete(key+":lock")
-    time.sleep(0.2)
-    return json.loads(r.get(key) or "null")
+            release_lock(key + ":lock", token, r)
+
+    # 跟随者：有上限地轮询等待加载者写入，超时自己加载
+    deadline = time.monotonic() + _WAIT_S
+    delay = 0.02
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+        env = _l2_get(r, key)
+        if env is not None:
+            _count("wait_hit")
+            _l1_put(key, env)
+            return env["v"]
+        if not r.exists(key + ":lock"):
+            break  # 加载者已失败退出
+    _count("wait_timeout")
+    return loader()
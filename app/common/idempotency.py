@@ -1,6 +1,25 @@
+import uuid
+
 from app.core.redis import get_redis
 
+# 只删除值等于自己 token 的锁：锁已过期并被别人拿走时不会误删
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
 def try_mark_once(key: str, ttl_s: int) -> bool:
     r = get_redis()
     ok = r.set(name=key, value="1", nx=True, ex=ttl_s)
     return bool(ok)
+
+def acquire_lock(key: str, ttl_s: int, r=None) -> str | None:
+    """SET NX EX 一个随机 token，拿到返回 token，否则 None。"""
+    token = uuid.uuid4().hex
+    return token if (r or get_redis()).set(key, token, nx=True, ex=ttl_s) else None
+
+def release_lock(key: str, token: str, r=None) -> bool:
+    """比较后删除（Lua 原子执行）。"""
+    return bool((r or get_redis()).eval(_RELEASE_LUA, 1, key, token))
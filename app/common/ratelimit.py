@@ -1,23 +1,92 @@
+import math
 import time
+from redis.exceptions import NoScriptError
 from app.core.redis import get_redis
 
-def _now_ms():
-    return int(time.time() * 1000)
+# 令牌桶：补充 + 扣减 + 续期在 Redis 端一次完成，多 worker 并发下不会超发
+# KEYS[1]=桶 key；ARGV = capacity, refill_per_sec, n
+# 返回 {granted(0/1), wait_ms}：未取到时 wait_ms 为攒够 n 个令牌还需等待的毫秒数
+_TAKE_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local n = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'last_ms')
+local tokens = tonumber(state[1])
+local last = tonumber(state[2])
+if tokens == nil or last == nil then
+  tokens = capacity
+  last = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - last) * rate / 1000)
+local granted = 0
+local wait = 0
+if tokens >= n then
+  tokens = tokens - n
+  granted = 1
+else
+  wait = math.ceil((n - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last_ms', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return {granted, wait}
+"""
+
+# 每个进程只 SCRIPT LOAD 一次，之后走 EVALSHA
+_take_sha = None
+
+
+def _evalsha(r, key: str, capacity, refill_per_sec, n: int):
+    global _take_sha
+    if _take_sha is None:
+        _take_sha = r.script_load(_TAKE_LUA)
+    try:
+        return r.evalsha(_take_sha, 1, key, capacity, refill_per_sec, n)
+    except NoScriptError:
+        # Redis 重启 / SCRIPT FLUSH 后脚本缓存丢失，重新加载一次
+        _take_sha = r.script_load(_TAKE_LUA)
+        return r.evalsha(_take_sha, 1, key, capacity, refill_per_sec, n)
+
+
+def take_tokens(bucket_key: str, n: int, capacity: float, refill_per_sec: float) -> tuple[bool, int]:
+    """原子地一次取 n 个令牌，返回 (是否取到, 未取到时需等待的毫秒数)。"""
+    if n <= 0:
+        return True, 0
+    if n > capacity:
+        raise ValueError(f"n={n} exceeds bucket capacity={capacity}")
+    if refill_per_sec <= 0:
+        raise ValueError("refill_per_sec must be positive")
+    granted, wait_ms = _evalsha(get_redis(), bucket_key, capacity, refill_per_sec, n)
+    return bool(int(granted)), int(math.ceil(float(wait_ms)))
+
 
 def take_token(bucket_key: str, capacity: int, refill_per_sec: int) -> bool:
-    r = get_redis()
-    state = r.hgetall(bucket_key) or {}
-    last_ms = int(state.get("last_ms", 0))
-    tokens = int(state.get("tokens", capacity))
-    now = _now_ms()
-    elapsed = max(0, now - last_ms)
-    refill = (elapsed * refill_per_sec) // 1000
-    tokens = min(capacity, tokens + refill)
-    if tokens <= 0:
-        r.hset(bucket_key, mapping={"tokens": tokens, "last_ms": now})
-        r.expire(bucket_key, 60)
-        return False
-    tokens -= 1
-    r.hset(bucket_key, mapping={"tokens": tokens, "last_ms": now})
-    r.expire(bucket_key, 60)
-    return True
+    granted, _ = take_tokens(bucket_key, 1, capacity, refill_per_sec)
+    return granted
+
+
+class TokenBucket:
+    """可复用的限流器：每次 acquire 只有一次原子往返；取不到时按脚本算出的精确时间等待后重试。"""
+
+    def __init__(self, key: str, rate: float, burst: float):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst >= 1")
+        self.key = key
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+    def try_acquire(self, n: int = 1) -> tuple[bool, int]:
+        return take_tokens(self.key, n, self.burst, self.rate)
+
+    def acquire(self, n: int = 1, timeout: float | None = None) -> bool:
+        """阻塞直到取到 n 个令牌；timeout（秒）内取不到返回 False。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            granted, wait_ms = self.try_acquire(n)
+            if granted:
+                return True
+            wait_s = max(wait_ms, 1) / 1000.0
+            if deadline is not None and time.monotonic() + wait_s > deadline:
+                return False
+            time.sleep(wait_s)
@@ -1,18 +1,161 @@
+"""
+分布式公平信号量（Redis ZSET 租约）：
+- 持有者：{key} ZSET，member=租约 token，score=到期时间（毫秒，取 Redis 服务器 TIME，不依赖各主机时钟）
+- 排队者：{key}:q ZSET 按到达序号排队（FIFO），{key}:qexp 记录排队者心跳到期时间
+- 获取、续期各是一次 Lua 原子执行（取消排队走 MULTI）；过期租约（持有者崩溃）和失联排队者在每次获取时顺手回收
+- release 只删自己的 token，不会多还
+用法：
+    sem = Semaphore("wecom:sem:agent:1000002", capacity=20, lease_s=60)
+    with sem.hold(timeout=30) as token:
+        if token is None: ...   # 超时未拿到
+"""
+import time
+import uuid
+from contextlib import contextmanager
+
+from redis.exceptions import NoScriptError
+
 from app.core.redis import get_redis
 
-def acquire_sem(key: str, ttl_s: int, capacity: int) -> bool:
-    r = get_redis()
-    r.setnx(key, capacity)
-    r.expire(key, ttl_s)
-    cur = int(r.get(key) or capacity)
-    if cur <= 0:
-        return False
-    r.decr(key)
-    r.expire(key, ttl_s)
-    return True
-
-def release_sem(key: str, capacity: int):
-    r = get_redis()
-    cur = int(r.get(key) or 0)
-    if cur < capacity:
-        r.incr(key)
+# KEYS = 持有 ZSET, 排队 ZSET, 排队心跳 ZSET, 序号 key
+# ARGV = capacity, lease_ms, token, queue_ttl_ms
+# 返回 {1, 0} 已获取；{0, wait_ms} 未获取，wait_ms 为最早一个租约到期还需的毫秒数
+_ACQUIRE_LUA = """
+local capacity = tonumber(ARGV[1])
+local lease = tonumber(ARGV[2])
+local token = ARGV[3]
+local qttl = tonumber(ARGV[4])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local gone = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)
+for _, w in ipairs(gone) do
+  redis.call('ZREM', KEYS[2], w)
+  redis.call('ZREM', KEYS[3], w)
+end
+
+if redis.call('ZSCORE', KEYS[1], token) then
+  redis.call('ZADD', KEYS[1], now + lease, token)
+  return {1, 0}
+end
+if not redis.call('ZSCORE', KEYS[2], token) then
+  redis.call('ZADD', KEYS[2], redis.call('INCR', KEYS[4]), token)
+end
+redis.call('ZADD', KEYS[3], now + qttl, token)
+
+local free = capacity - redis.call('ZCARD', KEYS[1])
+local rank = redis.call('ZRANK', KEYS[2], token)
+local ttl = lease + qttl + 1000
+if rank < free then
+  redis.call('ZADD', KEYS[1], now + lease, token)
+  redis.call('ZREM', KEYS[2], token)
+  redis.call('ZREM', KEYS[3], token)
+  for i = 1, 4 do redis.call('PEXPIRE', KEYS[i], ttl) end
+  return {1, 0}
+end
+for i = 1, 4 do redis.call('PEXPIRE', KEYS[i], ttl) end
+local first = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+local wait = 50
+if first[2] then wait = math.max(1, tonumber(first[2]) - now) end
+return {0, wait}
+"""
+
+# KEYS[1]=持有 ZSET；ARGV = token, lease_ms；租约仍有效才续期
+_REFRESH_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local exp = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not exp or tonumber(exp) <= now then
+  redis.call('ZREM', KEYS[1], ARGV[1])
+  return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[2]) + 1000)
+return 1
+"""
+
+_shas = {}
+
+
+def _eval(r, script: str, keys, args):
+    sha = _shas.get(script)
+    if sha is None:
+        sha = _shas[script] = r.script_load(script)
+    try:
+        return r.evalsha(sha, len(keys), *keys, *args)
+    except NoScriptError:
+        _shas[script] = r.script_load(script)
+        return r.evalsha(_shas[script], len(keys), *keys, *args)
+
+
+class Semaphore:
+    """capacity 个并发名额；lease_s 内未 release/refresh 的租约视为持有者已崩溃，自动回收。"""
+
+    # 排队者每次轮询都会续心跳；超过该时间没再轮询（进程挂了）就移出队列，不会堵住后来者
+    QUEUE_TTL_MS = 2000
+
+    def __init__(self, key: str, capacity: int, lease_s: float = 60):
+        if capacity < 1:
+            raise ValueError("capacity must be >= 1")
+        self.key = key
+        self.capacity = int(capacity)
+        self.lease_ms = max(1, int(lease_s * 1000))
+
+    def _keys(self):
+        return [self.key, self.key + ":q", self.key + ":qexp", self.key + ":seq"]
+
+    def _attempt(self, token: str) -> tuple[bool, int]:
+        """一次原子尝试；未拿到时 token 留在队列里，用同一 token 重试可保留排队位置。"""
+        got, wait_ms = _eval(get_redis(), _ACQUIRE_LUA, self._keys(),
+                             [self.capacity, self.lease_ms, token, self.QUEUE_TTL_MS])
+        return bool(int(got)), int(wait_ms)
+
+    def try_acquire(self) -> tuple[str | None, int]:
+        """不等待，只试一次；返回 (token 或 None, 建议等待毫秒数)。"""
+        token = uuid.uuid4().hex
+        got, wait_ms = self._attempt(token)
+        if not got:
+            self._cancel(token)
+            return None, wait_ms
+        return token, wait_ms
+
+    def acquire(self, timeout: float | None = None) -> str | None:
+        """阻塞直到拿到名额，返回租约 token；timeout（秒）内拿不到返回 None 并退出排队。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        token = uuid.uuid4().hex
+        while True:
+            got, wait_ms = self._attempt(token)
+            if got:
+                return token
+            # 轮询间隔不能超过排队心跳，否则会被当成失联移出队列
+            wait_s = min(max(wait_ms, 10), self.QUEUE_TTL_MS // 4) / 1000.0
+            if deadline is not None and time.monotonic() + wait_s > deadline:
+                self._cancel(token)
+                return None
+            time.sleep(wait_s)
+
+    def _cancel(self, token: str):
+        pipe = get_redis().pipeline(transaction=True)
+        pipe.zrem(self.key + ":q", token)
+        pipe.zrem(self.key + ":qexp", token)
+        pipe.execute()
+
+    def refresh(self, token: str) -> bool:
+        """长任务中途续租；租约已过期（名额可能已被别人拿走）返回 False。"""
+        return bool(int(_eval(get_redis(), _REFRESH_LUA, [self.key], [token, self.lease_ms])))
+
+    def release(self, token: str) -> bool:
+        return bool(get_redis().zrem(self.key, token))
+
+    def holders(self) -> int:
+        return int(get_redis().zcard(self.key))
+
+    @contextmanager
+    def hold(self, timeout: float | None = None):
+        token = self.acquire(timeout)
+        try:
+            yield token
+        finally:
+            if token:
+                self.release(token)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+增量同步状态：
+- sync_state(domain, item)：游标断点、增量起点、最近成功/失败
+- sync_row_hash(domain, item, row_key)：行内容哈希，未变化的行整行跳过
+- sync_state.extra：后台任务状态（extra.job）与同步进度（extra.progress），供任务状态接口查询
+所有函数都复用调用方的游标，避免在同步过程中另开/关闭线程内共享连接。
+"""
+import hashlib
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterable
+
+_HASH_LOAD_CHUNK = 1000
+
+
+def get_state(cur, domain: str, item: str) -> Dict[str, Any]:
+    cur.execute(
+        """
+        SELECT sync_cursor, since, last_ok_at, last_err, extra
+        FROM sync_state WHERE domain=%s AND item=%s
+        """,
+        (domain, item),
+    )
+    return cur.fetchone() or {}
+
+
+def save_cursor(cur, domain: str, item: str, cursor: str | None):
+    """写断点；连接为 autocommit，进程崩溃后可从这里续跑。"""
+    cur.execute(
+        """
+        INSERT INTO sync_state (domain, item, sync_cursor)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE sync_cursor=VALUES(sync_cursor)
+        """,
+        (domain, item, cursor),
+    )
+
+
+def mark_ok(cur, domain: str, item: str, since):
+    """一轮跑完：清断点，since 记为本轮开始时间（下轮增量起点）。"""
+    cur.execute(
+        """
+        INSERT INTO sync_state (domain, item, sync_cursor, since, last_ok_at, last_err)
+        VALUES (%s, %s, NULL, %s, NOW(), NULL)
+        ON DUPLICATE KEY UPDATE sync_cursor=NULL, since=VALUES(since),
+                                last_ok_at=NOW(), last_err=NULL
+        """,
+        (domain, item, since),
+    )
+
+
+def mark_err(cur, domain: str, item: str, err: Exception | str):
+    cur.execute(
+        """
+        INSERT INTO sync_state (domain, item, last_err)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE last_err=VALUES(last_err)
+        """,
+        (domain, item, str(err)[:512]),
+    )
+
+
+def save_extra(cur, domain: str, item: str, key: str, value: Any):
+    """把 value 写到 extra.<key>，extra 里其他键保留。"""
+    raw = json.dumps(value, ensure_ascii=False, default=str)
+    cur.execute(
+        """
+        INSERT INTO sync_state (domain, item, extra)
+        VALUES (%s, %s, JSON_OBJECT(%s, CAST(%s AS JSON)))
+        ON DUPLICATE KEY UPDATE extra=JSON_SET(COALESCE(extra, JSON_OBJECT()), %s, CAST(%s AS JSON))
+        """,
+        (domain, item, key, raw, f"$.{key}", raw),
+    )
+
+
+def save_progress(cur, domain: str, item: str, **fields):
+    """同步过程中的进度快照（整体覆盖 extra.progress），一般在写断点时顺带调用。"""
+    save_extra(cur, domain, item, "progress", {**fields, "at": datetime.now().isoformat(timespec="seconds")})
+
+
+def row_hash(payload: Any) -> str:
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class ChangeFilter:
+    """
+    比对内容哈希筛出变化的行。用法：
+        flt = ChangeFilter(cur, writer, "ext", "contacts", full)
+        for key in flt.changed({eid: payload, ...}):
+            writer.add(...); flt.mark(key)
+    mark 把新哈希加入同一个 writer，与数据行同一批次、同一事务落库。
+    full=True 时不读旧哈希，全部视为变化（但仍会刷新哈希）。
+    """
+
+    def __init__(self, cur, writer, domain: str, item: str, full: bool = False):
+        self.cur = cur
+        self.writer = writer
+        self.domain = domain
+        self.item = item
+        self.full = full
+        self.skipped = 0
+        self._pending: Dict[str, str] = {}
+        writer.register("sync_row_hash", ["domain", "item", "row_key", "row_hash"], update=["row_hash"])
+
+    def _load(self, keys: Iterable[str]) -> Dict[str, str]:
+        keys = list(keys)
+        stored: Dict[str, str] = {}
+        for i in range(0, len(keys), _HASH_LOAD_CHUNK):
+            chunk = keys[i:i + _HASH_LOAD_CHUNK]
+            self.cur.execute(
+                f"""
+                SELECT row_key, row_hash FROM sync_row_hash
+                WHERE domain=%s AND item=%s AND row_key IN ({",".join(["%s"] * len(chunk))})
+                """,
+                (self.domain, self.item, *chunk),
+            )
+            stored.update({r["row_key"]: r["row_hash"] for r in self.cur.fetchall()})
+        return stored
+
+    def changed(self, payloads: Dict[str, Any]) -> list:
+        hashes = {str(k): row_hash(v) for k, v in payloads.items()}
+        stored = {} if self.full else self._load(hashes)
+        out = []
+        for key, h in hashes.items():
+            if stored.get(key) == h:
+                self.skipped += 1
+                continue
+            self._pending[key] = h
+            out.append(key)
+        return out
+
+    def mark(self, key: str):
+        h = self._pending.pop(str(key), None)
+        if h:
+            self.writer.add("sync_row_hash", (self.domain, self.item, str(key), h))
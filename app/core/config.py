@@ -7,6 +7,8 @@ load_dotenv()
 class Settings(BaseModel):
     api_version_prefix: str = os.getenv("API_VERSION_PREFIX", "v1")
     global_concurrency: int = int(os.getenv("GLOBAL_CONCURRENCY", 20))
+    agent_concurrency: int = int(os.getenv("WECOM_AGENT_CONCURRENCY", os.getenv("GLOBAL_CONCURRENCY", 20)))
+    wecom_agent_id: str = os.getenv("WECOM_AGENT_ID", "")
     dispatch_batch_size: int = int(os.getenv("DISPATCH_BATCH_SIZE", 300))
     dispatch_qps_limit: int = int(os.getenv("DISPATCH_QPS_LIMIT", 600))
     retry_max: int = int(os.getenv("RETRY_MAX", 5))
@@ -15,6 +17,22 @@ class Settings(BaseModel):
     cache_hard_ttl_s: int = int(os.getenv("CACHE_HARD_TTL_SEC", 900))
     cache_jitter_min: float = float(os.getenv("CACHE_JITTER_MIN", 0.9))
     cache_jitter_max: float = float(os.getenv("CACHE_JITTER_MAX", 1.2))
+    sync_write_chunk: int = int(os.getenv("SYNC_WRITE_CHUNK", 500))
+    ext_sync_workers: int = int(os.getenv("EXT_SYNC_WORKERS", 4))
+    group_sync_workers: int = int(os.getenv("GROUP_SYNC_WORKERS", 4))
+    mass_delete_chunk: int = int(os.getenv("MASS_DELETE_CHUNK", 5000))
+    mass_plan_chunk: int = int(os.getenv("MASS_PLAN_CHUNK", 20000))
+    mass_delete_pause_ms: int = int(os.getenv("MASS_DELETE_PAUSE_MS", 20))
+    mass_sweep_stale_s: int = int(os.getenv("MASS_SWEEP_STALE_SEC", 1800))
+    mass_stat_flush_s: int = int(os.getenv("MASS_STAT_FLUSH_S", 10))
+    mass_stat_reconcile_s: int = int(os.getenv("MASS_STAT_RECONCILE_S", 300))
+    member_source: str = os.getenv("MEMBER_SOURCE", "view")
+    wecom_cb_batch: int = int(os.getenv("WECOM_CB_BATCH", 200))
+    wecom_cb_block_ms: int = int(os.getenv("WECOM_CB_BLOCK_MS", 500))
+    wecom_cb_window_ms: int = int(os.getenv("WECOM_CB_WINDOW_MS", 500))
+    wecom_cb_stream_maxlen: int = int(os.getenv("WECOM_CB_STREAM_MAXLEN", 1000000))
+    # 只在联调环境打开：允许 X-Wecom-Debug:1 跳过验签并同步直落
+    wecom_callback_debug: bool = os.getenv("WECOM_CALLBACK_DEBUG", "0") == "1"
     log_with_trace_id: bool = os.getenv("LOG_WITH_TRACE_ID", "1") == "1"
 
     mysql_host: str = os.getenv("MYSQL_HOST", "127.0.0.1")
@@ -1,7 +1,11 @@
-import os, threading, pymysql
+import os, time, threading, functools, logging, pymysql
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pymysql.constants import SERVER_STATUS
 from pymysql.cursors import DictCursor
 
-_tls = threading.local()
+log = logging.getLogger(__name__)
 
 def _env(name, default=None):
     return os.environ.get(name, default)
@@ -19,17 +23,301 @@ def _mysql_params():
                 database=db, charset=charset, cursorclass=DictCursor,
                 autocommit=True)
 
-def get_mysql_conn():
-    params = _mysql_params()
-    conn = getattr(_tls, "conn", None)
-    if conn:
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class MySQLPool:
+    """
+    有界连接池：
+    - 最多 max_size 条连接（含借出中的），满了等待 wait_s 秒，超时抛 PoolTimeout
+    - 空闲超过 idle_s 的连接直接关闭丢弃（避开 MySQL wait_timeout）
+    - 只有空闲超过 ping_after_s 才 ping 一次做健康检查，刚归还的连接直接复用
+    - LIFO 复用，热连接优先，冷连接自然老化
+    """
+
+    def __init__(self, connect, max_size=20, idle_s=300, ping_after_s=30, wait_s=5):
+        self._connect = connect
+        self.max_size = max(1, int(max_size))
+        self.idle_s = idle_s
+        self.ping_after_s = ping_after_s
+        self.wait_s = wait_s
+        self._idle = deque()  # (conn, 归还时间)
+        self._size = 0
+        self._cond = threading.Condition()
+        self._m = dict(created=0, closed=0, reconnects=0, waits=0, wait_ms_total=0.0,
+                       wait_ms_max=0.0, timeouts=0, checkouts=0)
+
+    def _discard(self, conn):
         try:
-            conn.ping(reconnect=True)
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._m["closed"] += 1
+            self._cond.notify()
+
+    def acquire(self):
+        started = time.monotonic()
+        waited = False
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._idle:
+                    conn, since = self._idle.pop()
+                    if now - since > self.idle_s:
+                        # 队尾是最近归还的，它都过期说明整池已冷，逐条丢弃后新建
+                        self._size -= 1
+                        self._m["closed"] += 1
+                        try:
+                            conn.close()
+                        except Exception:
+                            pass
+                        continue
+                    break
+                else:
+                    conn = None
+                if conn is not None or self._size < self.max_size:
+                    if conn is None:
+                        self._size += 1
+                    break
+                left = self.wait_s - (now - started)
+                if left <= 0:
+                    self._m["timeouts"] += 1
+                    raise PoolTimeout(f"mysql pool exhausted (size={self.max_size}, waited {self.wait_s}s)")
+                waited = True
+                self._cond.wait(left)
+            waited_ms = (time.monotonic() - started) * 1000
+            self._m["checkouts"] += 1
+            if waited:
+                self._m["waits"] += 1
+                self._m["wait_ms_total"] += waited_ms
+                self._m["wait_ms_max"] = max(self._m["wait_ms_max"], waited_ms)
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._m["created"] += 1
             return conn
+
+        if time.monotonic() - since > self.ping_after_s:
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                try:
+                    conn.connect()
+                    with self._cond:
+                        self._m["reconnects"] += 1
+                except Exception:
+                    self._discard(conn)
+                    raise
+        return conn
+
+    def release(self, conn):
+        if not getattr(conn, "open", False):
+            self._discard(conn)
+            return
+        if conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+            # 调用方异常退出时留下的未提交事务，不能带给下一个借用者
+            try:
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            idle = len(self._idle)
+            return {"max_size": self.max_size, "size": self._size, "idle": idle,
+                    "in_use": self._size - idle, **self._m}
+
+
+class PooledConnection:
+    """借出连接的代理：其余属性透传给 PyMySQL 连接，close()/with 退出/对象回收时归还连接池而不是断开。"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get("_conn")
+        if conn is None:
+            raise AttributeError(f"connection already returned to pool: {name}")
+        return getattr(conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def __del__(self):
+        try:
+            self.close()
         except Exception:
-            conn = None
-    _tls.conn = pymysql.connect(**params)
-    return _tls.conn
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _new_pool(params: dict) -> MySQLPool:
+    return MySQLPool(
+        lambda: pymysql.connect(**params),
+        max_size=int(_env("MYSQL_POOL_SIZE", "20")),
+        idle_s=float(_env("MYSQL_POOL_IDLE_SEC", "300")),
+        ping_after_s=float(_env("MYSQL_POOL_PING_AFTER_SEC", "30")),
+        wait_s=float(_env("MYSQL_POOL_WAIT_SEC", "5")),
+    )
+
+def get_pool() -> MySQLPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _new_pool(_mysql_params())
+    return _pool
+
+
+# -------------------------
+# 只读副本：MYSQL_REPLICA_HOST 配置后启用；复制延迟超限/不可用时回退主库
+# -------------------------
+_replica_pool = None
+_replica_state = {"ok": False, "lag_s": None, "checked": 0.0}
+_replica_lock = threading.Lock()
+_read_replica = ContextVar("mysql_read_replica", default=False)
+
+def _replica_params() -> dict | None:
+    host = _env("MYSQL_REPLICA_HOST")
+    if not host:
+        return None
+    params = _mysql_params()
+    params.update(
+        host=host,
+        port=int(_env("MYSQL_REPLICA_PORT", str(params["port"]))),
+        user=_env("MYSQL_REPLICA_USER", params["user"]),
+        password=_env("MYSQL_REPLICA_PASSWORD", params["password"]),
+    )
+    return params
+
+def _get_replica_pool() -> MySQLPool | None:
+    global _replica_pool
+    if _replica_pool is None:
+        params = _replica_params()
+        if params is None:
+            return None
+        with _replica_lock:
+            if _replica_pool is None:
+                _replica_pool = _new_pool(params)
+    return _replica_pool
+
+def _replica_lag(conn) -> float | None:
+    """Seconds_Behind_Source；复制线程停止时为 None。兼容 8.0.22 之前的 SHOW SLAVE STATUS。"""
+    with conn.cursor() as cur:
+        try:
+            cur.execute("SHOW REPLICA STATUS")
+            row = cur.fetchone() or {}
+            lag = row.get("Seconds_Behind_Source")
+        except pymysql.err.ProgrammingError:
+            cur.execute("SHOW SLAVE STATUS")
+            row = cur.fetchone() or {}
+            lag = row.get("Seconds_Behind_Master")
+    return None if lag is None else float(lag)
+
+def replica_available() -> bool:
+    """每 MYSQL_REPLICA_LAG_CHECK_SEC 秒最多检查一次复制延迟，结果进程内缓存。"""
+    pool = _get_replica_pool()
+    if pool is None:
+        return False
+    now = time.monotonic()
+    if now - _replica_state["checked"] < float(_env("MYSQL_REPLICA_LAG_CHECK_SEC", "5")):
+        return _replica_state["ok"]
+    with _replica_lock:
+        if now - _replica_state["checked"] < float(_env("MYSQL_REPLICA_LAG_CHECK_SEC", "5")):
+            return _replica_state["ok"]
+        try:
+            conn = pool.acquire()
+            try:
+                lag = _replica_lag(conn)
+            finally:
+                pool.release(conn)
+            ok = lag is not None and lag <= float(_env("MYSQL_REPLICA_MAX_LAG_SEC", "5"))
+        except Exception as e:
+            log.warning("mysql replica check failed, reads go to primary: %s", e)
+            lag, ok = None, False
+        if ok != _replica_state["ok"]:
+            log.info("mysql replica %s (lag=%s)", "enabled" if ok else "disabled", lag)
+        _replica_state.update(ok=ok, lag_s=lag, checked=time.monotonic())
+        return ok
+
+def _pool_for_read() -> MySQLPool:
+    if _read_replica.get() and replica_available():
+        return _replica_pool
+    return get_pool()
+
+def use_replica(fn):
+    """
+    标注只读的列表/报表函数（含 Flask 路由）：其中经 mysql_conn()/get_mysql_conn() 借出的连接走只读副本。
+    副本未配置、延迟超过 MYSQL_REPLICA_MAX_LAG_SEC 或不可用时自动回退主库。被标注的函数里不要写库。
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _read_replica.set(True)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _read_replica.reset(token)
+    return wrapper
+
+def pool_stats() -> dict:
+    return {
+        "primary": _pool.stats() if _pool is not None else None,
+        "replica": _replica_pool.stats() if _replica_pool is not None else None,
+        "replica_ok": _replica_state["ok"],
+        "replica_lag_s": _replica_state["lag_s"],
+    }
+
+@contextmanager
+def mysql_conn():
+    """从连接池借一条连接，退出时归还（不关闭）；在 use_replica 标注的调用里优先走只读副本。"""
+    pool = _pool_for_read()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+@contextmanager
+def read_conn():
+    """显式借一条只读连接（副本不可用时为主库连接）。"""
+    token = _read_replica.set(True)
+    try:
+        with mysql_conn() as conn:
+            yield conn
+    finally:
+        _read_replica.reset(token)
+
+def get_mysql_conn():
+    """兼容旧调用：返回代理连接，调用方 close() 或 with 退出时归还连接池。"""
+    pool = _pool_for_read()
+    return PooledConnection(pool, pool.acquire())
 
 
 # --- compat alias for legacy code ---
@@ -2,24 +2,36 @@ import os
 from redis import Redis, ConnectionPool
 
 _pool = None
+_raw_pool = None
 
-def get_redis() -> Redis:
-    global _pool
-
-    # 优先支持 REDIS_URL（如 redis://127.0.0.1:6379/0）
-    url = os.getenv("REDIS_URL", "").strip()
-    if url:
-        return Redis.from_url(url, decode_responses=True)
 
+def _pool_kwargs() -> dict:
     host = os.getenv("REDIS_HOST", "127.0.0.1")
     port = int(os.getenv("REDIS_PORT", "6379"))
     db   = int(os.getenv("REDIS_DB", "0"))
     # 只有在密码“非空”时才传入，从而避免对无密码实例执行 AUTH
     pwd  = os.getenv("REDIS_PASSWORD", "").strip() or None
+    return dict(host=host, port=port, db=db, password=pwd, socket_connect_timeout=2)
+
+
+def get_redis() -> Redis:
+    global _pool
 
     if _pool is None:
-        _pool = ConnectionPool(
-            host=host, port=port, db=db, password=pwd,
-            decode_responses=True, socket_connect_timeout=2
-        )
+        # 优先支持 REDIS_URL（如 redis://127.0.0.1:6379/0）；两种配置都只建一次连接池
+        url = os.getenv("REDIS_URL", "").strip()
+        if url:
+            _pool = ConnectionPool.from_url(url, decode_responses=True)
+        else:
+            _pool = ConnectionPool(decode_responses=True, **_pool_kwargs())
     return Redis(connection_pool=_pool)
+
+
+def get_redis_raw() -> Redis:
+    """RQ 的任务数据是 pickle 二进制，不能开启 decode_responses，单独一条连接池。"""
+    global _raw_pool
+
+    if _raw_pool is None:
+        url = os.getenv("REDIS_URL", "").strip()
+        _raw_pool = ConnectionPool.from_url(url) if url else ConnectionPool(**_pool_kwargs())
+    return Redis(connection_pool=_raw_pool)
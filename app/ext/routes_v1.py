@@ -1,5 +1,5 @@
 from flask import Blueprint, request, jsonify, g
-from app.core.db import get_mysql_conn
+from app.core.db import get_mysql_conn, use_replica
 from datetime import datetime
 
 bp = Blueprint("ext_v1", __name__, url_prefix="/api/v1/ext")
@@ -33,6 +33,7 @@ def _parse_dt(s):
 
 # ---- A1: GET /ext/contacts ----
 @bp.get("/contacts")
+@use_replica
 def list_contacts():
     try:
         page = max(int(request.args.get("page", 1)), 1)
@@ -134,6 +135,7 @@ def list_contacts():
 
 # ---- A2: GET /ext/tags （按 tag_id 汇总）----
 @bp.get("/tags")
+@use_replica
 def list_tags():
     try:
         page = max(int(request.args.get("page", 1)), 1)
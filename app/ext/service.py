@@ -2,99 +2,233 @@
 """外部联系人同步与查询服务。"""
 
 import json
-import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
 from typing import Iterator
 
-from app.core.db import get_mysql_conn
-from app.wecom.client import wecom_get_json, wecom_post_json
+from app.common import sync_state
+from app.common.bulk import BulkUpserter
+from app.common.cache import GEN_MEMBERS, bump_generation
+from app.common.sync_state import ChangeFilter
+from app.core.config import settings
+from app.core.db import mysql_conn
+from app.wecom.client import wecom_post_json
 
 
 @contextmanager
 def _use_cursor() -> Iterator:
-    conn = get_mysql_conn()
-    try:
-        with conn.cursor() as cur:
-            yield cur
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+    with mysql_conn() as conn, conn.cursor() as cur:
+        yield cur
 
 
-def _employees() -> list[str]:
-    with _use_cursor() as cur:
-        cur.execute("SELECT userid FROM org_employee WHERE enable=1 OR enable IS NULL")
-        return [row["userid"] for row in cur.fetchall()]
+def _employees(cur) -> list[str]:
+    cur.execute("SELECT userid FROM org_employee WHERE enable=1 OR enable IS NULL")
+    return [row["userid"] for row in cur.fetchall()]
+
+
+def _fetch_batch_page(userids: list[str], cursor: str, limit: int) -> tuple[list, str]:
+    data = wecom_post_json(
+        "https://qyapi.weixin.qq.com/cgi-bin/externalcontact/batch/get_by_user",
+        "ext",
+        body={"userid_list": userids, "cursor": cursor or "", "limit": limit},
+    )
+    return data.get("external_contact_list") or [], data.get("next_cursor") or ""
+
+
+def _iter_contact_pages(groups: list[list[str]], workers: int, limit: int) -> Iterator[tuple[int, list, bool]]:
+    """
+    有界并发拉取：每组员工一条游标链，同时在途的请求不超过 workers 个；
+    按完成先后产出 (组序号, 本页数据, 该组是否已拉完)，限速由 ext 限流桶统一控制。
+    """
+    order = iter(range(len(groups)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+
+        def _submit(idx, cursor=""):
+            pending[pool.submit(_fetch_batch_page, groups[idx], cursor, limit)] = idx
+
+        for idx in islice(order, workers):
+            _submit(idx)
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for fut in done:
+                idx = pending.pop(fut)
+                items, next_cursor = fut.result()
+                if next_cursor:
+                    _submit(idx, next_cursor)
+                else:
+                    nxt = next(order, None)
+                    if nxt is not None:
+                        _submit(nxt)
+                yield idx, items, not next_cursor
+
+
+def _ts(value) -> datetime | None:
+    return datetime.fromtimestamp(int(value)) if value else None
 
 
-def sync_contacts(full: bool = False, throttle_ms: int = 200) -> dict:
-    up_contact = up_follow = up_tagrel = 0
+def _removed_tags(cur, follows: dict) -> list[tuple[str, str]]:
+    """
+    follows 为本页拉到的 {external_userid: {userid: tag_ids}}；返回企微侧已不存在的 (客户, 标签)。
+    ext_contact_tag 是所有跟进人标签的并集：库里其他跟进人的 tag_ids 与本页的合并后，
+    不在并集里的才删。有跟进人 tag_ids 未知（NULL，迁移前的存量行）的客户不删。
+    """
+    eids = list(follows)
+    if not eids:
+        return []
+    placeholders = ",".join(["%s"] * len(eids))
+    cur.execute(
+        f"SELECT external_userid, userid, tag_ids FROM ext_follow_user WHERE external_userid IN ({placeholders})",
+        eids,
+    )
+    tags = {eid: dict(by_user) for eid, by_user in follows.items()}
+    for row in cur.fetchall():
+        by_user = tags[row["external_userid"]]
+        if row["userid"] not in by_user:
+            raw = row["tag_ids"]
+            by_user[row["userid"]] = json.loads(raw) if isinstance(raw, (str, bytes)) else raw
+    keep = {}
+    for eid, by_user in tags.items():
+        if all(v is not None for v in by_user.values()):
+            keep[eid] = {t for v in by_user.values() for t in v}
+    if not keep:
+        return []
+    placeholders = ",".join(["%s"] * len(keep))
+    cur.execute(
+        f"SELECT external_userid, tag_id FROM ext_contact_tag WHERE external_userid IN ({placeholders})",
+        list(keep),
+    )
+    return [(row["external_userid"], row["tag_id"]) for row in cur.fetchall()
+            if row["tag_id"] not in keep[row["external_userid"]]]
+
+
+def sync_contacts(full: bool = False, throttle_ms: int = 0, workers: int | None = None,
+                  users_per_call: int = 100, page_limit: int = 100,
+                  chunk_size: int | None = None) -> dict:
+    """
+    通过 batch/get_by_user 按员工批量拉取客户详情（每条为 客户 + 一个跟进人）。
+    - 增量（full=False）：从 sync_state 断点续跑；客户/跟进关系按内容哈希比对，未变化的整行跳过
+    - 断点 = 已连续拉完的员工分组里最后一个 userid（员工按 userid 排序），分组落库后才推进
+    - 写库走 BulkUpserter：按 chunk_size 攒批 INSERT ... ON DUPLICATE KEY UPDATE
+    - 跟进关系变化的客户，企微侧已移除的标签与新标签在同一事务里先删后写
+    throttle_ms 仅为兼容旧调用保留，限速统一由 app.wecom.client 的 ext 限流桶负责。
+    """
+    workers = max(1, int(workers or settings.ext_sync_workers))
+    up_contact = up_follow = up_tagrel = del_tagrel = 0
+    started = datetime.now()
     with _use_cursor() as cur:
-        for userid in _employees():
-            listing = wecom_get_json(
-                "https://qyapi.weixin.qq.com/cgi-bin/externalcontact/list",
-                "ext",
-                params={"userid": userid},
-            )
-            for external_userid in listing.get("external_userid", []):
-                detail = wecom_get_json(
-                    "https://qyapi.weixin.qq.com/cgi-bin/externalcontact/get",
-                    "ext",
-                    params={"external_userid": external_userid},
-                )
-                info = detail.get("external_contact", {})
-                follow_users = detail.get("follow_user", [])
-                cur.execute(
-                    """
-                    REPLACE INTO ext_contact
-                        (external_userid, name, corp_full_name, position, gender, unionid, ext)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (
-                        info.get("external_userid") or external_userid,
-                        info.get("name"),
-                        info.get("corp_full_name"),
-                        info.get("position"),
-                        info.get("gender"),
-                        info.get("unionid"),
-                        json.dumps(info, ensure_ascii=False),
-                    ),
-                )
-                up_contact += 1
-                for follow in follow_users:
-                    cur.execute(
-                        """
-                        REPLACE INTO ext_follow_user
-                            (external_userid, userid, remark, state, add_way, create_time)
-                        VALUES (%s, %s, %s, %s, %s, FROM_UNIXTIME(%s))
-                        """,
-                        (
+        resume_after = None if full else sync_state.get_state(cur, "ext", "contacts").get("sync_cursor")
+        userids = sorted(_employees(cur))
+        if resume_after:
+            userids = [u for u in userids if u > resume_after]
+        groups = [userids[i:i + users_per_call] for i in range(0, len(userids), users_per_call)]
+
+        writer = BulkUpserter(cur, chunk_size)
+        writer.register(
+            "ext_contact",
+            ["external_userid", "name", "corp_full_name", "position", "gender", "unionid", "ext"],
+            update=["name", "corp_full_name", "position", "gender", "unionid", "ext"],
+        )
+        writer.register(
+            "ext_follow_user",
+            ["external_userid", "userid", "remark", "state", "add_way", "create_time", "tag_ids"],
+            update=["remark", "state", "add_way", "create_time", "tag_ids"],
+        )
+        writer.register("ext_contact_tag", ["external_userid", "tag_id"])
+        # 跟进人/标签变了而客户行未变时 ext_contact.updated_at 不动，单独记给会员宽表增量刷新
+        writer.register("member_profile_dirty", ["external_userid"])
+        contact_flt = ChangeFilter(cur, writer, "ext", "contacts", full)
+        follow_flt = ChangeFilter(cur, writer, "ext", "follow", full)
+
+        finished, low_water = set(), 0
+        try:
+            with writer:
+                for idx, items, group_done in _iter_contact_pages(groups, workers, page_limit):
+                    contacts, follows = {}, {}
+                    for item in items:
+                        info = item.get("external_contact") or {}
+                        follow = item.get("follow_info") or {}
+                        external_userid = info.get("external_userid")
+                        if not external_userid:
+                            continue
+                        # 同一客户有多个跟进人时一页内会出现多次，主表只写一次
+                        contacts.setdefault(external_userid, info)
+                        if follow.get("userid"):
+                            follows[f"{external_userid}:{follow['userid']}"] = (external_userid, follow)
+
+                    for external_userid in contact_flt.changed(contacts):
+                        info = contacts[external_userid]
+                        writer.add("ext_contact", (
+                            external_userid,
+                            info.get("name"),
+                            info.get("corp_full_name"),
+                            info.get("position"),
+                            info.get("gender"),
+                            info.get("unionid"),
+                            json.dumps(info, ensure_ascii=False),
+                        ))
+                        contact_flt.mark(external_userid)
+                        up_contact += 1
+
+                    changed_follows = follow_flt.changed({k: v[1] for k, v in follows.items()})
+                    fresh_tags = {}
+                    for key in changed_follows:
+                        external_userid, follow = follows[key]
+                        fresh_tags.setdefault(external_userid, {})[follow["userid"]] = follow.get("tag_id") or []
+                    for external_userid in fresh_tags:
+                        writer.add("member_profile_dirty", (external_userid,))
+                    for pair in _removed_tags(cur, fresh_tags):
+                        writer.delete("ext_contact_tag", ["external_userid", "tag_id"], pair)
+                        del_tagrel += 1
+                    for key in changed_follows:
+                        external_userid, follow = follows[key]
+                        writer.add("ext_follow_user", (
                             external_userid,
                             follow.get("userid"),
                             follow.get("remark"),
                             follow.get("state"),
                             follow.get("add_way"),
-                            follow.get("createtime") or 0,
-                        ),
-                    )
-                    for tag_id in follow.get("tags") or []:
-                        cur.execute(
-                            """REPLACE INTO ext_contact_tag (external_userid, tag_id) VALUES (%s, %s)""",
-                            (external_userid, tag_id),
-                        )
-                        up_tagrel += 1
-                    up_follow += 1
-            time.sleep(throttle_ms / 1000.0)
+                            _ts(follow.get("createtime")),
+                            json.dumps(follow.get("tag_id") or [], ensure_ascii=False),
+                        ))
+                        for tag_id in follow.get("tag_id") or []:
+                            writer.add("ext_contact_tag", (external_userid, tag_id))
+                            up_tagrel += 1
+                        follow_flt.mark(key)
+                        up_follow += 1
+
+                    if group_done:
+                        finished.add(idx)
+                        if idx == low_water:
+                            while low_water in finished:
+                                low_water += 1
+                            writer.flush()
+                            sync_state.save_cursor(cur, "ext", "contacts", groups[low_water - 1][-1])
+                            sync_state.save_progress(cur, "ext", "contacts", done=low_water, total=len(groups),
+                                                     contacts_upserted=up_contact)
+            sync_state.mark_ok(cur, "ext", "contacts", started)
+        except Exception as e:
+            sync_state.mark_err(cur, "ext", "contacts", e)
+            raise
+        finally:
+            # 中途失败时已落库的部分同样要让会员元数据缓存失效
+            if up_contact or up_follow:
+                bump_generation(GEN_MEMBERS)
     return {
+        "mode": "full" if full else "incremental",
+        "resumed_after": resume_after,
         "contacts_upserted": up_contact,
         "follow_upserted": up_follow,
         "tag_relations": up_tagrel,
+        "tag_relations_removed": del_tagrel,
+        "skipped_unchanged": contact_flt.skipped + follow_flt.skipped,
+        "rows_written": dict(writer.written),
     }
 
 
-def sync_tags() -> dict:
+def sync_tags(chunk_size: int | None = None) -> dict:
     data = wecom_post_json(
         "https://qyapi.weixin.qq.com/cgi-bin/externalcontact/get_corp_tag_list",
         "ext",
@@ -102,23 +236,25 @@ def sync_tags() -> dict:
     )
     up = 0
     with _use_cursor() as cur:
-        for group in data.get("tag_group", []):
-            for tag in group.get("tag", []):
-                cur.execute(
-                    """
-                    REPLACE INTO ext_tag (tag_id, group_id, group_name, name, order_no)
-                    VALUES (%s, %s, %s, %s, %s)
-                    """,
-                    (
+        writer = BulkUpserter(cur, chunk_size).register(
+            "ext_tag",
+            ["tag_id", "group_id", "group_name", "name", "order_no"],
+            update=["group_id", "group_name", "name", "order_no"],
+        )
+        with writer:
+            for group in data.get("tag_group", []):
+                for tag in group.get("tag", []):
+                    writer.add("ext_tag", (
                         tag["id"],
                         group.get("group_id"),
                         group.get("group_name"),
                         tag.get("name"),
                         tag.get("order"),
-                    ),
-                )
-                up += 1
-    return {"tags_upserted": up}
+                    ))
+                    up += 1
+    if up:
+        bump_generation(GEN_MEMBERS)
+    return {"tags_upserted": up, "rows_written": dict(writer.written)}
 
 
 def list_contacts(tag: str | None = None, owner: str | None = None, page: int = 1, size: int = 50) -> dict:
@@ -1,85 +1,225 @@
 # -*- coding: utf-8 -*-
 """客户群拉取服务。"""
+import json
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from datetime import datetime
 from typing import Iterator
 
-from app.core.db import get_mysql_conn
+from app.common import sync_state
+from app.common.bulk import BulkUpserter
+from app.common.sync_state import ChangeFilter
+from app.core.config import settings
+from app.core.db import mysql_conn
+from app.core.redis import get_redis
 from app.wecom.client import wecom_post_json
 
+DIRTY_KEY = "group:chat:dirty"
+_DIRTY_SYNCING = DIRTY_KEY + ":syncing"
+
 
 @contextmanager
 def _use_cursor() -> Iterator:
-    conn = get_mysql_conn()
-    try:
-        with conn.cursor() as cur:
-            yield cur
-    finally:
+    with mysql_conn() as conn, conn.cursor() as cur:
+        yield cur
+
+
+def _ts(value) -> datetime | None:
+    return datetime.fromtimestamp(int(value)) if value else None
+
+
+def mark_dirty(chat_id: str):
+    """change_external_chat 回调调用：标记该群有变化，changed_only 同步时重拉详情。"""
+    get_redis().sadd(DIRTY_KEY, chat_id)
+
+
+def _take_dirty(r) -> set:
+    """把脏标记原子地转入处理中集合（并入上一轮失败遗留的），之后到达的回调进新的集合。"""
+    pipe = r.pipeline(transaction=True)
+    pipe.sunionstore(_DIRTY_SYNCING, [_DIRTY_SYNCING, DIRTY_KEY])
+    pipe.delete(DIRTY_KEY)
+    pipe.smembers(_DIRTY_SYNCING)
+    return set(pipe.execute()[-1])
+
+
+def _fetch_detail(chat_id: str) -> dict:
+    detail = wecom_post_json(
+        "https://qyapi.weixin.qq.com/cgi-bin/externalcontact/groupchat/get",
+        "ext",
+        body={"chat_id": chat_id},
+    )
+    return detail.get("group_chat", {})
+
+
+def _stored_versions(cur, chat_ids: list) -> dict:
+    """库里已有的群 -> member_version（可能为 NULL）。"""
+    if not chat_ids:
+        return {}
+    cur.execute(
+        f"SELECT chat_id, member_version FROM ec_groupchat WHERE chat_id IN ({','.join(['%s'] * len(chat_ids))})",
+        chat_ids,
+    )
+    return {row["chat_id"]: row["member_version"] for row in cur.fetchall()}
+
+
+def _load_members(cur, chat_ids: list) -> dict:
+    """chat_id -> {(member_id, member_type): 行}。"""
+    out = {}
+    if not chat_ids:
+        return out
+    cur.execute(
+        f"""
+        SELECT chat_id, member_id, member_type, join_time, unionid
+        FROM ec_groupchat_member WHERE chat_id IN ({','.join(['%s'] * len(chat_ids))})
+        """,
+        chat_ids,
+    )
+    for row in cur.fetchall():
+        out.setdefault(row["chat_id"], {})[(row["member_id"], row["member_type"])] = (
+            row["chat_id"], row["member_id"], row["member_type"], row["join_time"], row["unionid"],
+        )
+    return out
+
+
+def member_diff(existing: dict, rows: list) -> tuple[list, list]:
+    """
+    existing 为 {(member_id, member_type): 行}，rows 为本次拉到的成员行；
+    返回 (需 upsert 的新增/变化行, 退群成员的主键 (chat_id, member_id, member_type))。
+    """
+    fresh = {}
+    for row in rows:
+        if row[1]:
+            fresh[(row[1], row[2])] = row
+    upserts = [row for key, row in fresh.items() if existing.get(key) != row]
+    gone = [existing[key][:3] for key in existing if key not in fresh]
+    return upserts, gone
+
+
+def _delete_members(cur, keys: list, chunk: int) -> int:
+    for i in range(0, len(keys), chunk):
+        part = keys[i:i + chunk]
+        cur.execute(
+            "DELETE FROM ec_groupchat_member WHERE (chat_id, member_id, member_type) IN ("
+            + ",".join(["(%s,%s,%s)"] * len(part)) + ")",
+            [v for key in part for v in key],
+        )
+    return len(keys)
+
+
+def _member_row(chat_id: str, member: dict) -> tuple:
+    if member.get("type") == 1:
+        member_id, member_type, unionid = member.get("userid"), "employee", None
+    else:
+        member_id, member_type, unionid = member.get("external_userid"), "external", member.get("unionid")
+    return chat_id, member_id, member_type, _ts(member.get("join_time")), unionid
+
+
+def sync_groupchats(limit: int = 100, full: bool = False, changed_only: bool = False,
+                    workers: int | None = None) -> dict:
+    """
+    groupchat/list 分页游标在每页落库后写入 sync_state，中断后从断点续跑。
+    - 群详情按 workers 有界并发拉取，限速由 ext 限流桶统一控制
+    - 群详情按内容哈希比对，未变化的群整组跳过；变化的群若 member_version 未变只更新群信息，
+      否则成员按集合差异落库：新增/变化的成员多行 upsert，退群的成员多行 DELETE
+    - changed_only=True：只拉库里没有的群和收到 change_external_chat 回调的群，其余群不调详情接口；
+      该模式总是从列表第一页开始，脏标记按页落库后逐个清除
+    """
+    workers = max(1, int(workers or settings.group_sync_workers))
+    up_chat = up_member = del_member = skipped_clean = 0
+    started = datetime.now()
+    r = get_redis() if changed_only and not full else None
+    dirty = _take_dirty(r) if r is not None else set()
+    with _use_cursor() as cur, ThreadPoolExecutor(max_workers=workers) as pool:
+        # changed_only 每轮从头遍历列表（只翻列表页，不拉未变化群的详情）：
+        # 从断点续跑会漏掉断点之前的脏群
+        cursor = None if full or r is not None else sync_state.get_state(cur, "group", "groupchat").get("sync_cursor")
+        resumed_from = cursor
+        writer = BulkUpserter(cur)
+        writer.register(
+            "ec_groupchat",
+            ["chat_id", "name", "owner", "notice", "create_time", "status", "member_version", "update_time", "ext"],
+            update=["name", "owner", "notice", "create_time", "status", "member_version", "update_time", "ext"],
+        )
+        writer.register(
+            "ec_groupchat_member",
+            ["chat_id", "member_id", "member_type", "join_time", "unionid"],
+            update=["join_time", "unionid"],
+        )
+        flt = ChangeFilter(cur, writer, "group", "groupchat", full)
         try:
-            conn.close()
-        except Exception:
-            pass
-
-
-def sync_groupchats(limit: int = 100) -> dict:
-    cursor = None
-    up_chat = up_member = 0
-    with _use_cursor() as cur:
-        while True:
-            body = {"status_filter": 0, "owner_filter": {}, "cursor": cursor, "limit": limit}
-            listing = wecom_post_json(
-                "https://qyapi.weixin.qq.com/cgi-bin/externalcontact/groupchat/list",
-                "ext",
-                body=body,
-            )
-            for item in listing.get("group_chat_list", []):
-                chat_id = item.get("chat_id")
-                detail = wecom_post_json(
-                    "https://qyapi.weixin.qq.com/cgi-bin/externalcontact/groupchat/get",
+            while True:
+                body = {"status_filter": 0, "owner_filter": {}, "cursor": cursor, "limit": limit}
+                listing = wecom_post_json(
+                    "https://qyapi.weixin.qq.com/cgi-bin/externalcontact/groupchat/list",
                     "ext",
-                    body={"chat_id": chat_id},
+                    body=body,
                 )
-                group_chat = detail.get("group_chat", {})
-                cur.execute(
-                    """
-                    REPLACE INTO ec_groupchat
-                        (chat_id, name, owner, notice, create_time, status, ext)
-                    VALUES (%s, %s, %s, %s, FROM_UNIXTIME(%s), %s, %s)
-                    """,
-                    (
-                        group_chat.get("chat_id"),
+                chat_ids = [item["chat_id"] for item in listing.get("group_chat_list", []) if item.get("chat_id")]
+                versions = _stored_versions(cur, chat_ids)
+                if r is not None:
+                    fetch = [c for c in chat_ids if c not in versions or c in dirty]
+                    skipped_clean += len(chat_ids) - len(fetch)
+                else:
+                    fetch = chat_ids
+                details = dict(zip(fetch, pool.map(_fetch_detail, fetch)))
+
+                changed = flt.changed(details)
+                now = datetime.now()
+                resync = [c for c in changed if full or not details[c].get("member_version")
+                          or details[c].get("member_version") != versions.get(c)]
+                # 先落成员变化，再写群行（新 member_version）与内容哈希：中途失败时群仍是旧版本，下轮重新比对
+                existing = _load_members(cur, resync)
+                departed = []
+                for chat_id in resync:
+                    rows = [_member_row(chat_id, m) for m in details[chat_id].get("member_list", [])]
+                    upserts, gone = member_diff(existing.get(chat_id, {}), rows)
+                    for row in upserts:
+                        writer.add("ec_groupchat_member", row)
+                    up_member += len(upserts)
+                    departed += gone
+                writer.flush()
+                del_member += _delete_members(cur, departed, writer.chunk_size)
+                for chat_id in changed:
+                    group_chat = details[chat_id]
+                    writer.add("ec_groupchat", (
+                        chat_id,
                         group_chat.get("name"),
                         group_chat.get("owner"),
                         group_chat.get("notice"),
-                        group_chat.get("create_time") or 0,
+                        _ts(group_chat.get("create_time")),
                         group_chat.get("status"),
-                    ),
-                )
-                up_chat += 1
-                for member in group_chat.get("member_list", []):
-                    if member.get("type") == 1:
-                        member_id, member_type, unionid = member.get("userid"), "employee", None
-                    else:
-                        member_id, member_type, unionid = (
-                            member.get("external_userid"),
-                            "external",
-                            member.get("unionid"),
-                        )
-                    cur.execute(
-                        """
-                        REPLACE INTO ec_groupchat_member
-                            (chat_id, member_id, member_type, join_time, unionid)
-                        VALUES (%s, %s, %s, FROM_UNIXTIME(%s), %s)
-                        """,
-                        (
-                            group_chat.get("chat_id"),
-                            member_id,
-                            member_type,
-                            member.get("join_time") or 0,
-                            unionid,
-                        ),
-                    )
-                    up_member += 1
-            cursor = listing.get("next_cursor")
-            if not cursor:
-                break
-    return {"groupchats": up_chat, "members": up_member}
+                        group_chat.get("member_version"),
+                        now,
+                        json.dumps(group_chat, ensure_ascii=False),
+                    ))
+                    up_chat += 1
+                    flt.mark(chat_id)
+                writer.flush()
+                if r is not None:
+                    done = [c for c in fetch if c in dirty]
+                    if done:
+                        # 只清本页已落库的脏标记；中途失败时其余脏群留在处理中集合，下一轮重拉
+                        r.srem(_DIRTY_SYNCING, *done)
+
+                cursor = listing.get("next_cursor")
+                if not cursor:
+                    break
+                sync_state.save_cursor(cur, "group", "groupchat", cursor)
+                sync_state.save_progress(cur, "group", "groupchat", groupchats=up_chat, members=up_member,
+                                         skipped_unchanged=flt.skipped)
+            sync_state.mark_ok(cur, "group", "groupchat", started)
+        except Exception as e:
+            sync_state.mark_err(cur, "group", "groupchat", e)
+            raise
+    if r is not None:
+        # 整轮跑完：剩下的脏标记对应已不在列表里的群（已解散），一并清掉
+        r.delete(_DIRTY_SYNCING)
+    return {
+        "resumed_from": resumed_from,
+        "mode": "full" if full else ("changed_only" if changed_only else "incremental"),
+        "groupchats": up_chat,
+        "members": up_member,
+        "members_removed": del_member,
+        "skipped_unchanged": flt.skipped,
+        "skipped_clean": skipped_clean,
+    }
@@ -1,6 +1,9 @@
-from flask import Blueprint, request, jsonify, g
-import re, traceback, sys
+from flask import Blueprint, Response, request, jsonify, g, stream_with_context
+import json, traceback, sys
 from app.core.db import get_mysql_conn as get_conn  # 统一别名
+from app.core.db import use_replica
+from app.identity import service as identity_service
+from app.members import profile
 
 bp = Blueprint("identity_api", __name__, url_prefix="/api/v1/identity")
 
@@ -12,13 +15,6 @@ def j(payload, http=200):
         pass
     return resp, http
 
-def _norm_mobile(s: str) -> str:
-    """仅保留数字；若带 86 且长度>11，去掉前缀 86"""
-    digits = re.sub(r"\D+", "", s or "")
-    if digits.startswith("86") and len(digits) > 11:
-        digits = digits[2:]
-    return digits
-
 def _get_val(row, *keys_or_idx):
     """
     同时兼容 元组/列表/字典 的取值。
@@ -41,46 +37,43 @@ def _get_val(row, *keys_or_idx):
                 pass
     return None
 
+def _wants_ndjson() -> bool:
+    return request.args.get("format") == "ndjson" or \
+        "application/x-ndjson" in (request.headers.get("Accept") or "")
+
 @bp.post("/resolve-mobiles")
 def resolve_mobiles():
+    """
+    body: {"mobiles": [...]}
+    - 默认返回 {"mapped": [{mobile, external_userid}], "unmatched": [...]}
+    - ?format=ndjson 或 Accept: application/x-ndjson：逐行流式返回 {"mobile", "external_userid"|null}，适合 10 万级批量
+    """
     try:
         body = request.get_json(silent=True) or {}
         mobiles = body.get("mobiles") or []
-        norm = [_norm_mobile(x) for x in mobiles]
-        norm = [x for x in norm if x]  # 去空
-
-        if not norm:
-            return j({"ok": True, "data": {"mapped": [], "unmatched": []}})
 
-        placeholders = ",".join(["%s"] * len(norm))
-        sql = f"""
-            SELECT mobile_std, external_userid
-            FROM wecom_ops.vw_mobile_to_external
-            WHERE mobile_std IN ({placeholders})
-        """
-        conn = get_conn()
-        mapped_dict = {}
-        with conn.cursor() as cur:
-            cur.execute(sql, norm)
-            rows = cur.fetchall()
-            for r in rows:
-                mobile_std = _get_val(r, "mobile_std", 0)
-                external_userid = _get_val(r, "external_userid", 1)
-                if not mobile_std or not external_userid:
-                    continue
-                mapped_dict.setdefault(mobile_std, set()).add(external_userid)
+        if _wants_ndjson():
+            def _lines():
+                for m, eid in identity_service.resolve_mobiles(mobiles):
+                    yield json.dumps({"mobile": m, "external_userid": eid}, ensure_ascii=False) + "\n"
+            resp = Response(stream_with_context(_lines()), mimetype="application/x-ndjson")
+            resp.headers["X-Request-Id"] = getattr(g, "trace_id", "")
+            return resp
 
-        mapped = [{"mobile": m, "external_userid": sorted(list(v))[0]}
-                  for m, v in mapped_dict.items()]
-        unmatched = sorted(set(norm) - set(mapped_dict.keys()))
-
-        return j({"ok": True, "data": {"mapped": mapped, "unmatched": unmatched}})
+        mapped, unmatched = [], []
+        for m, eid in identity_service.resolve_mobiles(mobiles):
+            if eid:
+                mapped.append({"mobile": m, "external_userid": eid})
+            else:
+                unmatched.append(m)
+        return j({"ok": True, "data": {"mapped": mapped, "unmatched": sorted(unmatched)}})
     except Exception as e:
         return j({"ok": False, "error": {"code": "INTERNAL_ERROR",
                                          "message": str(e),
                                          "detail": traceback.format_exc()}}, 500)
 
 @bp.get("/mapping")
+@use_replica
 def mapping():
     try:
         eid = (request.args.get("external_userid") or "").strip()
@@ -106,9 +99,9 @@ def mapping():
                 unionid = _get_val(row, "unionid", 1)
 
             # 提取该 EID 的所有标准化手机号
-            cur.execute("""
+            cur.execute(f"""
                 SELECT DISTINCT mobile_std
-                FROM wecom_ops.vw_mobile_to_external
+                FROM {profile.source()}
                 WHERE external_userid=%s
             """, (eid,))
             rows = cur.fetchall()
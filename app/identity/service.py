@@ -1,23 +1,28 @@
 # -*- coding: utf-8 -*-
 """企业员工与外部联系人身份映射服务。"""
 
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
-from typing import Iterator
+from typing import Dict, Iterable, Iterator, List, Tuple
 
-from app.core.db import get_mysql_conn
+from app.common.cache import GEN_MEMBERS, generation
+from app.core.db import mysql_conn, read_conn, use_replica
+from app.members import profile
+
+_RESOLVE_CHUNK = int(os.getenv("IDENTITY_RESOLVE_CHUNK", "1000"))
+_LRU_SIZE = int(os.getenv("IDENTITY_LRU_SIZE", "100000"))
+_LRU_TTL_S = int(os.getenv("IDENTITY_LRU_TTL_SEC", "300"))
+_NON_DIGIT = re.compile(r"\D+")
 
 
 @contextmanager
 def _use_cursor() -> Iterator:
-    conn = get_mysql_conn()
-    try:
-        with conn.cursor() as cur:
-            yield cur
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+    with mysql_conn() as conn, conn.cursor() as cur:
+        yield cur
 
 
 def get_union_mapping(employee_id: str | None = None, external_userid: str | None = None) -> dict:
@@ -47,6 +52,7 @@ def get_union_mapping(employee_id: str | None = None, external_userid: str | Non
     return {}
 
 
+@use_replica
 def list_bi_views(view: str = "vw_contact_identity", page: int = 1, size: int = 50) -> dict:
     offset = (page - 1) * size
     with _use_cursor() as cur:
@@ -55,3 +61,104 @@ def list_bi_views(view: str = "vw_contact_identity", page: int = 1, size: int =
         cur.execute("SELECT FOUND_ROWS() AS n")
         total = cur.fetchone()["n"]
     return {"items": rows, "total": total, "page": page, "size": size}
+
+
+# -------------------------
+# 手机号 -> external_userid 批量解析
+# -------------------------
+def norm_mobile(s) -> str:
+    """仅保留数字；若带 86 且长度>11，去掉前缀 86（纯数字走快速路径）。"""
+    s = str(s or "").strip()
+    if not s.isdigit():
+        s = _NON_DIGIT.sub("", s)
+    if s.startswith("86") and len(s) > 11:
+        s = s[2:]
+    return s
+
+
+class _MobileLRU:
+    """热点手机号的进程内 LRU：值带写入时间与会员数据代际，代际变化或超过 TTL 即失效。"""
+
+    def __init__(self, size: int, ttl_s: int):
+        self.size, self.ttl_s = size, ttl_s
+        self._d: "OrderedDict[str, Tuple[str | None, int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: Iterable[str], gen: int) -> Dict[str, str | None]:
+        now, hits = time.monotonic(), {}
+        with self._lock:
+            for k in keys:
+                v = self._d.get(k)
+                if v is None:
+                    continue
+                if v[1] != gen or now - v[2] > self.ttl_s:
+                    del self._d[k]
+                    continue
+                self._d.move_to_end(k)
+                hits[k] = v[0]
+        return hits
+
+    def put_many(self, items: Dict[str, str | None], gen: int):
+        now = time.monotonic()
+        with self._lock:
+            for k, v in items.items():
+                self._d[k] = (v, gen, now)
+                self._d.move_to_end(k)
+            while len(self._d) > self.size:
+                self._d.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+
+
+_lru = _MobileLRU(_LRU_SIZE, _LRU_TTL_S)
+
+
+def _chunked(items: List[str], size: int) -> Iterator[List[str]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _lookup(cur, mobiles: List[str]) -> Dict[str, str | None]:
+    """
+    一块号码一次 IN 查询；一个号码对应多个客户时取最小的 external_userid。
+    数据源随 MEMBER_SOURCE：切到宽表（MEMBER_SOURCE=table）后走 mobile_std 索引，默认仍查视图。
+    """
+    cur.execute(
+        f"""
+        SELECT mobile_std, MIN(external_userid) AS external_userid
+        FROM {profile.source()}
+        WHERE mobile_std IN ({",".join(["%s"] * len(mobiles))})
+          AND external_userid IS NOT NULL AND external_userid <> ''
+        GROUP BY mobile_std
+        """,
+        mobiles,
+    )
+    found = {r["mobile_std"]: r["external_userid"] for r in cur.fetchall()}
+    return {m: found.get(m) for m in mobiles}
+
+
+def resolve_mobiles(mobiles: Iterable, chunk: int | None = None) -> Iterator[Tuple[str, str | None]]:
+    """
+    按输入顺序（去重后）逐块产出 (mobile_std, external_userid 或 None)。
+    先查 LRU，未命中的按固定大小分块 IN 查询，避免超 max_allowed_packet；可直接用于流式响应。
+    """
+    chunk = max(1, int(chunk or _RESOLVE_CHUNK))
+    norm = list(dict.fromkeys(m for m in (norm_mobile(x) for x in mobiles) if m))
+    if not norm:
+        return
+    try:
+        gen = generation(GEN_MEMBERS)
+    except Exception:
+        gen = -1
+    with read_conn() as conn, conn.cursor() as cur:
+        for part in _chunked(norm, chunk):
+            found = _lru.get_many(part, gen)
+            missing = [m for m in part if m not in found]
+            if missing:
+                fetched = _lookup(cur, missing)
+                _lru.put_many(fetched, gen)
+                found.update(fetched)
+            for m in part:
+                yield m, found.get(m)
@@ -0,0 +1 @@
+# pkg
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+RQ 队列与 worker：
+- 按优先级从高到低：callbacks（回调后续处理，秒级）> dispatch（群发批次）> media（名单导入）> sync（企微全量/增量同步，分钟到小时级）
+- 一个 worker 监听多个队列时，每次取任务都按上面的顺序先看高优先级队列，长同步不会插到回调和群发前面
+- 生产建议把 sync 单独起 worker，避免一个长同步占住 callbacks/dispatch 的唯一进程
+"""
+from rq import Queue, Worker
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from rq.results import Result
+
+from app.core.redis import get_redis_raw
+
+CALLBACKS = "callbacks"
+DISPATCH = "dispatch"
+MEDIA = "media"
+SYNC = "sync"
+
+PRIORITY = (CALLBACKS, DISPATCH, MEDIA, SYNC)
+
+
+def get_queue(name: str) -> Queue:
+    if name not in PRIORITY:
+        raise ValueError(f"unknown queue: {name}")
+    return Queue(name, connection=get_redis_raw())
+
+
+def fetch(job_id: str) -> Job | None:
+    try:
+        return Job.fetch(job_id, connection=get_redis_raw())
+    except NoSuchJobError:
+        return None
+
+
+def is_pending(job_id: str) -> bool:
+    """任务仍在排队或运行中（已结束、已过期、不存在都算否）。"""
+    job = fetch(job_id)
+    return job is not None and job.get_status() in ("queued", "started", "deferred", "scheduled")
+
+
+def describe(job_id: str) -> dict | None:
+    job = fetch(job_id)
+    if job is None:
+        return None
+    out = {
+        "job_id": job.id,
+        "queue": job.origin,
+        "status": job.get_status(),
+        "description": job.description,
+        "meta": job.meta,
+        "enqueued_at": job.enqueued_at,
+        "started_at": job.started_at,
+        "ended_at": job.ended_at,
+    }
+    result = job.latest_result()
+    if result is not None:
+        if result.type == Result.Type.SUCCESSFUL:
+            out["result"] = result.return_value
+        elif result.exc_string:
+            # 只回最后一行异常信息，完整堆栈看 worker 日志
+            out["error"] = result.exc_string.strip().splitlines()[-1]
+    return out
+
+
+def run_worker(names=None) -> None:
+    """names 为空时监听全部队列；传入的队列同样按 PRIORITY 排序。"""
+    names = [n for n in PRIORITY if n in (names or PRIORITY)]
+    Worker([get_queue(n) for n in names], connection=get_redis_raw()).work()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+后台任务接口：
+- POST /api/v1/jobs/sync/<name>       提交同步任务，JSON 请求体为同步函数参数（如 {"full": true}），返回 202 + job_id
+- GET  /api/v1/jobs/sync              各同步的 sync_state（含 extra.job / extra.progress）与当前占用的任务
+- POST /api/v1/jobs/callbacks/replay  死信回调重新投递（callbacks 队列）
+- GET  /api/v1/jobs/<job_id>          任务状态；同步任务附带 sync_state 里的进度
+"""
+from flask import Blueprint, request
+
+from app.common.response import ok, err
+from app.jobs import queues, sync
+
+bp = Blueprint("jobs_v1", __name__, url_prefix="/api/v1/jobs")
+
+
+@bp.post("/sync/<name>")
+def submit_sync(name: str):
+    params = request.get_json(silent=True) or {}
+    if not isinstance(params, dict):
+        return err("BAD_REQUEST", "body must be a JSON object", 400)
+    try:
+        job_id = sync.submit(name, params)
+    except KeyError:
+        return err("NOT_FOUND", f"unknown sync job: {name}", 404, {"choices": sorted(sync.SYNC_JOBS)})
+    except ValueError as e:
+        return err("BAD_REQUEST", str(e), 400)
+    except sync.JobConflict as e:
+        return err("CONFLICT", str(e), 409, {"job_id": e.job_id})
+    return ok({"job_id": job_id, "name": name, "queue": queues.SYNC}, 202)
+
+
+@bp.get("/sync")
+def list_sync():
+    return ok({"items": [sync.state(name) for name in sync.SYNC_JOBS]})
+
+
+@bp.post("/callbacks/replay")
+def replay_callbacks():
+    body = request.get_json(silent=True) or {}
+    try:
+        limit = max(1, min(int(body.get("limit") or 1000), 100_000))
+    except (TypeError, ValueError):
+        return err("BAD_REQUEST", "limit must be an integer", 400)
+    job = queues.get_queue(queues.CALLBACKS).enqueue(
+        "app.wecom.consumer.replay_dead", limit, job_timeout=600, result_ttl=86400,
+        description="callbacks:replay_dead",
+    )
+    return ok({"job_id": job.id, "queue": queues.CALLBACKS}, 202)
+
+
+@bp.get("/<job_id>")
+def job_status(job_id: str):
+    data = queues.describe(job_id)
+    if data is None:
+        return err("NOT_FOUND", "job not found or expired", 404)
+    name = (data.get("meta") or {}).get("name")
+    if name in sync.SYNC_JOBS:
+        data["sync_state"] = sync.state(name)
+    return ok(data)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+周期任务：监听 sync 队列的 worker 进程内起一个线程，按间隔提交 SYNC_JOBS 里的任务。
+- 多个 worker 同时运行时，jobs:sched:{name}（SET NX EX 间隔）保证每个间隔只提交一次
+- 提交时遇到同 domain 任务仍在排队/运行（JobConflict）直接跳过，等下个间隔
+- 间隔配 0 关闭对应任务
+"""
+import logging
+import os
+import threading
+
+from app.core.redis import get_redis
+from app.jobs import sync
+
+log = logging.getLogger(__name__)
+
+PERIODIC = {
+    "audience.rebuild": int(os.getenv("AUDIENCE_REBUILD_SEC", "3600")),
+    "mass.sweep": int(os.getenv("MASS_SWEEP_SEC", "300")),
+    "members.profile": int(os.getenv("MEMBER_PROFILE_REFRESH_SEC", "900")),
+}
+
+_TICK_S = 10
+
+
+def tick() -> list:
+    """到期的周期任务各提交一次，返回本次提交的任务名。"""
+    r = get_redis()
+    submitted = []
+    for name, every in PERIODIC.items():
+        if every <= 0 or not r.set(f"jobs:sched:{name}", "1", nx=True, ex=every):
+            continue
+        try:
+            sync.submit(name)
+            submitted.append(name)
+        except sync.JobConflict:
+            pass
+        except Exception as e:
+            log.warning("periodic job %s submit failed: %s", name, e)
+    return submitted
+
+
+def _loop(stop: threading.Event):
+    while not stop.wait(_TICK_S):
+        try:
+            tick()
+        except Exception as e:
+            log.warning("periodic scheduler tick failed: %s", e)
+
+
+def start() -> threading.Event:
+    """后台线程启动调度，返回用于停止的 Event。"""
+    stop = threading.Event()
+    threading.Thread(target=_loop, args=(stop,), name="jobs-schedule", daemon=True).start()
+    return stop
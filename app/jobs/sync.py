@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+企微同步后台任务（sync 队列）：
+- SYNC_JOBS 登记可提交的同步：name -> (domain, item, 函数)；item 与各同步函数写 sync_state 用的 item 一致
+- submit：同一 domain 只允许一个排队/运行中的任务（jobs:active:{domain}），重复提交抛 JobConflict 并带回已有任务 id
+- run：worker 里再拿 domain 级单名额信号量（jobs:lock:{domain}）才执行，两个同步任务不会在同一 domain 上并行；
+  运行期间后台线程续租，worker 被杀时租约到期自动释放
+- 任务状态写 sync_state.extra.job；同步函数在断点处自己写 extra.progress
+"""
+import importlib
+import inspect
+import json
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime
+from typing import Any, Dict
+
+from rq import get_current_job
+
+from app.common import sync_state
+from app.common.semaphore import Semaphore
+from app.core.db import mysql_conn
+from app.core.redis import get_redis
+from app.jobs import queues
+
+log = logging.getLogger(__name__)
+
+SYNC_JOBS = {
+    "org.departments": ("org", "departments", "app.org.service:sync_departments"),
+    "org.employees": ("org", "employees", "app.org.service:sync_employees"),
+    "ext.contacts": ("ext", "contacts", "app.ext.service:sync_contacts"),
+    "ext.tags": ("ext", "tags", "app.ext.service:sync_tags"),
+    "group.groupchat": ("group", "groupchat", "app.group.service:sync_groupchats"),
+    "kf.accounts": ("kf", "kf_account", "app.kf.service:sync_kf_accounts"),
+    "kf.servicers": ("kf", "kf_servicer", "app.kf.service:sync_kf_servicers"),
+    "audience.rebuild": ("audience", "index", "app.members.audience:rebuild_from_db"),
+    "mass.sweep": ("mass", "sweep", "app.mass.dispatcher:sweep_stale"),
+    "members.profile": ("members", "profile", "app.members.profile:refresh"),
+}
+
+JOB_TIMEOUT_S = int(os.getenv("JOBS_SYNC_TIMEOUT_SEC", "14400"))
+_LOCK_LEASE_S = 300
+_RESULT_TTL_S = 7 * 86400
+
+
+class JobConflict(RuntimeError):
+    def __init__(self, domain: str, job_id: str | None = None):
+        super().__init__(f"{domain} sync already queued or running" + (f" (job {job_id})" if job_id else ""))
+        self.domain = domain
+        self.job_id = job_id
+
+
+def _active_key(domain: str) -> str:
+    return f"jobs:active:{domain}"
+
+
+def _lock(domain: str) -> Semaphore:
+    return Semaphore(f"jobs:lock:{domain}", capacity=1, lease_s=_LOCK_LEASE_S)
+
+
+def _resolve(name: str):
+    if name not in SYNC_JOBS:
+        raise KeyError(name)
+    domain, item, path = SYNC_JOBS[name]
+    mod, attr = path.split(":")
+    return domain, item, getattr(importlib.import_module(mod), attr)
+
+
+def check_params(name: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """只接受同步函数签名里的参数；未知任务抛 KeyError，未知参数抛 ValueError。"""
+    _, _, fn = _resolve(name)
+    unknown = sorted(set(params) - set(inspect.signature(fn).parameters))
+    if unknown:
+        raise ValueError(f"unknown params for {name}: {', '.join(unknown)}")
+    return params
+
+
+def _job_state(domain: str, item: str, reset_progress: bool = False, **fields):
+    """状态写库失败不影响任务本身，只记日志。"""
+    try:
+        with mysql_conn() as conn, conn.cursor() as cur:
+            sync_state.save_extra(cur, domain, item, "job",
+                                  {**fields, "at": datetime.now().isoformat(timespec="seconds")})
+            if reset_progress:
+                sync_state.save_extra(cur, domain, item, "progress", {})
+    except Exception as e:
+        log.warning("sync job state write failed %s.%s: %s", domain, item, e)
+
+
+def state(name: str) -> dict:
+    """sync_state 行（含 extra.job / extra.progress）+ 当前占着 domain 的任务 id。"""
+    domain, item, _ = SYNC_JOBS[name]
+    with mysql_conn() as conn, conn.cursor() as cur:
+        row = dict(sync_state.get_state(cur, domain, item))
+    if isinstance(row.get("extra"), (str, bytes)):
+        row["extra"] = json.loads(row["extra"])
+    return {"name": name, "domain": domain, "item": item,
+            "active_job_id": get_redis().get(_active_key(domain)), **row}
+
+
+def submit(name: str, params: Dict[str, Any] | None = None) -> str:
+    domain, item, _ = _resolve(name)
+    params = check_params(name, dict(params or {}))
+    r = get_redis()
+    key = _active_key(domain)
+    job_id = uuid.uuid4().hex
+    if not r.set(key, job_id, nx=True, ex=JOB_TIMEOUT_S):
+        current = r.get(key)
+        if current and queues.is_pending(current):
+            raise JobConflict(domain, current)
+        # 上一个任务已结束但没清掉标记（worker 被杀等），直接接管
+        r.set(key, job_id, ex=JOB_TIMEOUT_S)
+    try:
+        queues.get_queue(queues.SYNC).enqueue(
+            run, name, params,
+            job_id=job_id,
+            job_timeout=JOB_TIMEOUT_S,
+            result_ttl=_RESULT_TTL_S,
+            failure_ttl=_RESULT_TTL_S,
+            description=f"sync:{name}",
+            meta={"name": name, "domain": domain, "item": item},
+        )
+    except Exception:
+        r.delete(key)
+        raise
+    _job_state(domain, item, id=job_id, name=name, status="queued")
+    return job_id
+
+
+def _heartbeat(lock: Semaphore, token: str, stop: threading.Event):
+    while not stop.wait(_LOCK_LEASE_S / 3):
+        if not lock.refresh(token):
+            log.warning("sync lock %s lost before job finished", lock.key)
+            return
+
+
+def run(name: str, params: Dict[str, Any] | None = None) -> dict:
+    """worker 里执行的任务体；也可以直接调用（同样受 domain 锁保护）。"""
+    domain, item, fn = _resolve(name)
+    job = get_current_job()
+    job_id = job.id if job else None
+    try:
+        lock = _lock(domain)
+        token, _ = lock.try_acquire()
+        if token is None:
+            raise JobConflict(domain)
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(lock, token, stop), daemon=True)
+        beat.start()
+        _job_state(domain, item, reset_progress=True, id=job_id, name=name, status="running")
+        try:
+            result = fn(**(params or {}))
+        except Exception as e:
+            _job_state(domain, item, id=job_id, name=name, status="failed", error=str(e)[:512])
+            raise
+        finally:
+            stop.set()
+            beat.join()
+            lock.release(token)
+        _job_state(domain, item, id=job_id, name=name, status="done", result=result)
+        return result
+    finally:
+        if job_id:
+            r = get_redis()
+            if r.get(_active_key(domain)) == job_id:
+                r.delete(_active_key(domain))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+后台任务 worker：
+    python -m app.jobs.worker                     # 全部队列，按优先级
+    python -m app.jobs.worker callbacks dispatch  # 只处理回调与群发
+    python -m app.jobs.worker sync                # 单独跑同步
+队列名也可以用冒号连写（callbacks:dispatch），方便作为 systemd 模板实例名。
+监听 sync 队列的 worker 同时负责提交周期任务（app/jobs/schedule.py）。
+"""
+import logging
+import sys
+
+from app.jobs import schedule
+from app.jobs.queues import PRIORITY, SYNC, run_worker
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    names = [n for arg in sys.argv[1:] for n in arg.split(":") if n]
+    unknown = [n for n in names if n not in PRIORITY]
+    if unknown:
+        sys.exit(f"unknown queue(s): {', '.join(unknown)}; choose from {', '.join(PRIORITY)}")
+    if not names or SYNC in names:
+        schedule.start()
+    run_worker(names or None)
@@ -1,69 +1,101 @@
 # -*- coding: utf-8 -*-
 """客服同步相关服务。"""
 
-from app.core.db import get_mysql_conn
+import json
+from contextlib import contextmanager
+from datetime import datetime
+
+from app.common import sync_state
+from app.common.bulk import BulkUpserter
+from app.common.sync_state import ChangeFilter
+from app.core.db import mysql_conn
 from app.wecom.client import wecom_get_json
 
 
 @contextmanager
 def _use_cursor():
-    """提供一次性游标，确保数据库连接按需释放。"""
-    conn = get_mysql_conn()
-    try:
-        with conn.cursor() as cur:
-            yield cur
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+    """提供一次性游标，连接用完归还连接池。"""
+    with mysql_conn() as conn, conn.cursor() as cur:
+        yield cur
 
 
-def sync_kf_accounts(offset: int = 0, limit: int = 100) -> dict:
+def sync_kf_accounts(offset: int = 0, limit: int = 100, full: bool = False) -> dict:
+    """
+    按 offset 分页拉客服账号；每页落库后把下一页 offset 记入 sync_state，
+    中断后从断点续跑。账号内容未变化的整行跳过。
+    """
     up = 0
+    started = datetime.now()
     with _use_cursor() as cur:
-        while True:
-            data = wecom_get_json(
-                "https://qyapi.weixin.qq.com/cgi-bin/kf/account/list",
-                "kf",
-                params={"offset": offset, "limit": limit},
-            )
-            for account in data.get("account_list", []):
-                cur.execute(
-                    """
-                    REPLACE INTO kf_account (open_kfid, name, status, ext)
-                    """,
-                    (
-                        account.get("open_kfid"),
+        if not offset and not full:
+            offset = int(sync_state.get_state(cur, "kf", "kf_account").get("sync_cursor") or 0)
+        writer = BulkUpserter(cur).register(
+            "kf_account", ["open_kfid", "name", "status", "ext"], update=["name", "status", "ext"]
+        )
+        flt = ChangeFilter(cur, writer, "kf", "kf_account", full)
+        try:
+            while True:
+                data = wecom_get_json(
+                    "https://qyapi.weixin.qq.com/cgi-bin/kf/account/list",
+                    "kf",
+                    params={"offset": offset, "limit": limit},
+                )
+                accounts = {a["open_kfid"]: a for a in data.get("account_list", []) if a.get("open_kfid")}
+                for kfid in flt.changed(accounts):
+                    account = accounts[kfid]
+                    writer.add("kf_account", (
+                        kfid,
                         account.get("name"),
                         account.get("status"),
-                    ),
-                )
-                up += 1
-            if len(data.get("account_list", [])) < limit:
-                break
-            offset += limit
-    return {"kf_accounts": up}
+                        json.dumps(account, ensure_ascii=False),
+                    ))
+                    flt.mark(kfid)
+                    up += 1
+                writer.flush()
+                if len(data.get("account_list", [])) < limit:
+                    break
+                offset += limit
+                sync_state.save_cursor(cur, "kf", "kf_account", str(offset))
+                sync_state.save_progress(cur, "kf", "kf_account", offset=offset, kf_accounts=up)
+            sync_state.mark_ok(cur, "kf", "kf_account", started)
+        except Exception as e:
+            sync_state.mark_err(cur, "kf", "kf_account", e)
+            raise
+    return {"kf_accounts": up, "kf_accounts_unchanged": flt.skipped}
 
 
-def sync_kf_servicers() -> dict:
+def sync_kf_servicers(full: bool = False) -> dict:
+    """按账号拉接待人员；某账号的接待人员列表未变化则整组跳过，变化时删后重建。"""
     up = 0
+    started = datetime.now()
     with _use_cursor() as cur:
-        cur.execute("SELECT open_kfid FROM kf_account")
-        for row in cur.fetchall():
-            kfid = row["open_kfid"]
-            detail = wecom_get_json(
-                "https://qyapi.weixin.qq.com/cgi-bin/kf/servicer/list",
-                "kf",
-                params={"open_kfid": kfid},
-            )
-            for user in detail.get("servicer_list", []):
-                cur.execute(
-                    """
-                    REPLACE INTO kf_servicer (open_kfid, userid, status)
-                    VALUES (%s, %s, %s)
-                    """,
-                    (kfid, user.get("userid"), 1),
+        cur.execute("SELECT open_kfid FROM kf_account ORDER BY open_kfid")
+        kfids = [row["open_kfid"] for row in cur.fetchall()]
+        writer = BulkUpserter(cur).register(
+            "kf_servicer", ["open_kfid", "userid", "status"], update=["status"]
+        )
+        flt = ChangeFilter(cur, writer, "kf", "kf_servicer", full)
+        try:
+            for i, kfid in enumerate(kfids, 1):
+                if i % 20 == 0:
+                    sync_state.save_progress(cur, "kf", "kf_servicer", done=i, total=len(kfids))
+                detail = wecom_get_json(
+                    "https://qyapi.weixin.qq.com/cgi-bin/kf/servicer/list",
+                    "kf",
+                    params={"open_kfid": kfid},
                 )
-                up += 1
-    return {"kf_servicers": up}
+                servicers = [u for u in detail.get("servicer_list", []) if u.get("userid")]
+                if not flt.changed({kfid: servicers}):
+                    continue
+                # 旧列表的删除与新列表、哈希在同一次 flush 的事务里提交，读方看不到空列表
+                writer.delete("kf_servicer", ["open_kfid"], (kfid,))
+                for user in servicers:
+                    writer.add("kf_servicer", (kfid, user.get("userid"), 1))
+                    up += 1
+                flt.mark(kfid)
+            writer.flush()
+            sync_state.mark_ok(cur, "kf", "kf_servicer", started)
+        except Exception as e:
+            sync_state.mark_err(cur, "kf", "kf_servicer", e)
+            raise
+    return {"kf_servicers": up, "kf_accounts_unchanged_servicers": flt.skipped}
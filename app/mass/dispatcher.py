@@ -0,0 +1,251 @@
+"""Dispatch engine that drains pending mass_target_snapshot rows.
+
+Each ``(task_id, wave_no, batch_no)`` becomes one RQ job on the ``dispatch``
+queue; run workers with ``rq worker dispatch --url $REDIS_URL`` or
+``python -m app.mass.dispatcher``.
+
+A job lost with its worker (killed, job timeout) leaves its rows pending with
+nothing queued for them; ``sweep_stale`` (periodic ``mass.sweep`` sync job)
+re-enqueues such batches for running tasks that have not been enqueued for
+``MASS_SWEEP_STALE_SEC``. Re-enqueued duplicates are harmless: a batch is
+claimed before its pending rows are read.
+"""
+
+from __future__ import annotations
+
+import datetime as dt
+import logging
+import time
+from typing import Any, Dict, List, Tuple
+
+from rq import Queue
+
+from app.common.idempotency import acquire_lock, release_lock
+from app.common.ratelimit import take_tokens
+from app.common.semaphore import Semaphore
+from app.core.config import settings
+from app.core.redis import get_redis
+from app.jobs import queues
+from app.mass import repo, service, stats
+from app.wecom.client import wecom_post_json
+
+log = logging.getLogger(__name__)
+
+QUEUE_NAME = queues.DISPATCH
+SEND_URL = "https://qyapi.weixin.qq.com/cgi-bin/externalcontact/add_msg_template"
+
+_JOB_TIMEOUT_S = 900
+# 认领与任务超时同长：任务还可能在跑时认领不会先过期
+_CLAIM_TTL_S = _JOB_TIMEOUT_S
+_SEM_WAIT_S = 30.0
+_SEM_LEASE_S = 120
+
+
+def _queue() -> Queue:
+    return queues.get_queue(QUEUE_NAME)
+
+
+def _now_str() -> str:
+    return dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _claim_key(task_id: int, wave_no: int, batch_no: int) -> str:
+    return f"mass:claim:{task_id}:{wave_no}:{batch_no}"
+
+
+def enqueue_task(task_id: int) -> int:
+    """Enqueue one job per pending batch, in wave/batch order."""
+    batches = repo.list_pending_batches(task_id)
+    queue = _queue()
+    for wave_no, batch_no in batches:
+        _enqueue_batch(queue, task_id, wave_no, batch_no)
+    repo.update_task(task_id, {"last_enqueue_at": _now_str()})
+    return len(batches)
+
+
+def _enqueue_batch(queue: Queue, task_id: int, wave_no: int, batch_no: int) -> None:
+    queue.enqueue(
+        dispatch_batch,
+        task_id,
+        wave_no,
+        batch_no,
+        job_timeout=_JOB_TIMEOUT_S,
+        result_ttl=3600,
+        description=f"mass:{task_id}:{wave_no}:{batch_no}",
+    )
+
+
+def _acquire_rate(task: Dict[str, Any], permits: int) -> None:
+    """Block until both the task bucket and the global bucket grant ``permits``."""
+    task_qps = max(1, int(task.get("qps_limit") or settings.dispatch_qps_limit))
+    global_qps = max(1, int(settings.dispatch_qps_limit))
+    for key, qps in ((f"mass:rl:task:{task['id']}", task_qps), ("mass:rl:global", global_qps)):
+        remaining = permits
+        while remaining > 0:
+            # 一批可能大于桶容量，按容量分段取，每段一次往返
+            step = min(remaining, qps)
+            granted, wait_ms = take_tokens(key, step, qps, qps)
+            if granted:
+                remaining -= step
+            else:
+                time.sleep(max(wait_ms, 1) / 1000.0)
+
+
+def _semaphores(task: Dict[str, Any]) -> List[Semaphore]:
+    """Per-task cap plus a per-agent cap shared by every task and host on the same app."""
+    task_cap = max(1, int(task.get("concurrency_limit") or settings.global_concurrency))
+    agent_id = task.get("agent_id") or settings.wecom_agent_id or "default"
+    return [
+        Semaphore(f"mass:sem:task:{task['id']}", task_cap, _SEM_LEASE_S),
+        Semaphore(f"wecom:sem:agent:{agent_id}", max(1, settings.agent_concurrency), _SEM_LEASE_S),
+    ]
+
+
+def _acquire_all(sems: List[Semaphore], timeout_s: float) -> List[Tuple[Semaphore, str]] | None:
+    """Take every semaphore in order; on timeout give back what was taken and return None."""
+    deadline = time.monotonic() + timeout_s
+    held: List[Tuple[Semaphore, str]] = []
+    for sem in sems:
+        token = sem.acquire(max(0.0, deadline - time.monotonic()))
+        if token is None:
+            _release_all(held)
+            return None
+        held.append((sem, token))
+    return held
+
+
+def _release_all(held: List[Tuple[Semaphore, str]]) -> None:
+    for sem, token in reversed(held):
+        sem.release(token)
+
+
+def _build_message(task: Dict[str, Any], recipients: List[str]) -> Dict[str, Any]:
+    content = dict(task.get("content_json") or {})
+    # 兼容建单时的简写 {"text": "hello"}
+    if isinstance(content.get("text"), str):
+        content["text"] = {"content": content["text"]}
+    body: Dict[str, Any] = {"chat_type": "single", **content}
+    body["external_userid"] = recipients
+    return body
+
+
+def _send(task: Dict[str, Any], rows: List[Dict[str, Any]]) -> Tuple[List[int], Dict[int, str]]:
+    """Send one batch; returns (sent ids, {failed id: error})."""
+    recipients = [row["recipient_id"] for row in rows]
+    try:
+        data = wecom_post_json(SEND_URL, "ext", body=_build_message(task, recipients))
+    except Exception as exc:
+        error = str(exc)[:255]
+        return [], {row["id"]: error for row in rows}
+    fail_list = set(data.get("fail_list") or [])
+    sent: List[int] = []
+    failed: Dict[int, str] = {}
+    for row in rows:
+        if row["recipient_id"] in fail_list:
+            failed[row["id"]] = "fail_list"
+        else:
+            sent.append(row["id"])
+    return sent, failed
+
+
+def _maybe_finish(task_id: int) -> None:
+    if repo.count_pending(task_id):
+        return
+    task = repo.get_task(task_id)
+    if not task or task["status"] != service.STATUS_RUNNING:
+        return
+    repo.set_task_status(
+        task_id,
+        service.STATUS_FINISHED,
+        {"finished_at": _now_str()},
+    )
+    # 收尾时按快照表精确重算一次，写入 report_stat
+    stats.reconcile(task_id)
+    repo.append_log(task_id, "INFO", "task finished")
+
+
+def dispatch_batch(task_id: int, wave_no: int, batch_no: int) -> Dict[str, Any]:
+    """RQ job: claim one batch, send it under the task/global limits, write results back."""
+    task = repo.get_task(task_id)
+    if not task or task["status"] != service.STATUS_RUNNING:
+        # 暂停/撤回的任务直接跳过，pending 行留给 resume 时重新入队
+        return {"task_id": task_id, "skipped": "not running"}
+
+    claim_key = _claim_key(task_id, wave_no, batch_no)
+    claim = acquire_lock(claim_key, _CLAIM_TTL_S)
+    if claim is None:
+        return {"task_id": task_id, "skipped": "claimed"}
+
+    try:
+        rows = repo.claim_batch(task_id, wave_no, batch_no)
+        if not rows:
+            return {"task_id": task_id, "sent": 0, "failed": 0}
+
+        held = _acquire_all(_semaphores(task), _SEM_WAIT_S)
+        if held is None:
+            release_lock(claim_key, claim)
+            _enqueue_batch(_queue(), task_id, wave_no, batch_no)
+            return {"task_id": task_id, "requeued": True}
+        try:
+            _acquire_rate(task, len(rows))
+            # 限流等待可能很久，发送前续租，避免租约过期被别人顶替
+            for sem, token in held:
+                sem.refresh(token)
+            sent, failed = _send(task, rows)
+        finally:
+            _release_all(held)
+
+        sent_rows, failed_rows = repo.write_back_targets(sent, failed)
+        stats.move(task_id, "pending", "sent", sent_rows)
+        stats.move(task_id, "pending", "failed", failed_rows)
+        if failed:
+            sample = next(iter(failed.values()))
+            repo.append_log(
+                task_id,
+                "WARN",
+                f"wave={wave_no} batch={batch_no} failed={len(failed)} sample={sample}",
+            )
+        log.info(
+            "mass.dispatch_batch done",
+            extra={"task_id": task_id, "wave": wave_no, "batch": batch_no},
+        )
+    finally:
+        release_lock(claim_key, claim)
+
+    stats.checkpoint(task_id)
+    _maybe_finish(task_id)
+    return {"task_id": task_id, "sent": len(sent), "failed": len(failed)}
+
+
+def sweep_stale(stale_s: int | None = None) -> Dict[str, Any]:
+    """Re-enqueue unclaimed pending batches of running tasks not enqueued for ``stale_s``."""
+    stale_s = max(1, int(stale_s or settings.mass_sweep_stale_s))
+    cutoff = (dt.datetime.utcnow() - dt.timedelta(seconds=stale_s)).strftime("%Y-%m-%d %H:%M:%S")
+    r = get_redis()
+    queue = _queue()
+    tasks = requeued = 0
+    for task_id in repo.list_stale_running_tasks(cutoff):
+        batches = [
+            (wave_no, batch_no)
+            for wave_no, batch_no in repo.list_pending_batches(task_id)
+            if not r.exists(_claim_key(task_id, wave_no, batch_no))
+        ]
+        if not batches:
+            # 最后一批的 job 可能在写回之后、收尾之前丢失
+            _maybe_finish(task_id)
+            continue
+        for wave_no, batch_no in batches:
+            _enqueue_batch(queue, task_id, wave_no, batch_no)
+        repo.update_task(task_id, {"last_enqueue_at": _now_str()})
+        repo.append_log(task_id, "WARN", f"re-enqueued {len(batches)} stale batches")
+        tasks += 1
+        requeued += len(batches)
+    return {"tasks": tasks, "batches": requeued}
+
+
+def run_worker() -> None:
+    queues.run_worker([QUEUE_NAME])
+
+
+if __name__ == "__main__":
+    run_worker()
@@ -2,13 +2,19 @@
 
 from __future__ import annotations
 
+import base64
 import json
+import time
 from contextlib import contextmanager
-from typing import Any, Dict, List, Sequence
+from typing import Any, Dict, List, Sequence, Tuple
 
 from pymysql.err import IntegrityError
 
-from app.core.db import get_mysql_conn
+from app.core.config import settings
+from app.core.db import mysql_conn
+
+
+_WRITE_BACK_CHUNK = 1000
 
 
 class DuplicateTaskNoError(Exception):
@@ -17,15 +23,8 @@ class DuplicateTaskNoError(Exception):
 
 @contextmanager
 def _use_cursor():
-    conn = get_mysql_conn()
-    try:
-        with conn.cursor() as cur:
-            yield conn, cur
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+    with mysql_conn() as conn, conn.cursor() as cur:
+        yield conn, cur
 
 
 def _loads_json(value: Any) -> Any:
@@ -142,81 +141,145 @@ def set_task_status(task_id: int, status: int, extra: Dict[str, Any] | None = No
 
 
 def delete_task(task_id: int) -> None:
+    # 快照先分块删完，再删任务本身；中途失败重试即可，不会留下无主的任务行
+    clear_snapshots(task_id)
     with _use_cursor() as (conn, cur):
-        cur.execute("DELETE FROM mass_target_snapshot WHERE task_id=%s", (task_id,))
         cur.execute("DELETE FROM mass_task WHERE id=%s", (task_id,))
         conn.commit()
 
 
-def clear_snapshots(task_id: int) -> None:
+def clear_snapshots(task_id: int, chunk: int | None = None, pause_ms: int | None = None) -> int:
+    """Delete a task's snapshot rows in LIMIT-bounded, separately committed chunks.
+
+    Each chunk holds row locks and undo only for ``chunk`` rows; the pause
+    between chunks lets dispatch writes of other tasks interleave.
+    """
+    chunk = max(1, int(chunk or settings.mass_delete_chunk))
+    pause_s = max(0, settings.mass_delete_pause_ms if pause_ms is None else pause_ms) / 1000.0
+    deleted = 0
     with _use_cursor() as (conn, cur):
-        cur.execute("DELETE FROM mass_target_snapshot WHERE task_id=%s", (task_id,))
-        conn.commit()
+        while True:
+            cur.execute(
+                "DELETE FROM mass_target_snapshot WHERE task_id=%s ORDER BY id LIMIT %s",
+                (task_id, chunk),
+            )
+            affected = int(cur.rowcount or 0)
+            conn.commit()
+            deleted += affected
+            if affected < chunk:
+                break
+            if pause_s:
+                time.sleep(pause_s)
+    return deleted
 
 
-def insert_snapshots(task_id: int, rows: Sequence[Dict[str, Any]]) -> int:
-    if not rows:
-        return 0
-    sql = (
-        """
-        INSERT INTO mass_target_snapshot
-            (task_id, recipient_id, shard_no, wave_no, batch_no, state, created_at, updated_at)
-        VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW())
-        """
-    )
-    values = [
-        (
-            task_id,
-            row["recipient_id"],
-            row.get("shard_no", 0),
-            row.get("wave_no", 1),
-            row.get("batch_no", 1),
-            row.get("state", "pending"),
-        )
-        for row in rows
-    ]
-    with _use_cursor() as (conn, cur):
-        cur.executemany(sql, values)
-        inserted = cur.rowcount
-        conn.commit()
-        return int(inserted)
+def encode_after_id(last_id: int) -> str:
+    """Opaque keyset cursor for the ``id`` ordering."""
+    return base64.urlsafe_b64encode(f"id:{int(last_id)}".encode()).decode().rstrip("=")
 
 
-def page_snapshots(task_id: int, state: str | None, page: int, size: int) -> Dict[str, Any]:
+def decode_after_id(token: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        prefix, value = raw.split(":", 1)
+        if prefix != "id":
+            raise ValueError(raw)
+        return int(value)
+    except Exception as exc:
+        raise ValueError(f"invalid after_id: {token}") from exc
+
+
+def _page_window(
+    where: List[str],
+    args: List[Any],
+    page: int,
+    size: int,
+    after_id: int | None,
+    descending: bool,
+) -> Tuple[str, List[Any]]:
+    """Build ``ORDER BY ... LIMIT`` for keyset (``after_id``) or legacy OFFSET paging.
+
+    One extra row is fetched to tell whether a next page exists.
+    """
+    if after_id is not None:
+        where.append("id < %s" if descending else "id > %s")
+        args.append(after_id)
+        tail = "LIMIT %s"
+        tail_args = [size + 1]
+    else:
+        tail = "LIMIT %s OFFSET %s"
+        tail_args = [size + 1, (page - 1) * size]
+    order = "ORDER BY id DESC" if descending else "ORDER BY id"
+    return f"{order} {tail}", tail_args
+
+
+def _next_after(rows: List[Dict[str, Any]], size: int) -> str | None:
+    if len(rows) <= size:
+        return None
+    del rows[size:]
+    return encode_after_id(rows[-1]["id"])
+
+
+def page_snapshots(
+    task_id: int,
+    state: str | None,
+    page: int,
+    size: int,
+    after_id: int | None = None,
+    with_total: bool = True,
+    total: int | None = None,
+) -> Dict[str, Any]:
+    """Page snapshot rows by id. ``total`` may be supplied by the caller (e.g. from
+    cached task stats) to skip the COUNT; ``with_total=False`` skips it altogether."""
     where = ["task_id=%s"]
     args: List[Any] = [task_id]
     if state:
         where.append("state=%s")
         args.append(state)
-    where_clause = " AND ".join(where)
-    offset = (page - 1) * size
     with _use_cursor() as (_, cur):
-        cur.execute(
-            f"SELECT COUNT(*) AS cnt FROM mass_target_snapshot WHERE {where_clause}",
-            tuple(args),
-        )
-        total = int(cur.fetchone()["cnt"])
+        if with_total and total is None:
+            cur.execute(
+                f"SELECT COUNT(*) AS cnt FROM mass_target_snapshot WHERE {' AND '.join(where)}",
+                tuple(args),
+            )
+            total = int(cur.fetchone()["cnt"])
+        window, window_args = _page_window(where, args, page, size, after_id, descending=False)
         cur.execute(
             f"""
-            SELECT recipient_id, state, wave_no, batch_no, last_error, created_at, updated_at
+            SELECT id, recipient_id, state, wave_no, batch_no, last_error, created_at, updated_at
             FROM mass_target_snapshot
-            WHERE {where_clause}
-            ORDER BY id
-            LIMIT %s OFFSET %s
+            WHERE {' AND '.join(where)}
+            {window}
             """,
-            tuple(args + [size, offset]),
+            tuple(args + window_args),
         )
-        items = cur.fetchall()
+        items = list(cur.fetchall())
+    next_after_id = _next_after(items, size)
     serialized = []
     for row in items:
         item = dict(row)
+        item.pop("id", None)
         for key in ("created_at", "updated_at"):
             item[key] = _format_dt(item.get(key))
         serialized.append(item)
-    return {"page": page, "size": size, "total": total, "items": serialized}
-
-
-def list_logs(task_id: int, level: str | None, keyword: str | None, page: int, size: int) -> Dict[str, Any]:
+    return {
+        "page": page,
+        "size": size,
+        "total": total if with_total else None,
+        "items": serialized,
+        "next_after_id": next_after_id,
+    }
+
+
+def list_logs(
+    task_id: int,
+    level: str | None,
+    keyword: str | None,
+    page: int,
+    size: int,
+    after_id: int | None = None,
+    with_total: bool = True,
+) -> Dict[str, Any]:
     where = ["task_id=%s"]
     args: List[Any] = [task_id]
     if level:
@@ -225,37 +288,40 @@ def list_logs(task_id: int, level: str | None, keyword: str | None, page: int, s
     if keyword:
         where.append("message LIKE %s")
         args.append(f"%{keyword}%")
-    where_clause = " AND ".join(where)
-    offset = (page - 1) * size
+    total = None
     with _use_cursor() as (_, cur):
-        cur.execute(
-            f"SELECT COUNT(*) AS cnt FROM mass_task_log WHERE {where_clause}",
-            tuple(args),
-        )
-        total = int(cur.fetchone()["cnt"])
+        if with_total:
+            cur.execute(
+                f"SELECT COUNT(*) AS cnt FROM mass_task_log WHERE {' AND '.join(where)}",
+                tuple(args),
+            )
+            total = int(cur.fetchone()["cnt"])
+        window, window_args = _page_window(where, args, page, size, after_id, descending=True)
         cur.execute(
             f"""
-            SELECT created_at, level, message
+            SELECT id, created_at, level, message
             FROM mass_task_log
-            WHERE {where_clause}
-            ORDER BY id DESC
-            LIMIT %s OFFSET %s
+            WHERE {' AND '.join(where)}
+            {window}
             """,
-            tuple(args + [size, offset]),
+            tuple(args + window_args),
         )
-        rows = cur.fetchall()
+        rows = list(cur.fetchall())
+    next_after_id = _next_after(rows, size)
     serialized = []
     for row in rows:
         item = dict(row)
+        item.pop("id", None)
         item["created_at"] = _format_dt(item.get("created_at"))
         serialized.append(item)
-    return {"page": page, "size": size, "total": total, "items": serialized}
+    return {"page": page, "size": size, "total": total, "items": serialized, "next_after_id": next_after_id}
 
 
 def page_tasks(params: Dict[str, Any]) -> Dict[str, Any]:
     page = params.get("page", 1)
     size = params.get("size", 20)
-    offset = (page - 1) * size
+    after_id = params.get("after_id")
+    with_total = params.get("with_total", True)
     where: List[str] = ["1=1"]
     args: List[Any] = []
     status = params.get("status")
@@ -277,28 +343,30 @@ def page_tasks(params: Dict[str, Any]) -> Dict[str, Any]:
     if date_to:
         where.append("created_at <= %s")
         args.append(date_to)
-    where_clause = " AND ".join(where)
+    total = None
     with _use_cursor() as (_, cur):
-        cur.execute(
-            f"SELECT COUNT(*) AS cnt FROM mass_task WHERE {where_clause}",
-            tuple(args),
-        )
-        total = int(cur.fetchone()["cnt"])
+        if with_total:
+            cur.execute(
+                f"SELECT COUNT(*) AS cnt FROM mass_task WHERE {' AND '.join(where)}",
+                tuple(args),
+            )
+            total = int(cur.fetchone()["cnt"])
+        window, window_args = _page_window(where, args, page, size, after_id, descending=True)
         cur.execute(
             f"""
             SELECT id, task_no, name, mass_type, content_type, status, scheduled_at,
                    qps_limit, concurrency_limit, batch_size, gray_strategy,
                    report_stat, agent_id, created_at, updated_at
             FROM mass_task
-            WHERE {where_clause}
-            ORDER BY id DESC
-            LIMIT %s OFFSET %s
+            WHERE {' AND '.join(where)}
+            {window}
             """,
-            tuple(args + [size, offset]),
+            tuple(args + window_args),
         )
-        rows = cur.fetchall()
+        rows = list(cur.fetchall())
+    next_after_id = _next_after(rows, size)
     items = [_normalize_task(row) for row in rows]
-    return {"page": page, "size": size, "total": total, "items": items}
+    return {"page": page, "size": size, "total": total, "items": items, "next_after_id": next_after_id}
 
 
 def recall_pending_targets(task_id: int) -> int:
@@ -331,6 +399,115 @@ def reset_failed_targets(task_id: int) -> int:
         return int(affected)
 
 
+def list_pending_batches(task_id: int) -> List[Tuple[int, int]]:
+    with _use_cursor() as (_, cur):
+        cur.execute(
+            """
+            SELECT wave_no, batch_no
+            FROM mass_target_snapshot
+            WHERE task_id=%s AND state='pending'
+            GROUP BY wave_no, batch_no
+            ORDER BY wave_no, batch_no
+            """,
+            (task_id,),
+        )
+        rows = cur.fetchall()
+    return [(int(row["wave_no"]), int(row["batch_no"])) for row in rows]
+
+
+def list_stale_running_tasks(enqueued_before: str) -> List[int]:
+    """Running tasks whose batches were last enqueued before ``enqueued_before`` (UTC)."""
+    with _use_cursor() as (_, cur):
+        cur.execute(
+            """
+            SELECT id FROM mass_task
+            WHERE status=2 -- RUNNING
+              AND (last_enqueue_at IS NULL OR last_enqueue_at < %s)
+            """,
+            (enqueued_before,),
+        )
+        return [int(row["id"]) for row in cur.fetchall()]
+
+
+def claim_batch(task_id: int, wave_no: int, batch_no: int) -> List[Dict[str, Any]]:
+    with _use_cursor() as (_, cur):
+        cur.execute(
+            """
+            SELECT id, recipient_id
+            FROM mass_target_snapshot
+            WHERE task_id=%s AND wave_no=%s AND batch_no=%s AND state='pending'
+            ORDER BY id
+            """,
+            (task_id, wave_no, batch_no),
+        )
+        return list(cur.fetchall())
+
+
+def write_back_targets(sent_ids: Sequence[int], failed: Dict[int, str]) -> Tuple[int, int]:
+    """Bulk-apply dispatch results; failed rows are grouped by error text.
+
+    Returns ``(rows moved to sent, rows moved to failed)``; rows no longer
+    pending (e.g. recalled meanwhile) are not counted.
+    """
+    if not sent_ids and not failed:
+        return 0, 0
+    by_error: Dict[str, List[int]] = {}
+    for target_id, error in failed.items():
+        by_error.setdefault((error or "")[:255], []).append(target_id)
+    sent_rows = failed_rows = 0
+    with _use_cursor() as (conn, cur):
+        conn.begin()
+        try:
+            for start in range(0, len(sent_ids), _WRITE_BACK_CHUNK):
+                chunk = list(sent_ids[start : start + _WRITE_BACK_CHUNK])
+                placeholders = ",".join(["%s"] * len(chunk))
+                cur.execute(
+                    f"""
+                    UPDATE mass_target_snapshot
+                    SET state='sent', last_error=NULL, updated_at=NOW()
+                    WHERE id IN ({placeholders}) AND state='pending'
+                    """,
+                    tuple(chunk),
+                )
+                sent_rows += cur.rowcount
+            for error, ids in by_error.items():
+                for start in range(0, len(ids), _WRITE_BACK_CHUNK):
+                    chunk = ids[start : start + _WRITE_BACK_CHUNK]
+                    placeholders = ",".join(["%s"] * len(chunk))
+                    cur.execute(
+                        f"""
+                        UPDATE mass_target_snapshot
+                        SET state='failed', last_error=%s, updated_at=NOW()
+                        WHERE id IN ({placeholders}) AND state='pending'
+                        """,
+                        tuple([error or None] + chunk),
+                    )
+                    failed_rows += cur.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return int(sent_rows), int(failed_rows)
+
+
+def count_pending(task_id: int) -> int:
+    with _use_cursor() as (_, cur):
+        cur.execute(
+            "SELECT COUNT(*) AS cnt FROM mass_target_snapshot WHERE task_id=%s AND state='pending'",
+            (task_id,),
+        )
+        return int(cur.fetchone()["cnt"])
+
+
+def append_log(task_id: int, level: str, message: str) -> None:
+    with _use_cursor() as (conn, cur):
+        cur.execute(
+            "INSERT INTO mass_task_log (task_id, level, message) VALUES (%s, %s, %s)",
+            (task_id, level, message),
+        )
+        conn.commit()
+
+
 def aggregate_task_stats(task_id: int) -> Dict[str, Any]:
     with _use_cursor() as (_, cur):
         cur.execute(
@@ -348,27 +525,121 @@ def aggregate_task_stats(task_id: int) -> Dict[str, Any]:
     return {"task_id": task_id, "total": total, **stats}
 
 
-def pick_all_contacts(limit: int) -> List[str]:
-    with _use_cursor() as (_, cur):
-        cur.execute("SELECT external_userid FROM ext_contact LIMIT %s", (limit,))
-        rows = cur.fetchall()
-    return [row["external_userid"] for row in rows]
+def _audience_source(
+    mode: str, tag_ids: Sequence[str], limit: int, after: str | None = None
+) -> Tuple[str, List[Any]]:
+    """Return ``(sql, args)`` selecting the ordered, limited audience as column ``rid``.
 
+    ``after`` is a keyset bound: only recipients sorting after it are selected.
+    """
+    after_sql = " AND external_userid > %s" if after is not None else ""
+    after_args: List[Any] = [after] if after is not None else []
+    if mode == "all_contacts":
+        return (
+            f"""
+            SELECT external_userid AS rid
+            FROM ext_contact
+            WHERE 1=1{after_sql}
+            ORDER BY external_userid
+            LIMIT %s
+            """,
+            [*after_args, limit],
+        )
+    if mode == "by_tag_ids":
+        placeholders = ",".join(["%s"] * len(tag_ids))
+        return (
+            f"""
+            SELECT DISTINCT external_userid AS rid
+            FROM ext_contact_tag
+            WHERE tag_id IN ({placeholders}){after_sql}
+            ORDER BY external_userid
+            LIMIT %s
+            """,
+            [*tag_ids, *after_args, limit],
+        )
+    raise ValueError(f"unsupported audience mode: {mode}")
 
-def pick_by_tag_ids(tag_ids: Sequence[str], limit: int) -> List[str]:
-    if not tag_ids:
-        return []
-    placeholders = ",".join(["%s"] * len(tag_ids))
-    sql = (
-        """
-        SELECT DISTINCT external_userid
-        FROM ext_contact_tag
-        WHERE tag_id IN ("""
-        + placeholders
-        + ") LIMIT %s"
-    )
-    args: List[Any] = list(tag_ids) + [limit]
+
+def count_audience(mode: str, tag_ids: Sequence[str], limit: int) -> int:
+    if mode == "by_tag_ids" and not tag_ids:
+        return 0
+    src, args = _audience_source(mode, tag_ids, limit)
     with _use_cursor() as (_, cur):
-        cur.execute(sql, tuple(args))
-        rows = cur.fetchall()
-    return [row["external_userid"] for row in rows]
+        cur.execute(f"SELECT COUNT(*) AS n FROM ({src}) s", tuple(args))
+        row = cur.fetchone() or {}
+    return int(row.get("n") or 0)
+
+
+def plan_snapshots(
+    task_id: int,
+    mode: str,
+    tag_ids: Sequence[str],
+    limit: int,
+    wave_sizes: Sequence[int],
+    batch_size: int,
+) -> int:
+    """Replace the task's snapshot: chunked clear, then keyset-chunked ``INSERT ... SELECT``.
+
+    Recipients are numbered with ``ROW_NUMBER()`` in recipient order, offset by
+    the rows already planned; the wave is picked from the cumulative
+    ``wave_sizes`` bounds and the batch number is the offset inside the wave
+    divided by ``batch_size``. Each chunk of ``mass_plan_chunk`` recipients is
+    its own committed statement, so no single insert holds locks and undo for
+    the whole audience, and no recipient id ever leaves MySQL.
+    """
+    bounds: List[Tuple[int, int, int]] = []  # (wave_no, wave_start, wave_end)
+    acc = 0
+    for wave_no, size in enumerate(wave_sizes, start=1):
+        if size > 0:
+            bounds.append((wave_no, acc, acc + size))
+            acc += size
+    # 旧快照先分块清掉，避免重新规划大任务时一条 DELETE 长时间锁表
+    clear_snapshots(task_id)
+    if not bounds:
+        return 0
+
+    # 最后一波兜底（ELSE）：COUNT 与 INSERT 之间新增的客户落到最后一波，不会丢行
+    wave_case = " ".join("WHEN w.rn <= %s THEN %s" for _ in bounds[:-1])
+    start_case = " ".join("WHEN w.rn <= %s THEN %s" for _ in bounds[:-1])
+    wave_args: List[Any] = [v for wave_no, _, end in bounds[:-1] for v in (end, wave_no)]
+    start_args: List[Any] = [v for _, start, end in bounds[:-1] for v in (end, start)]
+    last_wave, last_start, _ = bounds[-1]
+    head_args = [task_id, max(1, int(batch_size)), *wave_args, last_wave, *start_args, last_start]
+    chunk = max(1, int(settings.mass_plan_chunk))
+
+    inserted = 0
+    after: str | None = None
+    with _use_cursor() as (conn, cur):
+        while inserted < limit:
+            src, src_args = _audience_source(mode, tag_ids, min(chunk, limit - inserted), after)
+            cur.execute(
+                f"""
+                INSERT INTO mass_target_snapshot
+                    (task_id, recipient_id, shard_no, wave_no, batch_no, state, created_at, updated_at)
+                SELECT %s, p.rid, 0, p.wave_no, FLOOR((p.rn - p.wave_start - 1) / %s) + 1, 'pending', NOW(), NOW()
+                FROM (
+                    SELECT w.rid, w.rn,
+                           CASE {wave_case} ELSE %s END AS wave_no,
+                           CASE {start_case} ELSE %s END AS wave_start
+                    FROM (
+                        SELECT s.rid, %s + ROW_NUMBER() OVER (ORDER BY s.rid) AS rn
+                        FROM ({src}) s
+                    ) w
+                ) p
+                """,
+                tuple([*head_args, inserted, *src_args]),
+            )
+            affected = int(cur.rowcount or 0)
+            conn.commit()
+            if not affected:
+                break
+            inserted += affected
+            # 本块按 recipient 升序写入，最大 recipient_id 即下一块的 keyset 起点
+            cur.execute(
+                "SELECT MAX(recipient_id) AS last_rid FROM mass_target_snapshot WHERE task_id=%s",
+                (task_id,),
+            )
+            after = (cur.fetchone() or {}).get("last_rid")
+            if after is None:
+                break
+    return inserted
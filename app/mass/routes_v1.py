@@ -103,7 +103,9 @@ def list_targets(task_id: int):
         page = int(request.args.get("page", 1))
         size = int(request.args.get("size", 20))
         state = request.args.get("state") or None
-        data = service.list_targets(task_id, state, page, size)
+        after_id = request.args.get("after_id") or None
+        with_total = service.parse_flag(request.args.get("with_total"), default=after_id is None)
+        data = service.list_targets(task_id, state, page, size, after_id, with_total)
         return _response(True, data)
     except Exception as exc:
         return _handle_error(exc)
@@ -116,7 +118,9 @@ def list_logs(task_id: int):
         size = int(request.args.get("size", 20))
         level = request.args.get("level") or None
         keyword = request.args.get("q") or None
-        data = service.list_logs(task_id, level, keyword, page, size)
+        after_id = request.args.get("after_id") or None
+        with_total = service.parse_flag(request.args.get("with_total"), default=after_id is None)
+        data = service.list_logs(task_id, level, keyword, page, size, after_id, with_total)
         return _response(True, data)
     except Exception as exc:
         return _handle_error(exc)
@@ -5,7 +5,7 @@ from __future__ import annotations
 import datetime as dt
 from typing import Any, Dict, List
 
-from app.mass import repo
+from app.mass import dispatcher, planner, repo, stats
 
 
 class ConflictError(RuntimeError):
@@ -80,10 +80,30 @@ def create_task(body: Dict[str, Any]) -> int:
         raise ConflictError("task_no already exists") from exc
 
 
+def _decode_after_id(token: str | None) -> int | None:
+    if not token:
+        return None
+    try:
+        return repo.decode_after_id(token)
+    except ValueError as exc:
+        raise ValidationError(str(exc)) from exc
+
+
+def parse_flag(value: Any, default: bool) -> bool:
+    if value is None or value == "":
+        return default
+    return str(value).strip().lower() in ("1", "true", "yes")
+
+
 def list_tasks(params: Dict[str, Any]) -> Dict[str, Any]:
     page = int(params.get("page", 1))
     size = int(params.get("size", 20))
-    result = repo.page_tasks({**params, "page": page, "size": size})
+    after_id = _decode_after_id(params.get("after_id"))
+    # 游标翻页默认不数总数；传 with_total=1 时才 COUNT
+    with_total = parse_flag(params.get("with_total"), default=after_id is None)
+    result = repo.page_tasks(
+        {**params, "page": page, "size": size, "after_id": after_id, "with_total": with_total}
+    )
     result["items"] = [_annotate_status(it) for it in result.get("items", [])]
     return result
 
@@ -116,6 +136,7 @@ def update_task(task_id: int, patch: Dict[str, Any]) -> None:
 def delete_task(task_id: int) -> None:
     _ensure_task(task_id)
     repo.delete_task(task_id)
+    stats.drop(task_id)
 
 
 def plan_task(task_id: int) -> Dict[str, Any]:
@@ -126,55 +147,22 @@ def plan_task(task_id: int) -> Dict[str, Any]:
     spec = task.get("targets_spec") or {}
     mode = spec.get("mode", "all_contacts")
     limit = int(spec.get("limit") or 50000)
-
-    if mode == "all_contacts":
-        recipients = repo.pick_all_contacts(limit)
-    elif mode == "by_tag_ids":
-        recipients = repo.pick_by_tag_ids(spec.get("tag_ids") or [], limit)
-    else:
+    if mode not in ("all_contacts", "by_tag_ids"):
         raise ValidationError(f"unsupported targets_spec mode: {mode}")
+    tag_ids = spec.get("tag_ids") or []
 
-    if not recipients:
+    total = repo.count_audience(mode, tag_ids, limit)
+    if not total:
         raise ValidationError("no recipients selected")
 
     batch_size = int(task.get("batch_size") or 300)
-    gray_strategy = task.get("gray_strategy") or _default_gray_strategy(len(recipients))
-    waves = gray_strategy.get("waves") or _default_gray_strategy(len(recipients))["waves"]
-
-    counts: List[int] = []
-    total = len(recipients)
-    remain = total
-    for idx, wave in enumerate(waves, start=1):
-        pct = float(wave.get("pct", 0))
-        cnt = int(round(total * pct / 100.0)) if idx < len(waves) else remain
-        cnt = max(cnt, 0)
-        counts.append(cnt)
-        remain -= cnt
-    if remain:
-        counts[-1] += remain
-
-    snapshots = []
-    offset = 0
-    for wave_no, count in enumerate(counts, start=1):
-        if count <= 0:
-            continue
-        chunk = recipients[offset : offset + count]
-        offset += count
-        batches = (len(chunk) + batch_size - 1) // batch_size
-        for batch_no in range(1, batches + 1):
-            batch_slice = chunk[(batch_no - 1) * batch_size : batch_no * batch_size]
-            snapshots.extend(
-                {
-                    "recipient_id": rid,
-                    "wave_no": wave_no,
-                    "batch_no": batch_no,
-                    "state": "pending",
-                }
-                for rid in batch_slice
-            )
-
-    repo.clear_snapshots(task_id)
-    inserted = repo.insert_snapshots(task_id, snapshots)
+    gray_strategy = task.get("gray_strategy") or _default_gray_strategy(total)
+    waves = gray_strategy.get("waves") or _default_gray_strategy(total)["waves"]
+    counts = planner._allocate_waves(total, {"waves": waves})
+
+    # 快照在 MySQL 内一次 INSERT ... SELECT 生成，收件人不进 Python 内存
+    inserted = repo.plan_snapshots(task_id, mode, tag_ids, limit, counts, batch_size)
+    stats.reset(task_id, {"total": inserted, "pending": inserted})
     repo.set_task_status(task_id, STATUS_PLANNED)
 
     plan = {
@@ -191,19 +179,55 @@ def plan_task(task_id: int) -> Dict[str, Any]:
     return plan
 
 
-def list_targets(task_id: int, state: str | None, page: int, size: int) -> Dict[str, Any]:
+def list_targets(
+    task_id: int,
+    state: str | None,
+    page: int,
+    size: int,
+    after_id: str | None = None,
+    with_total: bool | None = None,
+) -> Dict[str, Any]:
+    task = _ensure_task(task_id)
+    after = _decode_after_id(after_id)
+    if with_total is None:
+        with_total = after is None
+    total = None
+    stat = task.get("report_stat") or {}
+    if with_total and task["status"] in (STATUS_FINISHED, STATUS_RECALLED) and "total" in stat:
+        # 已结束任务的各状态计数已固化在 report_stat，不必再 COUNT 百万行
+        total = int(stat.get(state or "total") or 0)
+    return repo.page_snapshots(task_id, state, page, size, after, with_total, total)
+
+
+def list_logs(
+    task_id: int,
+    level: str | None,
+    keyword: str | None,
+    page: int,
+    size: int,
+    after_id: str | None = None,
+    with_total: bool | None = None,
+) -> Dict[str, Any]:
     _ensure_task(task_id)
-    return repo.page_snapshots(task_id, state, page, size)
+    after = _decode_after_id(after_id)
+    if with_total is None:
+        with_total = after is None
+    return repo.list_logs(task_id, level, keyword, page, size, after, with_total)
 
 
-def list_logs(task_id: int, level: str | None, keyword: str | None, page: int, size: int) -> Dict[str, Any]:
+def retry_failed(task_id: int) -> int:
     _ensure_task(task_id)
-    return repo.list_logs(task_id, level, keyword, page, size)
+    reset = repo.reset_failed_targets(task_id)
+    stats.move(task_id, "failed", "pending", reset)
+    return reset
 
 
-def retry_failed(task_id: int) -> int:
-    _ensure_task(task_id)
-    return repo.reset_failed_targets(task_id)
+def _enqueue_or_revert(task_id: int, previous_status: int) -> None:
+    try:
+        dispatcher.enqueue_task(task_id)
+    except Exception:
+        repo.set_task_status(task_id, previous_status)
+        raise
 
 
 def start_task(task_id: int) -> Dict[str, Any]:
@@ -215,6 +239,7 @@ def start_task(task_id: int) -> Dict[str, Any]:
         STATUS_RUNNING,
         {"started_at": dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")},
     )
+    _enqueue_or_revert(task_id, task["status"])
     return get_task(task_id)
 
 
@@ -230,6 +255,7 @@ def resume_task(task_id: int) -> None:
     if task["status"] != STATUS_PAUSED:
         raise ValidationError("task not paused")
     repo.set_task_status(task_id, STATUS_RUNNING)
+    _enqueue_or_revert(task_id, STATUS_PAUSED)
 
 
 def recall_task(task_id: int) -> int:
@@ -242,9 +268,10 @@ def recall_task(task_id: int) -> int:
         STATUS_RECALLED,
         {"finished_at": dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")},
     )
+    stats.reconcile(task_id)
     return affected
 
 
 def stats_task(task_id: int) -> Dict[str, Any]:
     _ensure_task(task_id)
-    return repo.aggregate_task_stats(task_id)
+    return stats.get_stats(task_id)
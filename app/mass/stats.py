@@ -0,0 +1,121 @@
+"""Per-task state counters for mass_target_snapshot.
+
+Counters live in the Redis hash ``mass:stat:{task_id}`` and are bumped with
+HINCRBY as rows change state, so ``/stats`` is one HGETALL regardless of
+audience size. ``reconcile`` rewrites them from the snapshot table (the
+source of truth) and ``flush`` copies them into ``mass_task.report_stat``;
+dispatch jobs call ``checkpoint`` after each batch to run both on a timer.
+"""
+
+from __future__ import annotations
+
+import logging
+from typing import Any, Dict, Mapping
+
+from redis.exceptions import RedisError
+
+from app.common.idempotency import try_mark_once
+from app.core.config import settings
+from app.core.redis import get_redis
+from app.mass import repo
+
+log = logging.getLogger(__name__)
+
+STATES = ("pending", "sent", "failed", "recalled")
+_KEY_TTL_S = 7 * 86400
+
+
+def _key(task_id: int) -> str:
+    return f"mass:stat:{task_id}"
+
+
+def _format(task_id: int, raw: Mapping[str, Any]) -> Dict[str, Any]:
+    counts = {state: max(0, int(raw.get(state) or 0)) for state in STATES}
+    return {"task_id": task_id, "total": int(raw.get("total") or 0), **counts}
+
+
+def reset(task_id: int, counts: Mapping[str, int]) -> None:
+    """Overwrite the counters, e.g. right after planning."""
+    fields = {state: int(counts.get(state) or 0) for state in STATES}
+    fields["total"] = int(counts.get("total") or sum(fields.values()))
+    try:
+        pipe = get_redis().pipeline(transaction=True)
+        pipe.delete(_key(task_id))
+        pipe.hset(_key(task_id), mapping=fields)
+        pipe.expire(_key(task_id), _KEY_TTL_S)
+        pipe.execute()
+    except RedisError as exc:
+        log.warning("mass.stats reset failed task_id=%s err=%s", task_id, exc)
+
+
+def move(task_id: int, src: str, dst: str, n: int) -> None:
+    """Atomically shift ``n`` rows from state ``src`` to ``dst``."""
+    if n <= 0:
+        return
+    try:
+        pipe = get_redis().pipeline(transaction=True)
+        pipe.hincrby(_key(task_id), src, -n)
+        pipe.hincrby(_key(task_id), dst, n)
+        pipe.expire(_key(task_id), _KEY_TTL_S)
+        pipe.execute()
+    except RedisError as exc:
+        # 计数漂移由下一次 reconcile 纠正，不影响派发主流程
+        log.warning("mass.stats move failed task_id=%s err=%s", task_id, exc)
+
+
+def drop(task_id: int) -> None:
+    try:
+        get_redis().delete(_key(task_id))
+    except RedisError:
+        pass
+
+
+def read(task_id: int) -> Dict[str, Any] | None:
+    raw = get_redis().hgetall(_key(task_id))
+    return _format(task_id, raw) if raw else None
+
+
+def reconcile(task_id: int) -> Dict[str, Any]:
+    """Recount from the snapshot table, overwrite the counters and report_stat.
+
+    Moves that land between the GROUP BY and the overwrite are lost from the
+    counters until the next reconcile; the table stays authoritative.
+    """
+    stats = repo.aggregate_task_stats(task_id)
+    reset(task_id, stats)
+    stats = _format(task_id, stats)
+    repo.update_task(task_id, {"report_stat": stats})
+    return stats
+
+
+def flush(task_id: int) -> Dict[str, Any] | None:
+    """Copy the live counters into ``mass_task.report_stat``."""
+    try:
+        stats = read(task_id)
+    except RedisError as exc:
+        log.warning("mass.stats flush failed task_id=%s err=%s", task_id, exc)
+        return None
+    if stats is not None:
+        repo.update_task(task_id, {"report_stat": stats})
+    return stats
+
+
+def checkpoint(task_id: int) -> None:
+    """Reconcile every MASS_STAT_RECONCILE_S, otherwise flush every MASS_STAT_FLUSH_S."""
+    try:
+        if try_mark_once(f"mass:stat:reconcile:{task_id}", settings.mass_stat_reconcile_s):
+            reconcile(task_id)
+        elif try_mark_once(f"mass:stat:flush:{task_id}", settings.mass_stat_flush_s):
+            flush(task_id)
+    except RedisError as exc:
+        log.warning("mass.stats checkpoint skipped task_id=%s err=%s", task_id, exc)
+
+
+def get_stats(task_id: int) -> Dict[str, Any]:
+    """O(1) read; falls back to a reconcile when the counters are missing."""
+    try:
+        stats = read(task_id)
+    except RedisError as exc:
+        log.warning("mass.stats read failed task_id=%s err=%s", task_id, exc)
+        return repo.aggregate_task_stats(task_id)
+    return stats if stats is not None else reconcile(task_id)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+手机号名单上传：流式解析 + 分块入库 + 入库时即时统计匹配数。
+- 逐行增量解码 CSV，纯数字单元格走快速路径，其余用预编译正则提取数字
+- 每块先查本次上传已有的号码，只插入新号码（多行 INSERT IGNORE），再按索引查会员宽表统计新号码的命中数；
+  会员数据源是视图时不逐块查（每次都要整体求值视图），入库完后与明细表一次 JOIN 统计；
+  整个上传在一个事务里提交，total/valid 与明细表严格一致
+- 大文件（超过 MEDIA_UPLOAD_ASYNC_BYTES）落到 MEDIA_UPLOAD_DIR 后交给 RQ 后台任务，进度写 Redis 哈希 media:upload:{id}；
+  web 与 media worker 不在同一台机器时，MEDIA_UPLOAD_DIR 必须是两边都挂载的共享目录
+后台 worker：python -m app.media.service
+"""
+import csv
+import io
+import logging
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List
+
+from rq import Queue
+
+from app.core.db import mysql_conn
+from app.core.redis import get_redis
+from app.jobs import queues
+from app.members import profile
+
+log = logging.getLogger(__name__)
+
+QUEUE_NAME = queues.MEDIA
+ASYNC_BYTES = int(os.getenv("MEDIA_UPLOAD_ASYNC_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_DIR = os.getenv("MEDIA_UPLOAD_DIR", tempfile.gettempdir())
+
+_CHUNK = 5000
+_PROGRESS_TTL_S = 7 * 86400
+_NON_DIGIT = re.compile(r"\D+")
+
+
+def normalize_mobile(s: str) -> str:
+    if not s:
+        return ""
+    if not s.isdigit():
+        s = _NON_DIGIT.sub("", s)
+    if len(s) > 11 and s.startswith("86"):
+        s = s[2:]
+    return s if len(s) == 11 else ""
+
+
+def iter_mobiles(stream) -> Iterator[str]:
+    """二进制流逐行解码；每个单元格都尝试提取手机号。"""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="ignore", newline="")
+    for row in csv.reader(text):
+        for col in row:
+            m = normalize_mobile(col.strip())
+            if m:
+                yield m
+
+
+def _chunks(items: Iterable[str], size: int) -> Iterator[List[str]]:
+    buf = {}
+    for m in items:
+        buf[m] = None
+        if len(buf) >= size:
+            yield list(buf)
+            buf = {}
+    if buf:
+        yield list(buf)
+
+
+# -------------------------
+# 进度
+# -------------------------
+def _progress_key(upload_id: int) -> str:
+    return f"media:upload:{upload_id}"
+
+
+def _progress(upload_id: int, **fields):
+    try:
+        r = get_redis()
+        r.hset(_progress_key(upload_id), mapping={k: v for k, v in fields.items() if v is not None})
+        r.expire(_progress_key(upload_id), _PROGRESS_TTL_S)
+    except Exception as e:
+        log.warning("media upload progress write failed id=%s err=%s", upload_id, e)
+
+
+def get_progress(upload_id: int) -> dict | None:
+    raw = get_redis().hgetall(_progress_key(upload_id))
+    if raw:
+        out = {k: (int(v) if k in ("rows", "total", "valid", "invalid") else v) for k, v in raw.items()}
+        return {"upload_id": upload_id, **out}
+    with mysql_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT total, valid, invalid FROM wecom_ops.mobile_upload WHERE id=%s", (upload_id,))
+        row = cur.fetchone()
+    if not row:
+        return None
+    return {"upload_id": upload_id, "status": "done", **{k: int(row[k] or 0) for k in ("total", "valid", "invalid")}}
+
+
+# -------------------------
+# 入库
+# -------------------------
+def create_upload(up_type: str, filename: str) -> int:
+    with mysql_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO wecom_ops.mobile_upload(type, filename, total, valid, invalid) VALUES(%s,%s,0,0,0)",
+            (up_type, filename),
+        )
+        return int(cur.lastrowid)
+
+
+def _ingest_chunk(cur, upload_id: int, chunk: List[str], count: bool = True) -> tuple[int, int]:
+    """返回 (新号码数, 其中命中会员的数量)；count=False 时不统计，命中数恒为 0。"""
+    placeholders = ",".join(["%s"] * len(chunk))
+    cur.execute(
+        f"SELECT mobile_std FROM wecom_ops.mobile_upload_item WHERE upload_id=%s AND mobile_std IN ({placeholders})",
+        [upload_id, *chunk],
+    )
+    seen = {r["mobile_std"] for r in cur.fetchall()}
+    new = [m for m in chunk if m not in seen]
+    if not new:
+        return 0, 0
+    cur.executemany(
+        "INSERT IGNORE INTO wecom_ops.mobile_upload_item(upload_id, mobile_std) VALUES(%s,%s)",
+        [(upload_id, m) for m in new],
+    )
+    if not count:
+        return len(new), 0
+    placeholders = ",".join(["%s"] * len(new))
+    cur.execute(
+        f"SELECT COUNT(DISTINCT mobile_std) AS cnt FROM {profile.source()} WHERE mobile_std IN ({placeholders})",
+        new,
+    )
+    return len(new), int((cur.fetchone() or {}).get("cnt") or 0)
+
+
+def _count_matches(cur, upload_id: int) -> int:
+    """本次上传命中会员的号码数：明细表与会员数据源一次 JOIN。"""
+    cur.execute(
+        f"""
+        SELECT COUNT(DISTINCT i.mobile_std) AS cnt
+        FROM wecom_ops.mobile_upload_item i
+        JOIN {profile.source()} v ON v.mobile_std = i.mobile_std
+        WHERE i.upload_id=%s
+        """,
+        (upload_id,),
+    )
+    return int((cur.fetchone() or {}).get("cnt") or 0)
+
+
+def ingest(upload_id: int, mobiles: Iterable[str], chunk_size: int = _CHUNK) -> dict:
+    total = valid = rows = 0
+    # 宽表有 mobile_std 索引，逐块统计便宜；视图每次查询都要整体求值，改为最后统计一次
+    per_chunk = profile.source() == profile.TABLE
+    _progress(upload_id, status="running", rows=0, total=0, valid=0 if per_chunk else None)
+    with mysql_conn() as conn, conn.cursor() as cur:
+        conn.begin()
+        try:
+            for chunk in _chunks(mobiles, chunk_size):
+                rows += len(chunk)
+                added, matched = _ingest_chunk(cur, upload_id, chunk, count=per_chunk)
+                total += added
+                valid += matched
+                _progress(upload_id, rows=rows, total=total, valid=valid if per_chunk else None)
+            if not per_chunk and total:
+                valid = _count_matches(cur, upload_id)
+            cur.execute(
+                "UPDATE wecom_ops.mobile_upload SET total=%s, valid=%s, invalid=%s WHERE id=%s",
+                (total, valid, total - valid, upload_id),
+            )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            _progress(upload_id, status="failed", error=str(e)[:255])
+            raise
+    result = {"upload_id": upload_id, "total": total, "valid": valid, "invalid": total - valid}
+    _progress(upload_id, status="done", rows=rows, **{k: v for k, v in result.items() if k != "upload_id"})
+    return result
+
+
+# -------------------------
+# 后台任务
+# -------------------------
+def _queue() -> Queue:
+    return queues.get_queue(QUEUE_NAME)
+
+
+@contextmanager
+def _spooled(stream) -> Iterator[str]:
+    fd, path = tempfile.mkstemp(prefix="mobile_upload_", suffix=".csv", dir=UPLOAD_DIR)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                block = stream.read(1 << 20)
+                if not block:
+                    break
+                out.write(block)
+        yield path
+    except Exception:
+        os.unlink(path)
+        raise
+
+
+def submit_file(upload_id: int, stream) -> str:
+    """把上传流落到临时文件并入队，返回 RQ job id；文件由任务处理完后删除。"""
+    with _spooled(stream) as path:
+        job = _queue().enqueue(ingest_file, upload_id, path, job_timeout=3600, result_ttl=86400,
+                               description=f"media:upload:{upload_id}")
+    _progress(upload_id, status="queued", job_id=job.id)
+    return job.id
+
+
+def ingest_file(upload_id: int, path: str) -> dict:
+    if not os.path.exists(path):
+        # 文件落在了提交方机器的本地目录上：MEDIA_UPLOAD_DIR 需为 web 与 worker 共享的目录
+        _progress(upload_id, status="failed", error=f"upload file not found on worker: {path}")
+        raise FileNotFoundError(path)
+    try:
+        with open(path, "rb") as fh:
+            return ingest(upload_id, iter_mobiles(fh))
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def run_worker() -> None:
+    queues.run_worker([QUEUE_NAME])
+
+
+if __name__ == "__main__":
+    run_worker()
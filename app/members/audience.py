@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+人群位图索引（Redis bitmap）：回答“标签 X 且 负责人 Y 且 门店 Z 有多少人”。
+- 每个 external_userid 分配一个稠密整数 id（aud:id 哈希 + aud:seq 计数器，Lua 原子分配，id 永不回收）
+- 维度位图：aud:{ver}:{dim}:{value}，dim ∈ tag / owner / store / store_name / brand
+- 全集/标记位图：aud:{ver}:member（会员视图中未删除的）、aud:{ver}:pool（待分配池）、aud:{ver}:unassigned
+- 估算 = 维度内 BITOP OR、维度间 BITOP AND、再与全集 AND 后 BITCOUNT，毫秒级
+- rebuild() 按新版本号流式全量重建后原子切换 aud:ver，旧版本后台清理；由 app.jobs 定时提交（AUDIENCE_REBUILD_SEC）
+- 回调事件增量维护当前版本：标签增删、待分配进出直接置位；客户增删改时按会员数据源重算该客户的
+  member/owner/store/store_name/brand 位（aud:{ver}:dims 记录每个客户当前所在的维度位图，用于清掉旧位）
+- 计数语义为“去重后的 external_userid 数”；同一客户在会员视图里有多行（多手机号）时各行维度取并集，
+  因此跨行组合（如行 1 的负责人 + 行 2 的门店）也会命中，这一点与逐行过滤的 SQL 不同
+未建索引、索引超过 AUDIENCE_MAX_AGE_SEC 未重建、或带模糊关键词 q 时返回 None，调用方回退到 SQL。
+"""
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from pymysql.cursors import SSDictCursor
+from redis.exceptions import RedisError
+
+from app.core.db import mysql_conn
+from app.core.redis import get_redis
+from app.members import profile
+
+log = logging.getLogger(__name__)
+
+DIMENSIONS = ("tag", "owner", "store", "store_name", "brand")
+MEMBER_DIMS = ("owner", "store", "store_name", "brand")
+# set_bits 里的特殊位图名：按会员数据源重算该客户的 member 与各会员维度位
+REINDEX = "*member"
+MAX_AGE_S = int(os.getenv("AUDIENCE_MAX_AGE_SEC", "7200"))
+_CHUNK = 5000
+
+# KEYS[1]=aud:id, KEYS[2]=aud:seq；ARGV=external_userid 列表；返回对应 id 列表
+_ASSIGN_LUA = """
+local ids = {}
+for i, eid in ipairs(ARGV) do
+  local id = redis.call('HGET', KEYS[1], eid)
+  if not id then
+    id = redis.call('INCR', KEYS[2])
+    redis.call('HSET', KEYS[1], eid, id)
+  end
+  ids[i] = tonumber(id)
+end
+return ids
+"""
+_assign_script = None
+
+
+def _r():
+    return get_redis()
+
+
+def _assign(r, eids: Sequence[str]) -> List[int]:
+    global _assign_script
+    if not eids:
+        return []
+    if _assign_script is None:
+        _assign_script = r.register_script(_ASSIGN_LUA)
+    return [int(i) for i in _assign_script(keys=["aud:id", "aud:seq"], args=list(eids), client=r)]
+
+
+def current_version(r=None) -> int | None:
+    raw = (r or _r()).get("aud:ver")
+    return int(raw) if raw else None
+
+
+def _fresh_version(r) -> int | None:
+    """当前版本；索引重建时间超过 MAX_AGE_S（定时重建停了）视为不可用。"""
+    raw, built_at = r.mget("aud:ver", "aud:ver:at")
+    if not raw or not built_at or time.time() - float(built_at) > MAX_AGE_S:
+        return None
+    return int(raw)
+
+
+def _key(ver: int, name: str, value: str | None = None) -> str:
+    return f"aud:{ver}:{name}" if value is None else f"aud:{ver}:{name}:{value}"
+
+
+# -------------------------
+# 构建
+# -------------------------
+def _index_chunk(r, ver: int, rows: List[Tuple[str, List[str]]], track: bool = False):
+    """rows: [(external_userid, [位图名...])]；一次分配 id，一次管道 SETBIT。track=True 时并入 dims 记录。"""
+    ids = _assign(r, [eid for eid, _ in rows])
+    pipe = r.pipeline(transaction=False)
+    for (_, names), bit in zip(rows, ids):
+        for name in names:
+            pipe.setbit(f"aud:{ver}:{name}", bit, 1)
+    if track:
+        # 同一客户可能有多行且不相邻，和已记录的维度取并集
+        eids = list(dict.fromkeys(eid for eid, _ in rows))
+        merged = {eid: set(json.loads(v)) if v else set() for eid, v in zip(eids, r.hmget(_key(ver, "dims"), eids))}
+        for eid, names in rows:
+            merged[eid].update(names)
+        pipe.hset(_key(ver, "dims"), mapping={eid: json.dumps(sorted(n)) for eid, n in merged.items()})
+    pipe.execute()
+
+
+def _member_names(row: dict) -> List[str]:
+    names = ["member"]
+    for dim in MEMBER_DIMS:
+        if row.get(dim):
+            names.append(f"{dim}:{row[dim]}")
+    return names
+
+
+def _build(r, ver: int, sources: Dict[str, Iterable[dict]]):
+    """
+    sources 每项产出 dict 行：
+      members:    external_userid, owner, store, store_name, brand
+      tags:       external_userid, tag_id
+      unassigned: external_userid
+      pool:       external_userid
+    """
+    mapping = {
+        "members": _member_names,
+        "tags": lambda row: [f"tag:{row['tag_id']}"] if row.get("tag_id") else [],
+        "unassigned": lambda row: ["unassigned"],
+        "pool": lambda row: ["pool"],
+    }
+    counts = {}
+    for source, rows in sources.items():
+        buf: List[Tuple[str, List[str]]] = []
+        n = 0
+        for row in rows:
+            eid = row.get("external_userid")
+            if not eid:
+                continue
+            buf.append((eid, mapping[source](row)))
+            n += 1
+            if len(buf) >= _CHUNK:
+                _index_chunk(r, ver, buf, track=source == "members")
+                buf = []
+        if buf:
+            _index_chunk(r, ver, buf, track=source == "members")
+        counts[source] = n
+    return counts
+
+
+def _stream(sql: str):
+    with mysql_conn() as conn:
+        cur = conn.cursor(SSDictCursor)
+        try:
+            cur.execute(sql)
+            for row in cur:
+                yield row
+        finally:
+            cur.close()
+
+
+def _members_sql(where: str = "") -> str:
+    return f"""
+        SELECT v.external_userid, v.primary_owner_userid AS owner, v.store_code AS store,
+               v.store_name, v.department_brand AS brand
+        FROM {profile.source()} v
+        JOIN wecom_ops.ext_contact e ON e.external_userid = v.external_userid
+        WHERE v.is_deleted=0 {where}
+    """
+
+
+def _db_sources() -> Dict[str, Iterable[dict]]:
+    # 无缓冲游标逐行读取，内存与全量人数无关
+    return {
+        "members": _stream(_members_sql()),
+        "tags": _stream("SELECT external_userid, tag_id FROM wecom_ops.ext_contact_tag"),
+        "unassigned": _stream(
+            "SELECT external_userid FROM wecom_ops.ext_contact WHERE COALESCE(is_unassigned,0)=1"
+        ),
+        "pool": _stream("""
+            SELECT un.external_userid
+            FROM wecom_ops.ext_unassigned un
+            JOIN wecom_ops.ext_contact e ON e.external_userid = un.external_userid
+            WHERE un.is_active=1 AND COALESCE(e.is_deleted,0)=0
+        """),
+    }
+
+
+def _drop_version(r, ver: int):
+    batch = []
+    for key in r.scan_iter(match=f"aud:{ver}:*", count=1000):
+        batch.append(key)
+        if len(batch) >= 500:
+            r.unlink(*batch)
+            batch = []
+    if batch:
+        r.unlink(*batch)
+
+
+def rebuild(sources: Dict[str, Iterable[dict]] | None = None) -> dict:
+    """全量重建到新版本，完成后切换 aud:ver 并清理旧版本。"""
+    r = _r()
+    old = current_version(r)
+    ver = int(r.incr("aud:ver:seq"))
+    try:
+        counts = _build(r, ver, sources if sources is not None else _db_sources())
+    except Exception:
+        _drop_version(r, ver)
+        raise
+    r.mset({"aud:ver": ver, "aud:ver:at": time.time()})
+    if old is not None:
+        _drop_version(r, old)
+    log.info("audience index rebuilt ver=%s counts=%s", ver, counts)
+    return {"version": ver, **counts}
+
+
+def rebuild_from_db() -> dict:
+    """定时任务入口（app.jobs.sync.SYNC_JOBS["audience.rebuild"]）。"""
+    return rebuild()
+
+
+# -------------------------
+# 增量维护
+# -------------------------
+def _member_rows(eids: Sequence[str]) -> Dict[str, List[dict]]:
+    out: Dict[str, List[dict]] = {eid: [] for eid in eids}
+    with mysql_conn() as conn, conn.cursor() as cur:
+        for i in range(0, len(eids), _CHUNK):
+            part = list(eids[i:i + _CHUNK])
+            cur.execute(_members_sql(f"AND v.external_userid IN ({','.join(['%s'] * len(part))})"), part)
+            for row in cur.fetchall():
+                out[row["external_userid"]].append(row)
+    return out
+
+
+def reindex_members(eids: Iterable[str], rows: Dict[str, List[dict]] | None = None) -> int:
+    """
+    按会员数据源重算这些客户的 member 与 owner/store/store_name/brand 位：
+    与 aud:{ver}:dims 记录的旧维度做差，清掉不再属于的位、置上新位。源里已没有的客户（删除/离开视图）全部清位。
+    """
+    eids = list(dict.fromkeys(e for e in eids if e))
+    if not eids:
+        return 0
+    r = _r()
+    ver = current_version(r)
+    if ver is None:
+        return 0
+    rows = rows if rows is not None else _member_rows(eids)
+    ids = _assign(r, eids)
+    old = r.hmget(_key(ver, "dims"), eids)
+    pipe = r.pipeline(transaction=False)
+    for eid, bit, raw in zip(eids, ids, old):
+        want = {n for row in rows.get(eid) or [] for n in _member_names(row)}
+        have = set(json.loads(raw)) if raw else set()
+        for name in have - want:
+            pipe.setbit(_key(ver, name), bit, 0)
+        for name in want - have:
+            pipe.setbit(_key(ver, name), bit, 1)
+        if want:
+            pipe.hset(_key(ver, "dims"), eid, json.dumps(sorted(want)))
+        else:
+            pipe.hdel(_key(ver, "dims"), eid)
+    pipe.execute()
+    return len(eids)
+
+
+def set_bits(changes: Iterable[Tuple[str, str, bool]]) -> int:
+    """
+    changes: [(external_userid, 位图名, 置位/清位)]，位图名如 "tag:t1"、"unassigned"、"pool"；
+    位图名为 REINDEX 时按会员数据源重算该客户的会员维度（见 reindex_members）。
+    未建索引时直接跳过；Redis/MySQL 异常只记日志（下次 rebuild 纠正）。
+    """
+    changes = list(changes)
+    if not changes:
+        return 0
+    reindex = [eid for eid, name, _ in changes if name == REINDEX]
+    changes = [c for c in changes if c[1] != REINDEX]
+    try:
+        r = _r()
+        ver = current_version(r)
+        if ver is None:
+            return 0
+        if changes:
+            ids = _assign(r, [eid for eid, _, _ in changes])
+            pipe = r.pipeline(transaction=False)
+            for (_, name, on), bit in zip(changes, ids):
+                pipe.setbit(_key(ver, name), bit, 1 if on else 0)
+            pipe.execute()
+        if reindex:
+            reindex_members(reindex)
+        return len(changes) + len(reindex)
+    except Exception as e:
+        log.warning("audience index update skipped: %s", e)
+        return 0
+
+
+# -------------------------
+# 估算
+# -------------------------
+def estimate(universe: str, filters: Dict[str, Sequence[str]], unassigned: int | None = None) -> int | None:
+    """
+    universe: "member" 或 "pool"；filters: {dim: [values]}，维度内 OR、维度间 AND。
+    unassigned: None 不限 / 1 只看待分配 / 0 排除待分配。
+    返回 None 表示索引不可用，调用方应回退 SQL。
+    """
+    try:
+        r = _r()
+        ver = _fresh_version(r)
+        if ver is None:
+            return None
+        tmp = f"aud:tmp:{uuid.uuid4().hex}"
+        and_keys = [_key(ver, universe)]
+        temps = [tmp, tmp + ":u"]
+        pipe = r.pipeline(transaction=False)
+        for i, dim in enumerate(DIMENSIONS):
+            values = [v for v in (filters.get(dim) or []) if v]
+            if not values:
+                continue
+            if len(values) == 1:
+                and_keys.append(_key(ver, dim, values[0]))
+            else:
+                t = f"{tmp}:{i}"
+                pipe.bitop("OR", t, *[_key(ver, dim, v) for v in values])
+                temps.append(t)
+                and_keys.append(t)
+        if unassigned == 1:
+            and_keys.append(_key(ver, "unassigned"))
+        pipe.bitop("AND", tmp, *and_keys)
+        pipe.bitcount(tmp)
+        if unassigned == 0:
+            # BITOP NOT 会按源 key 长度截断，改用 总数 - 其中待分配数
+            pipe.bitop("AND", tmp + ":u", tmp, _key(ver, "unassigned"))
+            pipe.bitcount(tmp + ":u")
+        pipe.delete(*temps)
+        res = pipe.execute()
+    except RedisError as e:
+        log.warning("audience estimate fell back to SQL: %s", e)
+        return None
+    # res 依次为：各维度 OR 的 BITOP、AND 的 BITOP、BITCOUNT、（排除待分配时的 BITOP、BITCOUNT）、DEL
+    n_or = len(temps) - 2
+    total = int(res[n_or + 1])
+    if unassigned == 0:
+        total -= int(res[n_or + 3])
+    return total
+
+
+if __name__ == "__main__":
+    print(rebuild())
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+会员宽表 member_profile：vw_mobile_to_external 的物化版本（带索引）。
+- source()：查询侧统一取数据源，MEMBER_SOURCE=table 时走宽表，默认仍走视图
+- 每次刷新只对视图做一次集合式 INSERT ... SELECT（视图每次查询都整体求值，不能按客户分块 IN）：
+  - 增量：待刷新客户 = ext_contact.updated_at >= 上次起点（回调批次会刷新它）
+    + 同步写入 member_profile_dirty 的客户（客户行哈希未变、只有跟进人/标签变化时 updated_at 不动）；
+    同一事务里删掉这些客户的旧行，再与视图 JOIN 整批灌入
+  - full=True：视图整体灌进影子表后 RENAME 原子替换，已不存在的客户随之消失（CRM 侧变更没有时间戳，需定期全量兜底）
+- 宽表行与视图行一一对应（自增主键），不按 (external_userid, mobile_std) 去重，计数与视图一致
+- 增量刷新过的客户随后重算人群位图（audience.reindex_members）；全量刷新后提交一次人群位图重建
+断点与起点记在 sync_state('members', 'profile')；作为 sync 任务 members.profile 按 MEMBER_PROFILE_REFRESH_SEC 周期增量执行。
+"""
+import logging
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from app.common import sync_state
+from app.common.cache import GEN_MEMBERS, bump_generation
+from app.core.config import settings
+from app.core.db import mysql_conn
+
+log = logging.getLogger(__name__)
+
+VIEW = "wecom_ops.vw_mobile_to_external"
+TABLE = "wecom_ops.member_profile"
+DIRTY = "wecom_ops.member_profile_dirty"
+_SHADOW = TABLE + "__new"
+_RETIRED = TABLE + "__old"
+
+COLUMNS = (
+    "external_userid", "mobile_std", "unionid", "crm_user_id", "vip_name", "mobile_raw",
+    "store_code", "store_name", "department_brand",
+    "primary_owner_userid", "primary_owner_name", "tag_names", "is_deleted",
+)
+
+_CHUNK = 1000
+
+
+def source() -> str:
+    """会员查询的数据源（视图或宽表），两者列名一致。"""
+    return TABLE if settings.member_source == "table" else VIEW
+
+
+@contextmanager
+def _use_cursor() -> Iterator:
+    with mysql_conn() as conn, conn.cursor() as cur:
+        yield cur
+
+
+def _cols() -> tuple[str, str]:
+    """(插入列, 视图侧取值表达式)。"""
+    select_cols = ", ".join("COALESCE(v.mobile_std, '')" if c == "mobile_std" else
+                            "COALESCE(v.is_deleted, 0)" if c == "is_deleted" else f"v.{c}" for c in COLUMNS)
+    return ", ".join(COLUMNS), select_cols
+
+
+def _rebuild(cur) -> int:
+    """全量：视图一次灌进影子表，RENAME 原子换上，读方不会看到半成品。"""
+    cols, select_cols = _cols()
+    cur.execute(f"DROP TABLE IF EXISTS {_SHADOW}")
+    cur.execute(f"CREATE TABLE {_SHADOW} LIKE {TABLE}")
+    cur.execute(f"INSERT INTO {_SHADOW} ({cols}) SELECT {select_cols} FROM {VIEW} v")
+    rows = int(cur.rowcount or 0)
+    cur.execute(f"DROP TABLE IF EXISTS {_RETIRED}")
+    cur.execute(f"RENAME TABLE {TABLE} TO {_RETIRED}, {_SHADOW} TO {TABLE}")
+    cur.execute(f"DROP TABLE {_RETIRED}")
+    return rows
+
+
+def _reload_dirty(cur, upto: int) -> tuple[List[str], int]:
+    """
+    增量：seq <= upto 的待刷新客户在同一事务里删旧行、与视图 JOIN 整批重灌，并消费掉这些标记；
+    返回 (客户列表, 写入行数)。upto 之后新写入的标记留给下一轮。
+    """
+    cols, select_cols = _cols()
+    pending = f"(SELECT DISTINCT external_userid FROM {DIRTY} WHERE seq <= %s)"
+    conn = cur.connection
+    conn.begin()
+    try:
+        cur.execute(f"SELECT DISTINCT external_userid FROM {DIRTY} WHERE seq <= %s", (upto,))
+        eids = [r["external_userid"] for r in cur.fetchall()]
+        cur.execute(
+            f"DELETE p FROM {TABLE} p JOIN {pending} d ON d.external_userid = p.external_userid",
+            (upto,),
+        )
+        cur.execute(
+            f"""
+            INSERT INTO {TABLE} ({cols})
+            SELECT {select_cols} FROM {VIEW} v
+            JOIN {pending} d ON d.external_userid = v.external_userid
+            """,
+            (upto,),
+        )
+        rows = int(cur.rowcount or 0)
+        cur.execute(f"DELETE FROM {DIRTY} WHERE seq <= %s", (upto,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return eids, rows
+
+
+def _reindex(eids: List[str]):
+    # audience 依赖本模块取数据源，放到调用时导入避免循环导入
+    from app.members import audience
+
+    for i in range(0, len(eids), _CHUNK):
+        audience.set_bits((eid, audience.REINDEX, True) for eid in eids[i:i + _CHUNK])
+
+
+def _submit_audience_rebuild():
+    from app.jobs import sync
+
+    try:
+        sync.submit("audience.rebuild")
+    except sync.JobConflict:
+        pass
+    except Exception as e:
+        log.warning("audience rebuild submit after profile refresh failed: %s", e)
+
+
+def refresh(full: bool = False) -> dict:
+    with _use_cursor() as cur:
+        cur.execute("SELECT NOW() AS now")
+        started = cur.fetchone()["now"]
+        since = None if full else sync_state.get_state(cur, "members", "profile").get("since")
+        eids: List[str] = []
+        try:
+            if since:
+                cur.execute(
+                    f"""
+                    INSERT INTO {DIRTY} (external_userid)
+                    SELECT external_userid FROM wecom_ops.ext_contact WHERE updated_at >= %s
+                    """,
+                    (since,),
+                )
+            cur.execute(f"SELECT MAX(seq) AS upto FROM {DIRTY}")
+            upto = int((cur.fetchone() or {}).get("upto") or 0)
+            if since:
+                eids, rows = _reload_dirty(cur, upto) if upto else ([], 0)
+            else:
+                rows = _rebuild(cur)
+                # 全量已覆盖所有客户，之前的待刷新标记一并消费
+                cur.execute(f"DELETE FROM {DIRTY} WHERE seq <= %s", (upto,))
+            sync_state.mark_ok(cur, "members", "profile", started)
+        except Exception as e:
+            sync_state.mark_err(cur, "members", "profile", e)
+            raise
+    if since:
+        _reindex(eids)
+    else:
+        _submit_audience_rebuild()
+    if eids or not since:
+        bump_generation(GEN_MEMBERS)
+    return {"mode": "incremental" if since else "full", "contacts": len(eids), "rows": rows}
+
+
+if __name__ == "__main__":
+    import sys
+    print(refresh(full="--full" in sys.argv))
@@ -1,6 +1,7 @@
 # /www/wwwroot/wecom_ops/app/members/routes_v1.py
 from flask import Blueprint, request, jsonify, g
-from app.core.db import get_mysql_conn
+from app.core.db import get_mysql_conn, use_replica
+from app.members import audience, profile, service as members_service
 
 bp = Blueprint("members_v1", __name__, url_prefix="/api/v1/members")
 
@@ -69,6 +70,7 @@ def _get_flag(name):
 
 # ---------- /members/meta ----------
 @bp.get("/meta")
+@use_replica
 def meta():
     """
     元数据（分页）：
@@ -79,164 +81,18 @@ def meta():
     说明：
       * 仅统计 is_deleted=0。
       * 不做手机号规范化。
+      * 结果走读穿缓存（见 app.members.service.get_meta），同步/回调写库后失效。
     """
-    conn = None
-    cur = None
     try:
         only_raw = (request.args.get("only") or "").strip()
         only_set = set([s.strip().lower() for s in only_raw.split(",") if s.strip()]) if only_raw else set()
         page = _get_int("page", 1)
         size = _get_int("size", 50)
-        offset = (page - 1) * size
         q = (request.args.get("q") or "").strip()
-        qlike = f"%{q}%" if q else None
         unassigned = _get_flag("unassigned")
-
-        out = {}
-        conn = get_mysql_conn()
-        cur = conn.cursor()
-
-        # 1) tags
-        if not only_set or "tags" in only_set:
-            params, where = [], ["COALESCE(e.is_deleted,0)=0"]
-            if unassigned is not None:
-                where.append("COALESCE(e.is_unassigned,0)=%s")
-                params.append(int(unassigned))
-            if q:
-                where.append("(t.tag_name LIKE %s OR t.group_name LIKE %s)")
-                params += [qlike, qlike]
-
-            cur.execute(f"""
-              SELECT COUNT(*) FROM (
-                SELECT t.tag_id
-                FROM wecom_ops.ext_contact_tag t
-                JOIN wecom_ops.ext_contact e ON e.external_userid=t.external_userid
-                WHERE {" AND ".join(where)}
-                GROUP BY t.tag_id
-              ) x
-            """, params)
-            total = int(_first_val(cur.fetchone(), 0))
-
-            cur.execute(f"""
-              SELECT
-                  t.tag_id,
-                  COALESCE(t.tag_name, t.tag_id) AS tag_name,
-                  t.group_name,
-                  COUNT(DISTINCT t.external_userid) AS members
-              FROM wecom_ops.ext_contact_tag t
-              JOIN wecom_ops.ext_contact e ON e.external_userid=t.external_userid
-              WHERE {" AND ".join(where)}
-              GROUP BY t.tag_id, COALESCE(t.tag_name, t.tag_id), t.group_name
-              ORDER BY members DESC, tag_name ASC
-              LIMIT %s OFFSET %s
-            """, params + [size, offset])
-            rows = cur.fetchall()
-            out["tags"] = {
-                "items": [{
-                    "tag_id":    _get(r, "tag_id", 0),
-                    "tag_name":  _get(r, "tag_name", 1),
-                    "group_name":_get(r, "group_name", 2),
-                    "members":   int(_get(r, "members", 3)),
-                } for r in rows],
-                "page": page, "size": size, "total": total
-            }
-
-        # 2) owners
-        if not only_set or "owners" in only_set:
-            params, where = [], ["v.is_deleted=0"]
-            if q:
-                where.append("(v.primary_owner_name LIKE %s OR v.primary_owner_userid LIKE %s)")
-                params += [qlike, qlike]
-            # 为支持 unassigned 过滤，连接 ext_contact
-            if unassigned is not None:
-                where.append("COALESCE(e.is_unassigned,0)=%s")
-                params.append(int(unassigned))
-
-            cur.execute(f"""
-              SELECT COUNT(*) FROM (
-                SELECT v.primary_owner_userid, v.primary_owner_name
-                FROM wecom_ops.vw_mobile_to_external v
-                JOIN wecom_ops.ext_contact e ON e.external_userid=v.external_userid
-                WHERE {" AND ".join(where)}
-                GROUP BY v.primary_owner_userid, v.primary_owner_name
-              ) x
-            """, params)
-            total = int(_first_val(cur.fetchone(), 0))
-
-            cur.execute(f"""
-              SELECT v.primary_owner_userid AS userid,
-                     v.primary_owner_name   AS name,
-                     COUNT(*)               AS members
-              FROM wecom_ops.vw_mobile_to_external v
-              JOIN wecom_ops.ext_contact e ON e.external_userid=v.external_userid
-              WHERE {" AND ".join(where)}
-              GROUP BY v.primary_owner_userid, v.primary_owner_name
-              ORDER BY members DESC, name ASC
-              LIMIT %s OFFSET %s
-            """, params + [size, offset])
-            rows = cur.fetchall()
-            out["owners"] = {
-                "items": [{
-                    "userid":  _get(r, "userid", 0),
-                    "name":    _get(r, "name", 1),
-                    "members": int(_get(r, "members", 2)),
-                } for r in rows],
-                "page": page, "size": size, "total": total
-            }
-
-        # 3) stores/brands
-        if not only_set or "stores" in only_set:
-            params, where = [], ["v.is_deleted=0"]
-            if q:
-                where.append("(v.store_name LIKE %s OR v.department_brand LIKE %s OR v.store_code LIKE %s)")
-                params += [qlike, qlike, qlike]
-            if unassigned is not None:
-                where.append("COALESCE(e.is_unassigned,0)=%s")
-                params.append(int(unassigned))
-
-            cur.execute(f"""
-              SELECT COUNT(*) FROM (
-                SELECT v.store_code, v.store_name, v.department_brand
-                FROM wecom_ops.vw_mobile_to_external v
-                JOIN wecom_ops.ext_contact e ON e.external_userid=v.external_userid
-                WHERE {" AND ".join(where)}
-                GROUP BY v.store_code, v.store_name, v.department_brand
-              ) x
-            """, params)
-            total = int(_first_val(cur.fetchone(), 0))
-
-            cur.execute(f"""
-              SELECT v.store_code, v.store_name, v.department_brand, COUNT(*) AS members
-              FROM wecom_ops.vw_mobile_to_external v
-              JOIN wecom_ops.ext_contact e ON e.external_userid=v.external_userid
-              WHERE {" AND ".join(where)}
-              GROUP BY v.store_code, v.store_name, v.department_brand
-              ORDER BY members DESC, COALESCE(v.store_name,''), COALESCE(v.department_brand,'')
-              LIMIT %s OFFSET %s
-            """, params + [size, offset])
-            rows = cur.fetchall()
-            out["stores"] = {
-                "items": [{
-                    "store_code":       _get(r, "store_code", 0),
-                    "store_name":       _get(r, "store_name", 1),
-                    "department_brand": _get(r, "department_brand", 2),
-                    "members":          int(_get(r, "members", 3)),
-                } for r in rows],
-                "page": page, "size": size, "total": total
-            }
-
-        return _ok(out)
+        return _ok(members_service.get_meta(only_set, q, unassigned, page, size))
     except Exception as e:
         return _err(message=e, detail="")
-    finally:
-        try:
-            cur and cur.close()
-        except Exception:
-            pass
-        try:
-            conn and conn.close()
-        except Exception:
-            pass
 
 # ---------- 统一的过滤构建 ----------
 def _build_filters():
@@ -290,6 +146,7 @@ def _build_filters():
 
 # ---------- /members/list ----------
 @bp.get("/list")
+@use_replica
 def list_members():
     """
     列表：
@@ -316,7 +173,7 @@ def list_members():
         # total
         cur.execute(f"""
           SELECT COUNT(*)
-          FROM wecom_ops.vw_mobile_to_external v
+          FROM {profile.source()} v
           JOIN wecom_ops.ext_contact e ON e.external_userid = v.external_userid
           WHERE {" AND ".join(where)}
         """, params)
@@ -334,7 +191,7 @@ def list_members():
               COALESCE(e.is_deleted,0)    AS is_deleted,
               e.name AS ext_name, e.avatar, e.corp_name,
               e.created_at, e.updated_at
-          FROM wecom_ops.vw_mobile_to_external v
+          FROM {profile.source()} v
           JOIN wecom_ops.ext_contact e ON e.external_userid = v.external_userid
           WHERE {" AND ".join(where)}
           ORDER BY e.updated_at DESC
@@ -381,17 +238,35 @@ def list_members():
 
 # ---------- /members/estimate ----------
 @bp.get("/estimate")
+@use_replica
 def estimate_members():
-    """返回当前过滤条件下的总数（不分页）。"""
+    """
+    返回当前过滤条件下的人数（去重 external_userid，不分页）。
+    无模糊关键词时走人群位图索引，索引不可用/过期再查库；两条路径都按客户去重计数。
+    """
     conn = None
     cur = None
     try:
+        if not (request.args.get("q") or "").strip():
+            total = audience.estimate(
+                "member",
+                {
+                    "tag": _csv("tag_ids"),
+                    "owner": _csv("owner_userids"),
+                    "store": _csv("store_codes"),
+                    "brand": _csv("brands"),
+                },
+                _get_flag("unassigned"),
+            )
+            if total is not None:
+                return _ok({"total": total})
+
         where, params = _build_filters()
         conn = get_mysql_conn()
         cur = conn.cursor()
         cur.execute(f"""
-          SELECT COUNT(*)
-          FROM wecom_ops.vw_mobile_to_external v
+          SELECT COUNT(DISTINCT v.external_userid)
+          FROM {profile.source()} v
           JOIN wecom_ops.ext_contact e ON e.external_userid = v.external_userid
           WHERE {" AND ".join(where)}
         """, params)
@@ -411,6 +286,7 @@ def estimate_members():
 
 # ---------- /members/detail ----------
 @bp.get("/detail")
+@use_replica
 def detail_member():
     """
     详情：
@@ -429,7 +305,7 @@ def detail_member():
         cur = conn.cursor()
 
         # 主体信息（v + e）
-        cur.execute("""
+        cur.execute(f"""
           SELECT
               v.external_userid, v.unionid,
               v.crm_user_id, v.vip_name, v.mobile_raw,
@@ -439,7 +315,7 @@ def detail_member():
               COALESCE(e.is_deleted,0)    AS is_deleted,
               e.name AS ext_name, e.avatar, e.corp_name,
               e.created_at, e.updated_at, e.detail_json
-          FROM wecom_ops.vw_mobile_to_external v
+          FROM {profile.source()} v
           JOIN wecom_ops.ext_contact e ON e.external_userid = v.external_userid
           WHERE v.external_userid = %s
           LIMIT 1
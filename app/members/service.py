@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""会员元数据（标签/负责人/门店分面）查询与缓存。"""
+import hashlib
+import json
+import logging
+from contextlib import contextmanager
+from typing import Iterator
+
+from redis.exceptions import RedisError
+
+from app.common.cache import GEN_MEMBERS, generation, get_with_singleflight
+from app.core.config import settings
+from app.core.db import mysql_conn
+from app.members import profile
+
+log = logging.getLogger(__name__)
+
+META_FACETS = ("tags", "owners", "stores")
+
+
+@contextmanager
+def _use_cursor() -> Iterator:
+    with mysql_conn() as conn, conn.cursor() as cur:
+        yield cur
+
+
+def _meta_tags(cur, q, unassigned, page, size) -> dict:
+    params, where = [], ["COALESCE(e.is_deleted,0)=0"]
+    if unassigned is not None:
+        where.append("COALESCE(e.is_unassigned,0)=%s")
+        params.append(int(unassigned))
+    if q:
+        where.append("(t.tag_name LIKE %s OR t.group_name LIKE %s)")
+        params += [f"%{q}%", f"%{q}%"]
+
+    cur.execute(f"""
+      SELECT COUNT(*) AS n FROM (
+        SELECT t.tag_id
+        FROM wecom_ops.ext_contact_tag t
+        JOIN wecom_ops.ext_contact e ON e.external_userid=t.external_userid
+        WHERE {" AND ".join(where)}
+        GROUP BY t.tag_id
+      ) x
+    """, params)
+    total = int((cur.fetchone() or {}).get("n") or 0)
+
+    cur.execute(f"""
+      SELECT
+          t.tag_id,
+          COALESCE(t.tag_name, t.tag_id) AS tag_name,
+          t.group_name,
+          COUNT(DISTINCT t.external_userid) AS members
+      FROM wecom_ops.ext_contact_tag t
+      JOIN wecom_ops.ext_contact e ON e.external_userid=t.external_userid
+      WHERE {" AND ".join(where)}
+      GROUP BY t.tag_id, COALESCE(t.tag_name, t.tag_id), t.group_name
+      ORDER BY members DESC, tag_name ASC
+      LIMIT %s OFFSET %s
+    """, params + [size, (page - 1) * size])
+    items = [{
+        "tag_id":     r["tag_id"],
+        "tag_name":   r["tag_name"],
+        "group_name": r["group_name"],
+        "members":    int(r["members"]),
+    } for r in cur.fetchall()]
+    return {"items": items, "page": page, "size": size, "total": total}
+
+
+def _meta_owners(cur, q, unassigned, page, size) -> dict:
+    params, where = [], ["v.is_deleted=0"]
+    if q:
+        where.append("(v.primary_owner_name LIKE %s OR v.primary_owner_userid LIKE %s)")
+        params += [f"%{q}%", f"%{q}%"]
+    # 为支持 unassigned 过滤，连接 ext_contact
+    if unassigned is not None:
+        where.append("COALESCE(e.is_unassigned,0)=%s")
+        params.append(int(unassigned))
+
+    cur.execute(f"""
+      SELECT COUNT(*) AS n FROM (
+        SELECT v.primary_owner_userid, v.primary_owner_name
+        FROM {profile.source()} v
+        JOIN wecom_ops.ext_contact e ON e.external_userid=v.external_userid
+        WHERE {" AND ".join(where)}
+        GROUP BY v.primary_owner_userid, v.primary_owner_name
+      ) x
+    """, params)
+    total = int((cur.fetchone() or {}).get("n") or 0)
+
+    cur.execute(f"""
+      SELECT v.primary_owner_userid AS userid,
+             v.primary_owner_name   AS name,
+             COUNT(*)               AS members
+      FROM {profile.source()} v
+      JOIN wecom_ops.ext_contact e ON e.external_userid=v.external_userid
+      WHERE {" AND ".join(where)}
+      GROUP BY v.primary_owner_userid, v.primary_owner_name
+      ORDER BY members DESC, name ASC
+      LIMIT %s OFFSET %s
+    """, params + [size, (page - 1) * size])
+    items = [{
+        "userid":  r["userid"],
+        "name":    r["name"],
+        "members": int(r["members"]),
+    } for r in cur.fetchall()]
+    return {"items": items, "page": page, "size": size, "total": total}
+
+
+def _meta_stores(cur, q, unassigned, page, size) -> dict:
+    params, where = [], ["v.is_deleted=0"]
+    if q:
+        where.append("(v.store_name LIKE %s OR v.department_brand LIKE %s OR v.store_code LIKE %s)")
+        params += [f"%{q}%", f"%{q}%", f"%{q}%"]
+    if unassigned is not None:
+        where.append("COALESCE(e.is_unassigned,0)=%s")
+        params.append(int(unassigned))
+
+    cur.execute(f"""
+      SELECT COUNT(*) AS n FROM (
+        SELECT v.store_code, v.store_name, v.department_brand
+        FROM {profile.source()} v
+        JOIN wecom_ops.ext_contact e ON e.external_userid=v.external_userid
+        WHERE {" AND ".join(where)}
+        GROUP BY v.store_code, v.store_name, v.department_brand
+      ) x
+    """, params)
+    total = int((cur.fetchone() or {}).get("n") or 0)
+
+    cur.execute(f"""
+      SELECT v.store_code, v.store_name, v.department_brand, COUNT(*) AS members
+      FROM {profile.source()} v
+      JOIN wecom_ops.ext_contact e ON e.external_userid=v.external_userid
+      WHERE {" AND ".join(where)}
+      GROUP BY v.store_code, v.store_name, v.department_brand
+      ORDER BY members DESC, COALESCE(v.store_name,''), COALESCE(v.department_brand,'')
+      LIMIT %s OFFSET %s
+    """, params + [size, (page - 1) * size])
+    items = [{
+        "store_code":       r["store_code"],
+        "store_name":       r["store_name"],
+        "department_brand": r["department_brand"],
+        "members":          int(r["members"]),
+    } for r in cur.fetchall()]
+    return {"items": items, "page": page, "size": size, "total": total}
+
+
+_META_LOADERS = {"tags": _meta_tags, "owners": _meta_owners, "stores": _meta_stores}
+
+
+def load_meta(only: tuple, q: str, unassigned, page: int, size: int) -> dict:
+    """直查库：only 为空表示全部分面。"""
+    out = {}
+    with _use_cursor() as cur:
+        for facet in META_FACETS:
+            if not only or facet in only:
+                out[facet] = _META_LOADERS[facet](cur, q, unassigned, page, size)
+    return out
+
+
+def _meta_key(gen: int, only: tuple, q: str, unassigned, page: int, size: int) -> str:
+    raw = json.dumps([list(only), q, unassigned, page, size], ensure_ascii=False)
+    return f"members:meta:g{gen}:{hashlib.sha1(raw.encode('utf-8')).hexdigest()}"
+
+
+def get_meta(only, q: str, unassigned, page: int, size: int) -> dict:
+    """
+    读穿缓存：key = 代际号 + (only, q, unassigned, page, size)。
+    同步任务与回调写库后 bump 代际号，旧 key 不再命中、按 TTL 自然过期。
+    """
+    only = tuple(sorted(set(only or ())))
+    try:
+        key = _meta_key(generation(GEN_MEMBERS), only, q, unassigned, page, size)
+        return get_with_singleflight(
+            key,
+            lambda: load_meta(only, q, unassigned, page, size),
+            soft_ttl_s=settings.cache_soft_ttl_s,
+            hard_ttl_s=settings.cache_hard_ttl_s,
+        )
+    except RedisError as e:
+        # 缓存不可用时直查库
+        log.warning("members meta cache unavailable: %s", e)
+        return load_meta(only, q, unassigned, page, size)
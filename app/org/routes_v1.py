@@ -1,5 +1,5 @@
 from flask import Blueprint, request, jsonify, g
-from app.core.db import get_mysql_conn
+from app.core.db import get_mysql_conn, use_replica
 
 bp = Blueprint("org_v1", __name__, url_prefix="/api/v1/org")
 
@@ -32,6 +32,7 @@ def _table_exists(conn, table_name: str) -> bool:
         return False
 
 @bp.get("/employees")
+@use_replica
 def list_employees():
     # 支持分页
     try:
@@ -3,86 +3,117 @@
 
 import json
 from contextlib import contextmanager
+from datetime import datetime
 from typing import Iterator
 
-from app.core.db import get_mysql_conn
+from app.common import sync_state
+from app.common.bulk import BulkUpserter
+from app.common.cache import GEN_MEMBERS, bump_generation
+from app.common.sync_state import ChangeFilter
+from app.core.db import mysql_conn
 from app.wecom.client import wecom_get_json
 
 
 @contextmanager
 def _use_cursor() -> Iterator:
-    conn = get_mysql_conn()
-    try:
-        with conn.cursor() as cur:
-            yield cur
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+    with mysql_conn() as conn, conn.cursor() as cur:
+        yield cur
 
 
 def sync_departments(full: bool = False) -> dict:
+    """部门全量一次拉回；按内容哈希比对，只写变化的部门（full=True 全部重写）。"""
     data = wecom_get_json("https://qyapi.weixin.qq.com/cgi-bin/department/list", "contacts")
+    depts = {str(d["id"]): d for d in data.get("department", [])}
     upserted = 0
+    started = datetime.now()
     with _use_cursor() as cur:
-        for dept in data.get("department", []):
-            cur.execute(
-                """
-                REPLACE INTO org_department
-                    (id, name, parent_id, order_no, path, level, status, ext)
-                VALUES (%s, %s, %s, %s, %s, %s, 1, %s)
-                """,
-                (
-                    dept["id"],
-                    dept.get("name"),
-                    dept.get("parentid"),
-                    dept.get("order"),
-                    None,
-                    None,
-                    json.dumps(dept, ensure_ascii=False),
-                ),
-            )
-            upserted += 1
-    return {"upserted": upserted}
+        writer = BulkUpserter(cur).register(
+            "org_department",
+            ["id", "name", "parent_id", "order_no", "path", "level", "status", "ext"],
+            update=["name", "parent_id", "order_no", "status", "ext"],
+        )
+        flt = ChangeFilter(cur, writer, "org", "departments", full)
+        try:
+            with writer:
+                for key in flt.changed(depts):
+                    dept = depts[key]
+                    writer.add("org_department", (
+                        dept["id"],
+                        dept.get("name"),
+                        dept.get("parentid"),
+                        dept.get("order"),
+                        None,
+                        None,
+                        1,
+                        json.dumps(dept, ensure_ascii=False),
+                    ))
+                    flt.mark(key)
+                    upserted += 1
+            sync_state.mark_ok(cur, "org", "departments", started)
+        except Exception as e:
+            sync_state.mark_err(cur, "org", "departments", e)
+            raise
+    return {"upserted": upserted, "skipped_unchanged": flt.skipped}
 
 
 def sync_employees(full: bool = False, root_dept_id: int = 1, fetch_child: int = 1) -> dict:
+    """
+    员工按内容哈希比对，只写变化的员工；部门关系也只对变化的员工删后重建，
+    不再逐人 DELETE + INSERT。
+    """
     data = wecom_get_json(
         "https://qyapi.weixin.qq.com/cgi-bin/user/list",
         "contacts",
         params={"department_id": root_dept_id, "fetch_child": fetch_child},
     )
+    users = {u["userid"]: u for u in data.get("userlist", [])}
     upserted = 0
+    started = datetime.now()
     with _use_cursor() as cur:
-        for user in data.get("userlist", []):
-            cur.execute(
-                """
-                REPLACE INTO org_employee
-                    (userid, name, mobile, email, position, gender, enable, qr_code, departments, ext)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (
-                    user["userid"],
-                    user.get("name"),
-                    user.get("mobile"),
-                    user.get("email"),
-                    user.get("position"),
-                    user.get("gender"),
-                    user.get("enable"),
-                    user.get("qr_code"),
-                    json.dumps(user.get("department", [])),
-                    json.dumps(user, ensure_ascii=False),
-                ),
-            )
-            cur.execute("DELETE FROM org_employee_dept WHERE userid=%s", (user["userid"],))
-            for dept_id in user.get("department", []):
-                cur.execute(
-                    "INSERT IGNORE INTO org_employee_dept (userid, dept_id) VALUES (%s, %s)",
-                    (user["userid"], dept_id),
-                )
-            upserted += 1
-    return {"upserted": upserted}
+        writer = BulkUpserter(cur)
+        writer.register(
+            "org_employee",
+            ["userid", "name", "mobile", "email", "position", "gender", "enable", "qr_code", "departments", "ext"],
+            update=["name", "mobile", "email", "position", "gender", "enable", "qr_code", "departments", "ext"],
+        )
+        writer.register("org_employee_dept", ["userid", "dept_id"])
+        flt = ChangeFilter(cur, writer, "org", "employees", full)
+        try:
+            changed = flt.changed(users)
+            with writer:
+                for i in range(0, len(changed), writer.chunk_size):
+                    chunk = changed[i:i + writer.chunk_size]
+                    for userid in chunk:
+                        user = users[userid]
+                        # 旧部门关系的删除与重建、员工行、内容哈希在同一次 flush 的事务里提交
+                        writer.delete("org_employee_dept", ["userid"], [userid])
+                        writer.add("org_employee", (
+                            userid,
+                            user.get("name"),
+                            user.get("mobile"),
+                            user.get("email"),
+                            user.get("position"),
+                            user.get("gender"),
+                            user.get("enable"),
+                            user.get("qr_code"),
+                            json.dumps(user.get("department", [])),
+                            json.dumps(user, ensure_ascii=False),
+                        ))
+                        for dept_id in user.get("department", []):
+                            writer.add("org_employee_dept", (userid, dept_id))
+                        flt.mark(userid)
+                        upserted += 1
+                    writer.flush()
+                    sync_state.save_progress(cur, "org", "employees", done=upserted, total=len(changed))
+            sync_state.mark_ok(cur, "org", "employees", started)
+        except Exception as e:
+            sync_state.mark_err(cur, "org", "employees", e)
+            raise
+        finally:
+            # 负责人姓名等来自员工表，变更后让会员元数据缓存失效
+            if upserted:
+                bump_generation(GEN_MEMBERS)
+    return {"upserted": upserted, "skipped_unchanged": flt.skipped}
 
 
 def list_departments(page: int = 1, size: int = 50) -> dict:
@@ -1,78 +1,293 @@
 # -*- coding: utf-8 -*-
-import os, time, json, logging, threading
+"""
+企业微信统一 HTTP 客户端（唯一入口）：
+- 进程内共享 Session + 调优的 HTTPAdapter 连接池（复用 TLS 连接）
+- access_token 两级缓存：进程内 L1 + Redis L2（跨进程共享），按 corpid + secret 值的短哈希分键（轮换 secret 立即生效），
+  临近过期提前刷新，刷新加分布式锁（比较后删除）
+- errcode 感知重试：token 失效刷新重试、45009 限频退避、48009/48001 通讯录切换备用 secret；
+  5xx 与 -1（系统繁忙）只对 GET 重试——POST（如群发 add_msg_template）可能已被受理，重放会重复发送
+- 按 scope 分桶限流（contacts/ext/kf）
+"""
+import os, time, json, random, logging, threading, hashlib
 import requests
-import redis as _redis
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from redis.exceptions import RedisError
+
+from app.common.idempotency import acquire_lock, release_lock
+from app.common.ratelimit import TokenBucket
+from app.common.retry import expo_backoff
+from app.core.config import settings
+from app.core.redis import get_redis
 
 log = logging.getLogger(__name__)
-_session = requests.Session()
 
-def _r():
+QY_BASE = "https://qyapi.weixin.qq.com"
+
+# scope -> secret 环境变量名
+SCOPE_SECRETS = {
+    "contacts": "WECOM_CONTACTS_SECRET",
+    "ext": "WECOM_EXT_SECRET",
+    "kf": "WECOM_KF_SECRET",
+    "agent": "WECOM_AGENT_SECRET",
+}
+
+_SECRET_SCOPES = {v: k for k, v in SCOPE_SECRETS.items()}
+
+TOKEN_ERRCODES = (40014, 42001, 40001)
+RATE_LIMIT_ERRCODES = (45009,)     # 限频拒绝：请求未被受理，任何方法都可重试
+BUSY_ERRCODES = (-1,)              # 系统繁忙：可能已受理，只对 GET 重试
+FALLBACK_ERRCODES = (48009, 48001)
+
+_TOKEN_REFRESH_AHEAD_S = int(os.getenv("WECOM_TOKEN_REFRESH_AHEAD_S", "300"))
+_TOKEN_LOCK_TTL_S = 10
+
+
+# -------------------------
+# HTTP 连接池
+# -------------------------
+def _build_session() -> requests.Session:
+    s = requests.Session()
+    # 仅对“连接建立失败”做传输层重试（此时请求未发出，POST 也安全）；5xx/errcode 由下方业务重试处理
+    retry = Retry(total=2, connect=2, read=0, status=0, other=0, backoff_factor=0.3)
+    adapter = HTTPAdapter(
+        pool_connections=int(os.getenv("WECOM_HTTP_POOL_CONNECTIONS", "4")),
+        pool_maxsize=int(os.getenv("WECOM_HTTP_POOL_MAXSIZE", "32")),
+        max_retries=retry,
+    )
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+_session = _build_session()
+
+
+# -------------------------
+# 限流：按 scope 分桶（contacts/ext/kf 各自独立），避免通讯录同步把客服同步饿死
+# 可用 WECOM_PULL_QPS_<SCOPE> / WECOM_PULL_BURST_<SCOPE> 单独覆盖，否则取全局 WECOM_PULL_QPS / WECOM_PULL_BURST
+# -------------------------
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def _limiter(scope: str) -> TokenBucket:
+    lim = _limiters.get(scope)
+    if lim is None:
+        with _limiters_lock:
+            lim = _limiters.get(scope)
+            if lim is None:
+                suffix = scope.upper()
+                qps = float(os.getenv(f"WECOM_PULL_QPS_{suffix}", os.getenv("WECOM_PULL_QPS", 8)))
+                burst = float(os.getenv(f"WECOM_PULL_BURST_{suffix}", os.getenv("WECOM_PULL_BURST", 16)))
+                lim = TokenBucket(f"wec:rl:pull:{scope}", qps, burst)
+                _limiters[scope] = lim
+    return lim
+
+def _throttle(scope: str):
     try:
-        return _redis.Redis(host=os.getenv("REDIS_HOST","127.0.0.1"),
-                            port=int(os.getenv("REDIS_PORT","6379")),
-                            db=int(os.getenv("REDIS_DB","0")),
-                            decode_responses=True)
-    except Exception:
-        return None
+        _limiter(scope).acquire()
+    except RedisError as e:
+        # Redis 不可用时放行，不阻塞同步主流程
+        log.warning("wecom throttle skipped scope=%s err=%s", scope, e)
+
 
-def _token_bucket(key="wec:rl:pull", qps=8, burst=16):
-    r = _r()
-    if not r: return True
-    now = int(time.time())
-    cap = int(os.getenv("WECOM_PULL_BURST", burst))
-    rate = float(os.getenv("WECOM_PULL_QPS", qps))
-    tokens = float(r.get(key+":tokens") or cap)
-    ts = int(r.get(key+":ts") or now)
-    tokens = min(cap, tokens + (now - ts) * rate)
-    if tokens < 1:
-        time.sleep(1.0/max(rate,1))
-        return _token_bucket(key, qps, burst)
-    pipe = r.pipeline(True)
-    pipe.set(key+":tokens", tokens - 1)
-    pipe.set(key+":ts", now)
-    pipe.execute()
-    return True
-
-_token_cache = {}
+# -------------------------
+# access_token：L1（进程内）+ L2（Redis）
+# -------------------------
+_token_cache = {}  # _token_key(...) -> {"val": token, "exp": epoch}
 _lock = threading.Lock()
 
-def get_access_token(scope="contacts"):
+def _token_key(secret_env_key: str) -> str:
+    """键里带 secret 值的短哈希（不落明文）：secret 轮换后旧 token 不再命中。"""
+    digest = hashlib.sha256(os.getenv(secret_env_key, "").encode("utf-8")).hexdigest()[:12]
+    return f"wec:token:{os.getenv('WECOM_CORP_ID', '')}:{secret_env_key}:{digest}"
+
+def _l1_get(secret_env_key: str):
+    with _lock:
+        return _token_cache.get(_token_key(secret_env_key))
+
+def _l1_set(secret_env_key: str, info: dict):
     with _lock:
-        info = _token_cache.get(scope)
-        if info and info["exp"] > time.time():
-            return info["val"]
-    corpid = os.getenv("WECOM_CORP_ID")
-    if scope == "contacts":
-        secret = os.getenv("WECOM_CONTACTS_SECRET")
-    elif scope == "kf":
-        secret = os.getenv("WECOM_KF_SECRET")
-    else:
-        secret = os.getenv("WECOM_EXT_SECRET")
-    url = "https://qyapi.weixin.qq.com/cgi-bin/gettoken"
-    _token_bucket()
-    resp = _session.get(url, params={"corpid": corpid, "corpsecret": secret}, timeout=(5,15))
+        _token_cache[_token_key(secret_env_key)] = info
+
+def _l2_get(secret_env_key: str):
+    try:
+        raw = get_redis().get(_token_key(secret_env_key))
+    except RedisError as e:
+        log.warning("wecom token L2 read failed: %s", e)
+        return None
+    if not raw:
+        return None
+    try:
+        info = json.loads(raw)
+        return {"val": info["val"], "exp": float(info["exp"])}
+    except Exception:
+        return None
+
+def _fetch_token(secret_env_key: str) -> dict:
+    corpid = os.getenv("WECOM_CORP_ID"); secret = os.getenv(secret_env_key)
+    if not (corpid and secret):
+        raise RuntimeError(f"missing env WECOM_CORP_ID or {secret_env_key}")
+    # gettoken 同样计入该 secret 所属 scope 的拉取限流桶
+    _throttle(_SECRET_SCOPES.get(secret_env_key, secret_env_key.lower()))
+    resp = _session.get(f"{QY_BASE}/cgi-bin/gettoken",
+                        params={"corpid": corpid, "corpsecret": secret}, timeout=(5, 15))
+    resp.raise_for_status()
     data = resp.json()
     if data.get("errcode") != 0:
-        raise RuntimeError(f"gettoken failed: {data}")
-    _token_cache[scope] = {"val": data["access_token"], "exp": time.time()+3600}
-    return data["access_token"]
+        raise RuntimeError(f"gettoken failed: secret={secret_env_key} data={data}")
+    expires_in = int(data.get("expires_in", 7200))
+    info = {"val": data["access_token"], "exp": time.time() + expires_in}
+    _l1_set(secret_env_key, info)
+    try:
+        get_redis().set(_token_key(secret_env_key), json.dumps(info), ex=max(60, expires_in))
+    except RedisError as e:
+        log.warning("wecom token L2 write failed: %s", e)
+    return info
+
+def _fresh(info, now: float) -> bool:
+    return bool(info) and info["exp"] - now > _TOKEN_REFRESH_AHEAD_S
+
+def _usable(info, now: float) -> bool:
+    return bool(info) and info["exp"] - now > 5
+
+def get_token_by_secret(secret_env_key: str) -> str:
+    now = time.time()
+    info = _l1_get(secret_env_key)
+    if _fresh(info, now):
+        return info["val"]
+    l2 = _l2_get(secret_env_key)
+    if _fresh(l2, now):
+        _l1_set(secret_env_key, l2)
+        return l2["val"]
+    current = l2 if _usable(l2, now) else (info if _usable(info, now) else None)
+
+    # 需要刷新：同一时刻只让一个进程去 gettoken
+    lock_key = _token_key(secret_env_key) + ":lock"
+    try:
+        lock_token = acquire_lock(lock_key, _TOKEN_LOCK_TTL_S)
+        got_lock = lock_token is not None
+    except RedisError:
+        lock_token, got_lock = None, True
+    if got_lock:
+        try:
+            return _fetch_token(secret_env_key)["val"]
+        except Exception:
+            # 提前刷新失败但旧 token 仍有效时继续用旧的
+            if current:
+                log.exception("wecom token refresh-ahead failed, keep current token")
+                return current["val"]
+            raise
+        finally:
+            if lock_token:
+                try:
+                    release_lock(lock_key, lock_token)
+                except RedisError:
+                    pass
+    if current:
+        # 其他进程正在刷新，旧 token 仍在有效期内
+        return current["val"]
+    deadline = time.monotonic() + _TOKEN_LOCK_TTL_S
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        l2 = _l2_get(secret_env_key)
+        if _usable(l2, time.time()):
+            _l1_set(secret_env_key, l2)
+            return l2["val"]
+    return _fetch_token(secret_env_key)["val"]
+
+def invalidate_token(secret_env_key: str, token: str):
+    """token 被企业微信判定失效时清理两级缓存（只清与失效值相同的，避免误删他人刚刷新的新 token）。"""
+    with _lock:
+        info = _token_cache.get(_token_key(secret_env_key))
+        if info and info["val"] == token:
+            _token_cache.pop(_token_key(secret_env_key), None)
+    l2 = _l2_get(secret_env_key)
+    if l2 and l2["val"] == token:
+        try:
+            get_redis().delete(_token_key(secret_env_key))
+        except RedisError:
+            pass
+
+def get_access_token(scope="contacts"):
+    return get_token_by_secret(SCOPE_SECRETS.get(scope, scope))
+
+
+# -------------------------
+# 请求与重试
+# -------------------------
+def _scope_for_path(path: str) -> str:
+    if "/cgi-bin/externalcontact/" in path:
+        return "ext"
+    if "/cgi-bin/kf/" in path:
+        return "kf"
+    return "contacts"
+
+def _sleep_backoff(i, cap=8.0):
+    time.sleep(min(cap, expo_backoff(i, settings.retry_backoff_base, 0.8)) + random.random() * 0.3)
+
+def request_json(method: str, path: str, scope: str | None = None,
+                 params: dict | None = None, body: dict | None = None,
+                 secret_env_key: str | None = None,
+                 fallback_secret_env_key: str | None = None,
+                 max_retry: int | None = None) -> dict:
+    """
+    path 可为完整 URL 或以 / 开头的相对路径。
+    scope 决定限流桶与默认 secret；secret_env_key 显式指定时优先。
+    """
+    method = method.upper()
+    url = path if path.startswith("http") else f"{QY_BASE}{path}"
+    scope = scope or _scope_for_path(url)
+    use_key = secret_env_key or SCOPE_SECRETS.get(scope, SCOPE_SECRETS["contacts"])
+    if fallback_secret_env_key is None and scope == "contacts" and not secret_env_key:
+        fallback_secret_env_key = SCOPE_SECRETS["agent"]
+    max_retry = settings.retry_max if max_retry is None else max_retry
+    retry = 0; switched = False
+
+    while True:
+        token = get_token_by_secret(use_key)
+        q = dict(params or {}); q["access_token"] = token
+        _throttle(scope)
+        try:
+            if method == "GET":
+                resp = _session.get(url, params=q, timeout=(5, 30))
+            else:
+                resp = _session.post(url, params=q, json=body or {}, timeout=(5, 30))
+        except (requests.ConnectionError, requests.Timeout):
+            # POST 超时可能已被受理（如群发），不自动重放
+            if method != "GET" or retry >= max_retry:
+                raise
+            _sleep_backoff(retry); retry += 1; continue
+
+        if resp.status_code >= 500:
+            # 网关 5xx 时 POST 可能已被受理，同超时一样不自动重放
+            if method != "GET" or retry >= max_retry: resp.raise_for_status()
+            _sleep_backoff(retry); retry += 1; continue
+
+        data = resp.json(); ec = data.get("errcode", 0)
+        if ec == 0:
+            return data
+
+        if ec in TOKEN_ERRCODES:
+            if retry >= max_retry:
+                raise RuntimeError(f"token error: path={path} use_key={use_key} params={params} data={data}")
+            invalidate_token(use_key, token)
+            retry += 1; continue
+
+        if ec in FALLBACK_ERRCODES and not switched \
+           and fallback_secret_env_key and os.getenv(fallback_secret_env_key):
+            use_key = fallback_secret_env_key; switched = True
+            retry += 1; continue
+
+        if ec in RATE_LIMIT_ERRCODES or (ec in BUSY_ERRCODES and method == "GET"):
+            if retry >= max_retry:
+                raise RuntimeError(f"rate limit: path={path} use_key={use_key} params={params} data={data}")
+            _sleep_backoff(retry); retry += 1; continue
+
+        # 关键：把 path/params/secret 一起打出来
+        raise RuntimeError(f"wecom {method} error: path={path} use_key={use_key} params={params} data={data}")
 
 def wecom_get_json(path, scope="contacts", params=None):
-    if params is None: params = {}
-    params["access_token"] = get_access_token(scope)
-    _token_bucket()
-    r = _session.get(path, params=params, timeout=(5,30))
-    data = r.json()
-    if data.get("errcode") != 0:
-        raise RuntimeError(f"wecom GET error: {data}")
-    return data
+    return request_json("GET", path, scope=scope, params=params)
 
 def wecom_post_json(path, scope="ext", params=None, body=None):
-    if params is None: params = {}
-    params["access_token"] = get_access_token(scope)
-    _token_bucket()
-    r = _session.post(path, params=params, json=body or {}, timeout=(5,30))
-    data = r.json()
-    if data.get("errcode") != 0:
-        raise RuntimeError(f"wecom POST error: {data}")
-    return data
+    return request_json("POST", path, scope=scope, params=params, body=body)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+回调事件消费者（Redis Stream 消费组）：
+    python -m app.wecom.consumer [consumer_name]
+- XREADGROUP 阻塞 WECOM_CB_BLOCK_MS 毫秒等首条消息，再在 WECOM_CB_WINDOW_MS 窗口内攒到最多 WECOM_CB_BATCH 条
+- 先 XAUTOCLAIM 接管其他消费者挂掉后遗留的超时消息
+- 整批落库失败时按客户拆成单条事务重试，坏消息不拖累整批；单条消息失败超过 _MAX_FAILS 次转入死信流后 ACK
+- 死信修复后用 replay_dead 重新投回主流（后台任务：POST /api/v1/jobs/callbacks/replay）
+"""
+import json
+import logging
+import os
+import socket
+import time
+from typing import List, Tuple
+
+from redis.exceptions import RedisError, ResponseError
+
+from app.core.config import settings
+from app.core.db import get_mysql_conn
+from app.core.redis import get_redis
+from app.wecom import events
+
+log = logging.getLogger(__name__)
+
+_CLAIM_IDLE_MS = 60_000
+_MAX_FAILS = 5
+_FAILS_KEY = "wecom:cb:fails"
+
+
+def ensure_group(r):
+    try:
+        r.xgroup_create(events.STREAM, events.GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _decode(entries) -> Tuple[List[Tuple[str, dict]], List[str]]:
+    """返回 ([(msg_id, event)], 无法解析的 msg_id)。"""
+    good, bad = [], []
+    for msg_id, fields in entries or []:
+        try:
+            good.append((msg_id, json.loads(fields["ev"])))
+        except (KeyError, TypeError, ValueError):
+            bad.append(msg_id)
+    return good, bad
+
+
+def _apply(msgs: List[Tuple[str, dict]]) -> events.Bits:
+    fresh, keys = events.unseen(ev for _, ev in msgs)
+    if not fresh:
+        return []
+    with get_mysql_conn() as conn:
+        bits = events.apply_batch(conn, fresh)
+    # apply_batch 已提交；此后崩溃最多导致重投后重复执行幂等语句，不会丢事件
+    events.mark_seen(keys)
+    return bits
+
+
+def _fail(r, msgs: List[Tuple[str, dict]], err: Exception) -> List[str]:
+    """记失败次数；超过上限的转死信，返回可以 ACK 的 msg_id。"""
+    dead = []
+    for msg_id, ev in msgs:
+        n = r.hincrby(_FAILS_KEY, msg_id, 1)
+        if n >= _MAX_FAILS:
+            r.xadd(events.DEAD, {"id": msg_id, "ev": json.dumps(ev, ensure_ascii=False), "err": str(err)[:500]},
+                   maxlen=100_000, approximate=True)
+            r.hdel(_FAILS_KEY, msg_id)
+            dead.append(msg_id)
+    return dead
+
+
+def process(r, entries) -> dict:
+    """处理一批 Stream 消息并 ACK；返回计数。"""
+    msgs, bad = _decode(entries)
+    ack = list(bad)
+    bits: events.Bits = []
+    failed = 0
+    try:
+        bits += _apply(msgs)
+        ack += [msg_id for msg_id, _ in msgs]
+    except Exception as e:
+        log.warning("callback batch failed, retry per contact: %s", e)
+        by_contact = {}
+        for msg_id, ev in msgs:
+            by_contact.setdefault(ev.get("external_userid"), []).append((msg_id, ev))
+        for group in by_contact.values():
+            try:
+                bits += _apply(group)
+                ack += [msg_id for msg_id, _ in group]
+            except Exception as e1:
+                log.exception("callback events failed external_userid=%s", group[0][1].get("external_userid"))
+                failed += len(group)
+                ack += _fail(r, group, e1)
+    if bits:
+        events.after_commit(bits)
+    if ack:
+        r.xack(events.STREAM, events.GROUP, *ack)
+    return {"read": len(entries or []), "acked": len(ack), "failed": failed}
+
+
+def read_window(r, consumer: str, batch: int, block_ms: int, window_ms: int) -> list:
+    """
+    先阻塞等第一条消息，之后在 window_ms 内继续攒，直到凑满 batch 条；
+    标签批量变更时一个窗口内的事件会被 TagDeltaAggregator 合并成少量多行语句。
+    """
+    entries = []
+    resp = r.xreadgroup(events.GROUP, consumer, {events.STREAM: ">"}, count=batch, block=block_ms)
+    for _, items in resp or []:
+        entries += items
+    deadline = time.monotonic() + window_ms / 1000.0
+    while entries and len(entries) < batch:
+        left_ms = int((deadline - time.monotonic()) * 1000)
+        if left_ms <= 0:
+            break
+        resp = r.xreadgroup(events.GROUP, consumer, {events.STREAM: ">"}, count=batch - len(entries), block=left_ms)
+        got = [e for _, items in resp or [] for e in items]
+        if not got:
+            break
+        entries += got
+    return entries
+
+
+def replay_dead(limit: int = 1000) -> dict:
+    """把死信流里最早的 limit 条事件重新投回主流并从死信流删除；去重标记只在批次提交后写入，进死信的事件从未写过标记，重放时不会被跳过。"""
+    r = get_redis()
+    entries = r.xrange(events.DEAD, count=limit)
+    replayed = 0
+    for msg_id, fields in entries:
+        try:
+            events.enqueue(json.loads(fields["ev"]), r)
+            replayed += 1
+        except (KeyError, TypeError, ValueError):
+            pass
+        r.xdel(events.DEAD, msg_id)
+    return {"replayed": replayed, "dropped": len(entries) - replayed, "left": int(r.xlen(events.DEAD))}
+
+
+def run(consumer: str | None = None, once: bool = False):
+    r = get_redis()
+    ensure_group(r)
+    consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+    batch, block_ms = settings.wecom_cb_batch, settings.wecom_cb_block_ms
+    while True:
+        try:
+            # 接管超时未 ACK 的消息（消费者崩溃 / 落库失败待重试）
+            _, claimed, *_ = r.xautoclaim(events.STREAM, events.GROUP, consumer,
+                                          min_idle_time=_CLAIM_IDLE_MS, start_id="0-0", count=batch)
+            if claimed:
+                process(r, claimed)
+            entries = read_window(r, consumer, batch, block_ms, settings.wecom_cb_window_ms)
+            if entries:
+                process(r, entries)
+        except RedisError as e:
+            log.warning("callback consumer redis error: %s", e)
+            time.sleep(1)
+        if once:
+            return
+
+
+if __name__ == "__main__":
+    import sys
+    run(sys.argv[1] if len(sys.argv) > 1 else None)
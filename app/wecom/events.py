@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+外部联系人回调事件：入队（Redis Stream）与批量落库。
+- 回调入口只做校验 + XADD，立即返回；落库交给 app/wecom/consumer.py 的消费组 worker
+- 一批事件按 external_userid 归并：同一客户的事件保持到达顺序，连续重复的 add/edit 只保留最后一条
+- 去重：事件指纹（Event/ExternalUserID/FromUserName/CreateTime/Detail）落库前只查、事务提交后才标记，
+  企业微信重试不重复落库；worker 在提交前被杀时消息重投后仍会处理（至少一次，落库语句本身幂等）
+- 标签变更经 TagDeltaAggregator 合并为每个客户的净增删，多行语句写入
+- 整批在一个事务里提交；成功后统一更新人群位图并 bump 会员缓存代际
+"""
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+from app.common.cache import GEN_MEMBERS, bump_generation
+from app.core.config import settings
+from app.core.redis import get_redis
+from app.members import audience
+
+log = logging.getLogger(__name__)
+
+STREAM = "wecom:cb:stream"
+GROUP = "wecom:cb:workers"
+DEAD = "wecom:cb:dead"
+
+_SEEN_TTL_S = 86400
+_COLLAPSIBLE = ("add_external_contact", "edit_external_contact")
+
+Bits = List[Tuple[str, str, bool]]  # 人群位图增量：(external_userid, 位图名, 置位)
+
+
+# -------------------------
+# 解析 / 入队
+# -------------------------
+def normalize(payload: dict) -> dict | None:
+    """取出落库需要的字段；缺 Event 或 ExternalUserID 返回 None。"""
+    event = (payload.get("Event") or "").strip()
+    ext_id = (payload.get("ExternalUserID") or "").strip()
+    if not event or not ext_id:
+        return None
+    try:
+        create_ts = int(payload.get("CreateTime"))
+    except (TypeError, ValueError):
+        create_ts = int(time.time())
+    return {
+        "event": event,
+        "external_userid": ext_id,
+        "from_user": (payload.get("FromUserName") or "").strip(),
+        "detail": payload.get("Detail"),
+        "create_ts": create_ts,
+    }
+
+
+def fingerprint(ev: dict) -> str:
+    raw = json.dumps(
+        [ev["event"], ev["external_userid"], ev["from_user"], ev["create_ts"], ev.get("detail")],
+        ensure_ascii=False, sort_keys=True, default=str,
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def enqueue(ev: dict, r=None) -> str:
+    """XADD 到持久化 Stream（近似 MAXLEN 截断），返回消息 id。"""
+    r = r or get_redis()
+    return r.xadd(
+        STREAM,
+        {"ev": json.dumps(ev, ensure_ascii=False, default=str)},
+        maxlen=settings.wecom_cb_stream_maxlen,
+        approximate=True,
+    )
+
+
+# -------------------------
+# 归并 / 去重
+# -------------------------
+def coalesce(events: Iterable[dict]) -> Dict[str, List[dict]]:
+    """按 external_userid 分组（保持首次出现顺序与组内到达顺序），连续重复的 add/edit 合并为最后一条。"""
+    groups: Dict[str, List[dict]] = OrderedDict()
+    for ev in events:
+        seq = groups.setdefault(ev["external_userid"], [])
+        if seq and ev["event"] in _COLLAPSIBLE and seq[-1]["event"] == ev["event"] \
+                and seq[-1]["from_user"] == ev["from_user"]:
+            merged = dict(ev)
+            if merged.get("detail") is None:
+                merged["detail"] = seq[-1].get("detail")
+            seq[-1] = merged
+        else:
+            seq.append(ev)
+    return groups
+
+
+def _seen_key(ev: dict) -> str:
+    return f"wecom:cb:seen:{fingerprint(ev)}"
+
+
+def unseen(events: Iterable[dict]) -> Tuple[List[dict], List[str]]:
+    """
+    过滤已落库过的事件（批内重复也去掉），只读不写；返回 (待处理事件, 对应的去重 key)。
+    去重 key 在事务提交后由 mark_seen 写入，提交前进程崩溃不会留下"已处理"的假标记。
+    """
+    pending = OrderedDict()
+    for ev in events:
+        pending.setdefault(_seen_key(ev), ev)
+    if not pending:
+        return [], []
+    keys = list(pending)
+    seen = get_redis().mget(keys)
+    keys = [k for k, v in zip(keys, seen) if v is None]
+    return [pending[k] for k in keys], keys
+
+
+def mark_seen(keys: List[str]):
+    if not keys:
+        return
+    pipe = get_redis().pipeline(transaction=False)
+    for key in keys:
+        pipe.set(key, "1", ex=_SEEN_TTL_S)
+    pipe.execute()
+
+
+# -------------------------
+# 标签增量合并
+# -------------------------
+class TagDeltaAggregator:
+    """
+    把一个窗口内的 change_external_tag 事件合并成每个客户的净增删：
+    同一 (客户, 标签) 以最后一次操作为准（同一事件里先加后删，与逐条落库的结果一致）。
+    apply() 用多行 INSERT IGNORE / 行构造器 DELETE 落库，并返回对应的人群位图增量。
+    """
+
+    def __init__(self, chunk_size: int = 500):
+        self.chunk_size = chunk_size
+        self._net: Dict[str, Dict[str, bool]] = OrderedDict()
+        self.events = 0
+
+    def add(self, ext_id: str, add: Iterable[str] = (), remove: Iterable[str] = ()):
+        tags = self._net.setdefault(ext_id, OrderedDict())
+        for t in add:
+            if t:
+                tags[t] = True
+        for t in remove:
+            if t:
+                tags[t] = False
+        self.events += 1
+
+    def add_event(self, ev: dict):
+        detail = ev.get("detail") or {}
+        self.add(ev["external_userid"], detail.get("add") or [], detail.get("remove") or [])
+
+    def deltas(self) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+        adds, removes = [], []
+        for ext_id, tags in self._net.items():
+            for t, on in tags.items():
+                (adds if on else removes).append((ext_id, t))
+        return adds, removes
+
+    def __len__(self):
+        return sum(len(tags) for tags in self._net.values())
+
+    def apply(self, cur) -> Bits:
+        adds, removes = self.deltas()
+        for i in range(0, len(adds), self.chunk_size):
+            # 纯 %s 占位符，PyMySQL 会改写为一条多行 VALUES
+            cur.executemany(
+                "INSERT IGNORE INTO wecom_ops.ext_contact_tag (external_userid, tag_id) VALUES (%s, %s)",
+                adds[i:i + self.chunk_size],
+            )
+        for i in range(0, len(removes), self.chunk_size):
+            part = removes[i:i + self.chunk_size]
+            cur.execute(
+                "DELETE FROM wecom_ops.ext_contact_tag WHERE (external_userid, tag_id) IN ("
+                + ",".join(["(%s, %s)"] * len(part)) + ")",
+                [x for pair in part for x in pair],
+            )
+        self._net.clear()
+        self.events = 0
+        return [(e, f"tag:{t}", True) for e, t in adds] + [(e, f"tag:{t}", False) for e, t in removes]
+
+
+# -------------------------
+# 落库
+# -------------------------
+def _mark_unassigned(cur, ext_id: str, reason: str):
+    cur.execute(
+        "UPDATE wecom_ops.ext_contact SET is_unassigned=1, updated_at=NOW() WHERE external_userid=%s",
+        (ext_id,),
+    )
+    cur.execute(
+        """
+        INSERT INTO wecom_ops.ext_unassigned (external_userid, is_active, reason, created_at, updated_at)
+        VALUES (%s, 1, %s, NOW(), NOW())
+        ON DUPLICATE KEY UPDATE
+          is_active=VALUES(is_active),
+          reason=VALUES(reason),
+          updated_at=VALUES(updated_at)
+        """,
+        (ext_id, reason),
+    )
+
+
+def apply_event(cur, ev: dict) -> Bits:
+    """
+    单条事件的落库语句。ext_contact 存在性由 apply_batch 统一多行写入；
+    change_external_tag 不在这里处理，由 TagDeltaAggregator 合并后整批写入。
+    """
+    event, ext_id = ev["event"], ev["external_userid"]
+    from_user, detail = ev["from_user"], ev.get("detail")
+    bits: Bits = []
+
+    if event in _COLLAPSIBLE:
+        dj = json.dumps(detail, ensure_ascii=False) if detail is not None else None
+        cur.execute(
+            """
+            UPDATE wecom_ops.ext_contact
+               SET is_deleted=0, is_unassigned=0,
+                   detail_json=COALESCE(%s, detail_json), updated_at=NOW()
+             WHERE external_userid=%s
+            """,
+            (dj, ext_id),
+        )
+        if from_user:
+            cur.execute(
+                "INSERT IGNORE INTO wecom_ops.ext_contact_follow (external_userid, userid) VALUES (%s, %s)",
+                (ext_id, from_user),
+            )
+        cur.execute(
+            """
+            UPDATE wecom_ops.ext_unassigned
+               SET is_active=0,
+                   handover_userid=COALESCE(%s, handover_userid),
+                   updated_at=NOW()
+             WHERE external_userid=%s
+            """,
+            (from_user or None, ext_id),
+        )
+        bits += [(ext_id, "unassigned", False), (ext_id, "pool", False)]
+
+    elif event == "del_external_contact":
+        if from_user:
+            cur.execute(
+                "DELETE FROM wecom_ops.ext_contact_follow WHERE external_userid=%s AND userid=%s",
+                (ext_id, from_user),
+            )
+        cur.execute(
+            "SELECT COUNT(*) AS total FROM wecom_ops.ext_contact_follow WHERE external_userid=%s",
+            (ext_id,),
+        )
+        if not int((cur.fetchone() or {}).get("total") or 0):
+            _mark_unassigned(cur, ext_id, "del_external_contact")
+            bits += [(ext_id, "unassigned", True), (ext_id, "pool", True)]
+
+    elif event == "transfer_fail":
+        _mark_unassigned(cur, ext_id, "transfer_fail")
+        bits += [(ext_id, "unassigned", True), (ext_id, "pool", True)]
+
+    if event in _COLLAPSIBLE or event == "del_external_contact":
+        # 提交后按会员数据源重算 member/负责人/门店/品牌位
+        bits.append((ext_id, audience.REINDEX, True))
+    return bits
+
+
+def apply_batch(conn, events: List[dict]) -> Bits:
+    """一个事务落一批事件；ext_contact 存在性与 updated_at 用一条多行 UPSERT 完成。"""
+    groups = coalesce(events)
+    if not groups:
+        return []
+    bits: Bits = []
+    cur = conn.cursor()
+    conn.begin()
+    try:
+        ids = list(groups)
+        cur.execute(
+            "INSERT INTO wecom_ops.ext_contact (external_userid, is_deleted, updated_at) VALUES "
+            + ",".join(["(%s, 0, NOW())"] * len(ids))
+            + " ON DUPLICATE KEY UPDATE updated_at=NOW()",
+            ids,
+        )
+        tags = TagDeltaAggregator()
+        for seq in groups.values():
+            for ev in seq:
+                if ev["event"] == "change_external_tag":
+                    tags.add_event(ev)
+                else:
+                    bits += apply_event(cur, ev)
+        # 标签表与其他事件涉及的表互不影响，合并后放在同一事务最后写
+        bits += tags.apply(cur)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return bits
+
+
+def after_commit(bits: Bits):
+    audience.set_bits(bits)
+    bump_generation(GEN_MEMBERS)
@@ -1,15 +1,24 @@
 # app/wecom/routes_v1.py
 from __future__ import annotations
 
-import json
+import logging
+import os
 import re
-import time
 import traceback
 from typing import Any, Iterable, List, Tuple
 
 from flask import Blueprint, request, jsonify, g
+from redis.exceptions import RedisError
 
-from app.core.db import get_mysql_conn
+from app.common.cache import GEN_MEMBERS, bump_generation
+from app.core.config import settings
+from app.core.db import get_mysql_conn, use_replica
+from app.group import service as group_service
+from app.members import audience, profile
+from app.wecom import events
+from app.wecom.signature import verify_callback_signature
+
+log = logging.getLogger(__name__)
 
 bp = Blueprint("wecom_v1", __name__, url_prefix="/api/v1/wecom")
 
@@ -23,6 +32,11 @@ def _ok(data: Any, code: int = 200):
     return resp, code
 
 
+def _debug() -> bool:
+    """X-Wecom-Debug:1 只有在 WECOM_CALLBACK_DEBUG=1 时才生效，生产环境的请求头无法绕过验签。"""
+    return settings.wecom_callback_debug and request.headers.get("X-Wecom-Debug") == "1"
+
+
 def _bad(msg: str, code: int = 400, detail: str = ""):
     resp = jsonify({"ok": False, "error": {"code": "BAD_REQUEST", "message": msg, "detail": detail}})
     resp.headers["X-Request-Id"] = getattr(g, "trace_id", "")
@@ -127,153 +141,48 @@ def wecom_verify():
 
 @bp.post("/callback")
 def wecom_callback():
-    debug = request.headers.get("X-Wecom-Debug") == "1"
+    """
+    校验签名后写入 Redis Stream 立即返回，由 app/wecom/consumer.py 批量落库。
+    - 调试（WECOM_CALLBACK_DEBUG=1 且 X-Wecom-Debug:1）跳过签名并同步落库，便于本地验证
+    - 签名覆盖包体里的密文 <Encrypt>，见 app/wecom/signature.py
+    - Redis 不可用时降级为同步落库，不丢事件
+    - 客户群变更（change_external_chat）只标记该群待重拉，由 sync_groupchats(changed_only=True) 处理
+    """
+    debug = _debug()
+    if not debug and os.getenv("WECOM_CALLBACK_TOKEN"):
+        ok, _ = verify_callback_signature(request)
+        if not ok:
+            return _err("invalid signature", 403)
     try:
         payload = request.get_json(force=True, silent=False) or {}
     except Exception as e:
         return _bad("invalid json", 400, str(e))
 
-    event = (payload.get("Event") or "").strip()
-    ext_id = (payload.get("ExternalUserID") or "").strip()
-    detail = payload.get("Detail")
-    from_user = (payload.get("FromUserName") or "").strip()
-    create_ts = _parse_int(payload.get("CreateTime"), int(time.time()))
+    if payload.get("Event") == "change_external_chat":
+        chat_id = (payload.get("ChatId") or "").strip()
+        if not chat_id:
+            return _bad("missing ChatId", 400)
+        try:
+            group_service.mark_dirty(chat_id)
+        except RedisError as e:
+            return _err(_ex_text(e), 500)
+        return _ok({"event": "change_external_chat", "chat_id": chat_id, "debug": debug})
 
-    if not event or not ext_id:
+    ev = events.normalize(payload)
+    if ev is None:
         return _bad("missing Event or ExternalUserID", 400)
+    result = {"event": ev["event"], "external_userid": ev["external_userid"], "debug": debug}
 
+    if not debug:
+        try:
+            return _ok({**result, "queued": events.enqueue(ev)})
+        except RedisError as e:
+            log.warning("callback enqueue failed, apply inline: %s", e)
     try:
         with get_mysql_conn() as conn:
-            cur = conn.cursor()
-
-            # 基础存在性
-            _exec(
-                cur,
-                """
-                INSERT INTO wecom_ops.ext_contact (external_userid, is_deleted, updated_at)
-                VALUES (%s, 0, NOW())
-                ON DUPLICATE KEY UPDATE updated_at=NOW()
-                """,
-                (ext_id,),
-            )
-
-            if event in ("add_external_contact", "edit_external_contact"):
-                _exec(
-                    cur,
-                    """
-                    UPDATE wecom_ops.ext_contact
-                       SET is_deleted=0,
-                           is_unassigned=0,
-                           updated_at=NOW()
-                     WHERE external_userid=%s
-                    """,
-                    (ext_id,),
-                )
-                if from_user:
-                    _exec(
-                        cur,
-                        "INSERT IGNORE INTO wecom_ops.ext_contact_follow (external_userid, userid) VALUES (%s, %s)",
-                        (ext_id, from_user),
-                    )
-                if detail is not None:
-                    try:
-                        dj = json.dumps(detail, ensure_ascii=False)
-                        _exec(
-                            cur,
-                            "UPDATE wecom_ops.ext_contact SET detail_json=%s, updated_at=NOW() WHERE external_userid=%s",
-                            (dj, ext_id),
-                        )
-                    except Exception:
-                        pass
-                _exec(
-                    cur,
-                    """
-                    UPDATE wecom_ops.ext_unassigned
-                       SET is_active=0,
-                           handover_userid=COALESCE(%s, handover_userid),
-                           updated_at=NOW()
-                     WHERE external_userid=%s
-                    """,
-                    (from_user or None, ext_id),
-                )
-
-            elif event == "del_external_contact":
-                if from_user:
-                    _exec(
-                        cur,
-                        "DELETE FROM wecom_ops.ext_contact_follow WHERE external_userid=%s AND userid=%s",
-                        (ext_id, from_user),
-                    )
-                left = _fetch_one_value(
-                    cur,
-                    "SELECT COUNT(*) AS total FROM wecom_ops.ext_contact_follow WHERE external_userid=%s",
-                    (ext_id,),
-                    0,
-                )
-                if left and int(left) > 0:
-                    _exec(cur, "UPDATE wecom_ops.ext_contact SET updated_at=NOW() WHERE external_userid=%s", (ext_id,))
-                else:
-                    _exec(
-                        cur,
-                        "UPDATE wecom_ops.ext_contact SET is_unassigned=1, updated_at=NOW() WHERE external_userid=%s",
-                        (ext_id,),
-                    )
-                    _exec(
-                        cur,
-                        """
-                        INSERT INTO wecom_ops.ext_unassigned (external_userid, is_active, reason, created_at, updated_at)
-                        VALUES (%s, 1, %s, NOW(), NOW())
-                        ON DUPLICATE KEY UPDATE
-                          is_active=VALUES(is_active),
-                          reason=VALUES(reason),
-                          updated_at=VALUES(updated_at)
-                        """,
-                        (ext_id, "del_external_contact"),
-                    )
-
-            elif event == "transfer_fail":
-                _exec(
-                    cur,
-                    "UPDATE wecom_ops.ext_contact SET is_unassigned=1, updated_at=NOW() WHERE external_userid=%s",
-                    (ext_id,),
-                )
-                _exec(
-                    cur,
-                    """
-                    INSERT INTO wecom_ops.ext_unassigned (external_userid, is_active, reason, created_at, updated_at)
-                    VALUES (%s, 1, %s, NOW(), NOW())
-                    ON DUPLICATE KEY UPDATE
-                      is_active=VALUES(is_active),
-                      reason=VALUES(reason),
-                      updated_at=VALUES(updated_at)
-                    """,
-                    (ext_id, "transfer_fail"),
-                )
-
-            elif event == "change_external_tag":
-                add = (detail or {}).get("add") or []
-                rmv = (detail or {}).get("remove") or []
-                add = [t for t in add if t]
-                rmv = [t for t in rmv if t]
-                if add:
-                    cur.executemany(
-                        "INSERT IGNORE INTO wecom_ops.ext_contact_tag (external_userid, tag_id) VALUES (%s, %s)",
-                        [(ext_id, t) for t in add],
-                    )
-                if rmv:
-                    placeholders = ",".join(["%s"] * len(rmv))
-                    _exec(
-                        cur,
-                        f"DELETE FROM wecom_ops.ext_contact_tag WHERE external_userid=%s AND tag_id IN ({placeholders})",
-                        (ext_id, *rmv),
-                    )
-                _exec(cur, "UPDATE wecom_ops.ext_contact SET updated_at=NOW() WHERE external_userid=%s", (ext_id,))
-
-            else:
-                pass
-
-            conn.commit()
-        return _ok({"event": event, "external_userid": ext_id, "debug": debug})
+            bits = events.apply_batch(conn, [ev])
+        events.after_commit(bits)
+        return _ok(result)
     except Exception as e:
         return _err(_ex_text(e), 500, traceback.format_exc())
 
@@ -317,14 +226,22 @@ def _build_where_for_unassigned(filters: dict | None) -> Tuple[str, List[Any], b
 
 
 @bp.post("/unassigned/estimate")
+@use_replica
 def unassigned_estimate():
     """
     body: {"filters": {"brands":["Nike"], "stores":["万象城"], "q":"跑步"}, "limit":0}
     无筛选时会尝试不关联视图，从而避免视图临时不可用导致 500。
+    无关键词 q 时优先走人群位图索引（待分配池 ∩ 品牌 ∩ 门店），索引不可用再查库。
     """
     try:
         body = request.get_json(force=True, silent=True) or {}
         filters = body.get("filters") or {}
+        if not (filters.get("q") or "").strip():
+            total = audience.estimate(
+                "pool", {"brand": filters.get("brands") or [], "store_name": filters.get("stores") or []}
+            )
+            if total is not None:
+                return _ok({"total": total})
         where_sql, args, need_view = _build_where_for_unassigned(filters)
 
         with get_mysql_conn() as conn:
@@ -341,12 +258,13 @@ def unassigned_estimate():
                 total = _fetch_one_value(cur, sql, args, 0)
                 return _ok({"total": int(total or 0)})
 
+            # 视图一个客户可能多行（多手机号），按客户去重，与位图索引口径一致
             sql = f"""
-                SELECT COUNT(1) AS total
+                SELECT COUNT(DISTINCT un.external_userid) AS total
                   FROM wecom_ops.ext_unassigned un
                   JOIN wecom_ops.ext_contact e
                     ON e.external_userid = un.external_userid
-             LEFT JOIN wecom_ops.vw_mobile_to_external v
+             LEFT JOIN {profile.source()} v
                     ON v.external_userid = un.external_userid
                  WHERE {where_sql}
             """
@@ -358,6 +276,7 @@ def unassigned_estimate():
 
 
 @bp.get("/unassigned/list")
+@use_replica
 def unassigned_list():
     """
     query: page/size, q / brands / stores
@@ -402,7 +321,7 @@ def unassigned_list():
                       FROM wecom_ops.ext_unassigned un
                       JOIN wecom_ops.ext_contact e
                         ON e.external_userid = un.external_userid
-                 LEFT JOIN wecom_ops.vw_mobile_to_external v
+                 LEFT JOIN {profile.source()} v
                         ON v.external_userid = un.external_userid
                      WHERE {where_sql}
                 """
@@ -426,7 +345,7 @@ def unassigned_list():
                       FROM wecom_ops.ext_unassigned un
                       JOIN wecom_ops.ext_contact e
                         ON e.external_userid = un.external_userid
-                 LEFT JOIN wecom_ops.vw_mobile_to_external v
+                 LEFT JOIN {profile.source()} v
                         ON v.external_userid = un.external_userid
                      WHERE {where_sql}
                   ORDER BY un.updated_at DESC
@@ -471,10 +390,10 @@ def unassigned_list():
 def unassigned_assign():
     """
     body: {"takeover_userid":"U1","external_userids":["ext_a","ext_b",...]}
-    - 调试模式（X-Wecom-Debug:1）：本地直落
+    - 调试模式（WECOM_CALLBACK_DEBUG=1 且 X-Wecom-Debug:1）：本地直落
     - 生产：走 externalcontact/transfer_customer（此处保留 501）
     """
-    debug = request.headers.get("X-Wecom-Debug") == "1"
+    debug = _debug()
     try:
         body = request.get_json(force=True, silent=False) or {}
     except Exception as e:
@@ -513,6 +432,10 @@ def unassigned_assign():
                     )
                     accepted.append(ext_id)
                 conn.commit()
+            audience.set_bits(
+                [(x, "unassigned", False) for x in accepted] + [(x, "pool", False) for x in accepted]
+            )
+            bump_generation(GEN_MEMBERS)
             return _ok({"mode": "debug_local", "count": len(accepted), "accepted": accepted, "skipped": []})
         except Exception as e:
             return _err(_ex_text(e), 500, traceback.format_exc())
@@ -1,22 +1,60 @@
 # app/wecom/signature.py
-import os, hashlib
+import os, re, json, hashlib, hmac, time
 from flask import Request
 
+_ENCRYPT_XML = re.compile(r"<Encrypt>\s*(?:<!\[CDATA\[(.*?)\]\]>|([^<]*))\s*</Encrypt>", re.S)
+
 def _sha1(s: str) -> str:
     return hashlib.sha1(s.encode("utf-8")).hexdigest()
 
+def sign(token: str, timestamp: str, nonce: str, msg: str | None = None) -> str:
+    """企业微信 msg_signature 算法：sha1(sort(token, timestamp, nonce[, msg]))；msg 为 echostr 或密文 Encrypt。"""
+    parts = [token, timestamp, nonce]
+    if msg is not None:
+        parts.append(msg)
+    return _sha1("".join(sorted(parts)))
+
+def encrypted_field(body: str) -> str | None:
+    """取回调包体里的密文：XML 的 <Encrypt> 元素（JSON 包体的 Encrypt/encrypt 键兜底），没有返回 None。"""
+    m = _ENCRYPT_XML.search(body or "")
+    if m:
+        return m.group(1) if m.group(1) is not None else m.group(2).strip()
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    if isinstance(data, dict):
+        value = data.get("Encrypt") or data.get("encrypt")
+        return value if isinstance(value, str) else None
+    return None
+
 def verify_callback_signature(req: Request) -> tuple[bool, str | None]:
-    """返回 (ok, echostr_if_any)。GET 用于URL校验（原样回显 echostr），POST 仅校验签名。"""
+    """
+    返回 (ok, echostr_if_any)。
+    - GET 用于 URL 校验：签名覆盖 echostr，校验通过后原样回显
+    - POST：msg_signature 覆盖包体里的密文 <Encrypt>（不是整个 XML），没有密文的包体一律拒绝；
+      timestamp 与本机时间相差超过 WECOM_CALLBACK_MAX_SKEW_SEC 秒的请求拒绝
+    """
     token = os.getenv("WECOM_CALLBACK_TOKEN", "")
     if not token:
         return False, None
     timestamp = req.args.get("timestamp", "")
     nonce     = req.args.get("nonce", "")
     echostr   = req.args.get("echostr")
-    signature = req.args.get("msg_signature") or req.args.get("signature")  # 视回调类型而定
+    signature = req.args.get("msg_signature") or req.args.get("signature") or ""  # 视回调类型而定
 
-    parts = [token, timestamp, nonce]
-    if echostr:  # GET 验证包含 echostr
-        parts.append(echostr)
-    calc = _sha1("".join(sorted(parts)))
-    return (calc == signature, echostr)
+    if req.method == "GET":
+        calc = sign(token, timestamp, nonce, echostr)
+        return hmac.compare_digest(calc, signature), echostr
+
+    try:
+        skew = abs(time.time() - int(timestamp))
+    except ValueError:
+        return False, None
+    if skew > int(os.getenv("WECOM_CALLBACK_MAX_SKEW_SEC", "300")):
+        return False, None
+    encrypted = encrypted_field(req.get_data(as_text=True))
+    if encrypted is None:
+        return False, None
+    calc = sign(token, timestamp, nonce, encrypted)
+    return hmac.compare_digest(calc, signature), None
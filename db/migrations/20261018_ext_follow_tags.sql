@@ -0,0 +1,7 @@
+/* ---------- 跟进人维度的客户标签 ----------
+ * tag_ids：该跟进人给客户打的企业标签（JSON 数组），sync_contacts 写入。
+ * ext_contact_tag 是所有跟进人标签的并集；跟进关系变化时按并集删掉企微侧已移除的标签。
+ * 存量行为 NULL（未知），对应客户在其所有跟进人都重新同步前不做删除。
+ */
+ALTER TABLE ext_follow_user
+  ADD COLUMN tag_ids JSON NULL AFTER create_time;
@@ -0,0 +1,8 @@
+/* ---------- 客户群增量同步 ----------
+ * member_version：groupchat/get 返回的成员版本号，未变化时跳过成员比对
+ * update_time：本地同步最后一次写入群内容变化的时间
+ */
+ALTER TABLE ec_groupchat
+  ADD COLUMN member_version VARCHAR(64) NULL AFTER status,
+  ADD COLUMN update_time    DATETIME    NULL AFTER member_version,
+  ADD KEY idx_update_time (update_time);
@@ -0,0 +1,27 @@
+/* ---------- 会员宽表 member_profile ----------
+ * vw_mobile_to_external 的物化版本：列名与视图一致，便于查询按 MEMBER_SOURCE 切换。
+ * 由 app/members/profile.py::refresh 维护（增量按 ext_contact.updated_at，全量兜底 CRM 侧变更）。
+ */
+CREATE TABLE IF NOT EXISTS member_profile (
+  external_userid      VARCHAR(64)  NOT NULL,
+  mobile_std           VARCHAR(20)  NOT NULL DEFAULT '',
+  unionid              VARCHAR(128) NULL,
+  crm_user_id          VARCHAR(64)  NULL,
+  vip_name             VARCHAR(128) NULL,
+  mobile_raw           VARCHAR(64)  NULL,
+  store_code           VARCHAR(64)  NULL,
+  store_name           VARCHAR(128) NULL,
+  department_brand     VARCHAR(128) NULL,
+  primary_owner_userid VARCHAR(64)  NULL,
+  primary_owner_name   VARCHAR(128) NULL,
+  tag_names            TEXT         NULL,
+  is_deleted           TINYINT      NOT NULL DEFAULT 0,
+  refreshed_at         TIMESTAMP    DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (external_userid, mobile_std),
+  KEY idx_mobile (mobile_std),
+  KEY idx_store (store_code),
+  KEY idx_store_name (store_name),
+  KEY idx_brand (department_brand),
+  KEY idx_owner (primary_owner_userid),
+  KEY idx_deleted (is_deleted)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
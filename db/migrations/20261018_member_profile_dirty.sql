@@ -0,0 +1,11 @@
+/* ---------- member_profile 待刷新客户 ----------
+ * 客户同步对客户行按哈希跳过未变化的记录，只有跟进人/标签变化时 ext_contact.updated_at 不会刷新，
+ * 增量刷新按 updated_at 挑不到这些客户。客户同步在写跟进人/标签的同一事务里追加一条标记，
+ * app/members/profile.py::refresh 按 seq 上限整批消费（可重复，消费时 DISTINCT）。
+ */
+CREATE TABLE IF NOT EXISTS member_profile_dirty (
+  seq             BIGINT      NOT NULL AUTO_INCREMENT,
+  external_userid VARCHAR(64) NOT NULL,
+  PRIMARY KEY (seq),
+  KEY idx_external (external_userid)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
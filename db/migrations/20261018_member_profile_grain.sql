@@ -0,0 +1,11 @@
+/* ---------- member_profile 行粒度与视图一致 ----------
+ * 视图对同一 (external_userid, mobile_std) 可能返回多行（多个 CRM 会员/门店），
+ * 原主键配合 INSERT IGNORE 会静默丢掉多出的行，宽表与视图计数不一致。
+ * 改为自增主键，(external_userid, mobile_std) 降为普通索引；refresh 改用普通 INSERT。
+ * 执行后建议跑一次 `python -m app.members.profile --full` 补齐被丢弃的行。
+ */
+ALTER TABLE member_profile
+  ADD COLUMN id BIGINT NOT NULL AUTO_INCREMENT FIRST,
+  DROP PRIMARY KEY,
+  ADD PRIMARY KEY (id),
+  ADD KEY idx_external_mobile (external_userid, mobile_std);
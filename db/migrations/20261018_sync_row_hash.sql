@@ -0,0 +1,12 @@
+/* ---------- 增量同步：行内容哈希 ----------
+ * 与 sync_state(domain, item) 对应；每行一条内容哈希，
+ * 增量同步时与拉到的数据比对，未变化的行整行跳过写库。
+ */
+CREATE TABLE IF NOT EXISTS sync_row_hash (
+  domain      VARCHAR(32)  NOT NULL,
+  item        VARCHAR(32)  NOT NULL,
+  row_key     VARCHAR(191) NOT NULL,
+  row_hash    CHAR(40)     NOT NULL,
+  updated_at  TIMESTAMP    DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (domain, item, row_key)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,116 @@
+import fakeredis
+import pytest
+
+from app.members import audience
+
+
+@pytest.fixture()
+def r(monkeypatch):
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(audience, "_r", lambda: fake)
+    monkeypatch.setattr(audience, "_assign_script", None)
+    return fake
+
+
+def _sources():
+    return {
+        "members": [
+            {"external_userid": "e1", "owner": "u1", "store": "s1", "brand": "Nike"},
+            {"external_userid": "e2", "owner": "u1", "store": "s2", "brand": "Adidas"},
+            {"external_userid": "e3", "owner": "u2", "store": "s1", "brand": "Nike"},
+        ],
+        "tags": [
+            {"external_userid": "e1", "tag_id": "vip"},
+            {"external_userid": "e3", "tag_id": "vip"},
+            {"external_userid": "e2", "tag_id": "new"},
+        ],
+        "unassigned": [{"external_userid": "e3"}],
+        "pool": [{"external_userid": "e3"}],
+    }
+
+
+def test_estimate_and_or_semantics(r):
+    assert audience.estimate("member", {}) is None  # 未建索引 -> 回退 SQL
+    audience.rebuild(_sources())
+    assert audience.estimate("member", {}) == 3
+    assert audience.estimate("member", {"tag": ["vip"]}) == 2
+    assert audience.estimate("member", {"tag": ["vip"], "owner": ["u1"]}) == 1
+    assert audience.estimate("member", {"store": ["s1", "s2"], "brand": ["Nike"]}) == 2
+    assert audience.estimate("member", {"tag": ["vip"]}, unassigned=1) == 1
+    assert audience.estimate("member", {"tag": ["vip"]}, unassigned=0) == 1
+    assert audience.estimate("member", {"tag": ["missing"]}) == 0
+    assert not r.keys("aud:tmp:*")
+
+
+def test_rebuild_keeps_ids_and_drops_old_version(r):
+    first = audience.rebuild(_sources())["version"]
+    ids = r.hgetall("aud:id")
+    second = audience.rebuild(_sources())["version"]
+    assert second == first + 1
+    assert r.hgetall("aud:id") == ids
+    assert not r.keys(f"aud:{first}:*")
+
+
+def test_set_bits_updates_current_version(r):
+    audience.rebuild(_sources())
+    audience.set_bits([("e2", "tag:vip", True), ("e1", "tag:vip", False), ("e4", "pool", True)])
+    assert audience.estimate("member", {"tag": ["vip"]}) == 2
+    assert audience.estimate("pool", {}) == 2
+
+
+def _sql_count(rows, tags, filters, unassigned=None, pool=None):
+    """回退 SQL 的口径：逐行过滤会员视图，再按 external_userid 去重计数。"""
+    dims = {"owner": "owner", "store": "store", "brand": "brand"}
+    hit = set()
+    for row in rows:
+        eid = row["external_userid"]
+        if any(filters.get(d) and row.get(col) not in filters[d] for d, col in dims.items()):
+            continue
+        if filters.get("tag") and not any((eid, t) in tags for t in filters["tag"]):
+            continue
+        if unassigned is not None and (eid in (pool or set())) != bool(unassigned):
+            continue
+        hit.add(eid)
+    return len(hit)
+
+
+def test_estimate_matches_sql_semantics_with_multi_row_members(r):
+    src = _sources()
+    # e1 有两个手机号，视图里两行维度相同：SQL 去重后仍算 1 人
+    src["members"].append(dict(src["members"][0]))
+    audience.rebuild(src)
+    tags = {(t["external_userid"], t["tag_id"]) for t in src["tags"]}
+    unassigned = {u["external_userid"] for u in src["unassigned"]}
+    cases = [
+        ({}, None),
+        ({"tag": ["vip"]}, None),
+        ({"owner": ["u1"]}, None),
+        ({"store": ["s1"], "brand": ["Nike"]}, None),
+        ({"tag": ["vip", "new"], "owner": ["u1", "u2"]}, 0),
+        ({"tag": ["vip"]}, 1),
+    ]
+    for filters, flag in cases:
+        expected = _sql_count(src["members"], tags, filters, flag, unassigned)
+        assert audience.estimate("member", filters, flag) == expected, filters
+
+
+def test_stale_index_falls_back_to_sql(r, monkeypatch):
+    audience.rebuild(_sources())
+    assert audience.estimate("member", {}) == 3
+    r.set("aud:ver:at", 0)
+    assert audience.estimate("member", {}) is None
+
+
+def test_reindex_moves_member_dims_and_drops_deleted_contacts(r, monkeypatch):
+    audience.rebuild(_sources())
+    rows = {
+        "e1": [{"external_userid": "e1", "owner": "u2", "store": "s1", "brand": "Nike"}],
+        "e2": [],
+        "e4": [{"external_userid": "e4", "owner": "u1", "store": "s2", "brand": "Adidas"}],
+    }
+    monkeypatch.setattr(audience, "_member_rows", lambda eids: {e: rows.get(e, []) for e in eids})
+    audience.set_bits([(e, audience.REINDEX, True) for e in ("e1", "e2", "e4")])
+    assert audience.estimate("member", {}) == 3
+    assert audience.estimate("member", {"owner": ["u1"]}) == 1
+    assert audience.estimate("member", {"owner": ["u2"]}) == 2
+    assert audience.estimate("member", {"brand": ["Adidas"]}) == 1
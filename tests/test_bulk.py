@@ -0,0 +1,69 @@
+from pymysql.cursors import RE_INSERT_VALUES
+
+from app.common.bulk import BulkUpserter
+
+
+class _Conn:
+    def __init__(self):
+        self.events = []
+
+    def begin(self):
+        self.events.append("begin")
+
+    def commit(self):
+        self.events.append("commit")
+
+    def rollback(self):
+        self.events.append("rollback")
+
+
+class _Cur:
+    def __init__(self):
+        self.connection = _Conn()
+        self.calls = []
+
+    def executemany(self, sql, rows):
+        self.calls.append((sql, list(rows)))
+
+    def execute(self, sql, args):
+        self.calls.append((sql, list(args)))
+
+
+def test_bulk_upserter_flushes_in_chunks_inside_transactions():
+    cur = _Cur()
+    writer = BulkUpserter(cur, chunk_size=2)
+    writer.register("ext_tag", ["tag_id", "name"], update=["name"])
+    writer.register("ext_contact_tag", ["external_userid", "tag_id"])
+    with writer:
+        for i in range(3):
+            writer.add("ext_tag", (f"t{i}", "n"))
+        writer.add("ext_contact_tag", ("e1", "t1"))
+    assert [len(rows) for _, rows in cur.calls] == [2, 1, 1]
+    assert cur.connection.events == ["begin", "commit", "begin", "commit"]
+    assert writer.written == {"ext_tag": 3, "ext_contact_tag": 1}
+
+
+def test_bulk_upserter_sql_is_rewritable_to_multi_row():
+    writer = BulkUpserter(_Cur())
+    writer.register("ext_tag", ["tag_id", "name"], update=["name"])
+    writer.register("ext_contact_tag", ["external_userid", "tag_id"])
+    for sql in writer._sql.values():
+        assert RE_INSERT_VALUES.match(sql)
+
+
+def test_buffered_deletes_run_first_in_the_same_transaction():
+    cur = _Cur()
+    writer = BulkUpserter(cur, chunk_size=10)
+    writer.register("org_employee_dept", ["userid", "dept_id"])
+    writer.delete("org_employee_dept", ["userid"], ["u1"])
+    writer.add("org_employee_dept", ("u1", 2))
+    writer.delete("ext_contact_tag", ["external_userid", "tag_id"], ("e1", "t1"))
+    writer.flush()
+    assert cur.calls[0] == ("DELETE FROM org_employee_dept WHERE userid IN (%s)", ["u1"])
+    assert cur.calls[1] == (
+        "DELETE FROM ext_contact_tag WHERE (external_userid, tag_id) IN ((%s, %s))", ["e1", "t1"],
+    )
+    assert cur.calls[2][0].startswith("INSERT IGNORE INTO org_employee_dept")
+    assert cur.connection.events == ["begin", "commit"]
+    writer.flush()
+    assert len(cur.calls) == 3
@@ -0,0 +1,91 @@
+import json
+import time
+
+import fakeredis
+import pytest
+
+from app.common import cache
+
+
+@pytest.fixture()
+def r(monkeypatch):
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(cache, "_r", lambda: fake)
+    cache._l1_clear()
+    return fake
+
+
+def test_value_and_ts_in_one_key_and_l1_hit(r):
+    calls = []
+    loader = lambda: calls.append(1) or {"n": 1}
+    assert cache.get_with_singleflight("k:a", loader) == {"n": 1}
+    env = json.loads(r.get("k:a"))
+    assert env["v"] == {"n": 1} and "ts" in env
+    assert r.get("k:a:meta") is None
+    before = cache.stats().get("l1_hit", 0)
+    assert cache.get_with_singleflight("k:a", loader) == {"n": 1}
+    assert cache.stats()["l1_hit"] == before + 1
+    assert len(calls) == 1
+
+
+def test_stale_value_served_while_refreshing_in_background(r):
+    r.set("k:b", json.dumps({"v": "old", "ts": time.time() - 100, "soft": 10}), ex=900)
+    assert cache.get_with_singleflight("k:b", lambda: "new") == "old"
+    deadline = time.monotonic() + 2
+    while json.loads(r.get("k:b"))["v"] != "new" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert json.loads(r.get("k:b"))["v"] == "new"
+
+
+def test_follower_never_returns_null(r, monkeypatch):
+    monkeypatch.setattr(cache, "_WAIT_S", 0.1)
+    r.set("k:c:lock", "1", ex=30)  # 其他进程持锁但迟迟不写
+    assert cache.get_with_singleflight("k:c", lambda: [1, 2]) == [1, 2]
+    assert cache.stats().get("wait_timeout", 0) >= 1
+
+
+def test_jitter_stays_within_settings(monkeypatch):
+    monkeypatch.setattr(cache.settings, "cache_jitter_min", 0.9)
+    monkeypatch.setattr(cache.settings, "cache_jitter_max", 1.2)
+    assert all(90 <= cache._jitter(100) <= 120 for _ in range(50))
+
+
+def test_background_refresh_sees_callers_contextvars(r):
+    import contextvars
+
+    var = contextvars.ContextVar("cache_test_var", default="unset")
+    seen = []
+    r.set("k:d", json.dumps({"v": "old", "ts": time.time() - 100, "soft": 10}), ex=900)
+    token = var.set("caller")
+    try:
+        cache.get_with_singleflight("k:d", lambda: seen.append(var.get()) or "new")
+    finally:
+        var.reset(token)
+    deadline = time.monotonic() + 2
+    while not seen and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert seen == ["caller"]
+
+
+def test_l1_value_past_hard_ttl_is_not_served_when_redis_is_down(r, monkeypatch):
+    from redis.exceptions import ConnectionError
+
+    cache._l1_put("k:e", {"v": "fresh-enough", "ts": time.time() - 50, "soft": 10, "hard": 100})
+    cache._l1_put("k:f", {"v": "too-old", "ts": time.time() - 500, "soft": 10, "hard": 100})
+
+    def _down():
+        raise ConnectionError("down")
+
+    monkeypatch.setattr(cache, "_r", _down)
+    assert cache.get_with_singleflight("k:e", lambda: "loaded") == "fresh-enough"
+    assert cache.get_with_singleflight("k:f", lambda: "loaded") == "loaded"
+
+
+def test_loader_never_deletes_a_lock_it_does_not_own(r):
+    def _loader():
+        # 锁过期后被别的进程拿走
+        r.set("k:g:lock", "someone-else", ex=30)
+        return "v"
+
+    assert cache.get_with_singleflight("k:g", _loader) == "v"
+    assert r.get("k:g:lock") == "someone-else"
@@ -0,0 +1,189 @@
+import json
+
+import fakeredis
+import pytest
+
+from app.wecom import consumer, events
+
+
+@pytest.fixture()
+def r(monkeypatch):
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(events, "get_redis", lambda: fake)
+    monkeypatch.setattr("app.common.idempotency.get_redis", lambda: fake)
+    return fake
+
+
+def _ev(event, eid, ts=1, **kw):
+    payload = {"Event": event, "ExternalUserID": eid, "CreateTime": ts, **kw}
+    return events.normalize(payload)
+
+
+def test_normalize_requires_event_and_contact():
+    assert events.normalize({"Event": "add_external_contact"}) is None
+    ev = _ev("add_external_contact", " e1 ", FromUserName="u1")
+    assert ev["external_userid"] == "e1" and ev["from_user"] == "u1"
+
+
+def test_coalesce_groups_by_contact_and_collapses_repeated_edits():
+    groups = events.coalesce([
+        _ev("edit_external_contact", "e1", 1, Detail={"a": 1}),
+        _ev("change_external_tag", "e2", 2, Detail={"add": ["t1"]}),
+        _ev("edit_external_contact", "e1", 3),
+        _ev("del_external_contact", "e1", 4, FromUserName="u1"),
+    ])
+    assert list(groups) == ["e1", "e2"]
+    assert [e["event"] for e in groups["e1"]] == ["edit_external_contact", "del_external_contact"]
+    # 合并后保留最后一条，缺 Detail 时沿用前一条
+    assert groups["e1"][0]["create_ts"] == 3 and groups["e1"][0]["detail"] == {"a": 1}
+
+
+def test_unseen_dedupes_and_marks_only_after_commit(r):
+    ev = _ev("change_external_tag", "e1", 5, Detail={"add": ["t1"]})
+    fresh, keys = events.unseen([ev, dict(ev)])
+    assert len(fresh) == 1 and len(keys) == 1
+    # 未提交前不留标记，同一事件仍视为未处理
+    assert len(events.unseen([ev])[0]) == 1
+    events.mark_seen(keys)
+    assert events.unseen([ev]) == ([], [])
+
+
+def test_redelivered_message_is_applied_when_worker_died_before_commit(r, monkeypatch):
+    consumer.ensure_group(r)
+    events.enqueue(_ev("transfer_fail", "e1"), r)
+    entries = r.xreadgroup(events.GROUP, "c1", {events.STREAM: ">"}, count=10)[0][1]
+
+    class Conn:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    applied = []
+    monkeypatch.setattr(consumer, "get_mysql_conn", lambda: Conn())
+    monkeypatch.setattr(consumer.events, "after_commit", lambda bits: None)
+
+    # 第一个 worker 已读到事件，但在提交前被 SIGKILL：apply_batch 没有返回
+    def killed(conn, evs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(consumer.events, "apply_batch", killed)
+    with pytest.raises(KeyboardInterrupt):
+        consumer.process(r, entries)
+
+    # XAUTOCLAIM 重投给另一个 worker：事件照常落库并 ACK
+    _, claimed, *_ = r.xautoclaim(events.STREAM, events.GROUP, "c2", min_idle_time=0, start_id="0-0")
+    monkeypatch.setattr(consumer.events, "apply_batch", lambda conn, evs: applied.extend(evs) or [])
+    assert consumer.process(r, claimed)["acked"] == 1
+    assert [ev["external_userid"] for ev in applied] == ["e1"]
+
+    # 提交后再收到同一事件（企业微信重试）则跳过
+    events.enqueue(_ev("transfer_fail", "e1"), r)
+    entries = r.xreadgroup(events.GROUP, "c2", {events.STREAM: ">"}, count=10)[0][1]
+    assert consumer.process(r, entries)["acked"] == 1
+    assert len(applied) == 1
+
+
+def test_process_acks_batch_and_dead_letters_poison(r, monkeypatch):
+    consumer.ensure_group(r)
+    events.enqueue(_ev("transfer_fail", "e1"), r)
+    r.xadd(events.STREAM, {"junk": "x"})
+    entries = r.xreadgroup(events.GROUP, "c1", {events.STREAM: ">"}, count=10)[0][1]
+
+    applied = []
+    monkeypatch.setattr(consumer, "_apply", lambda msgs: applied.extend(msgs) or [])
+    out = consumer.process(r, entries)
+    assert out == {"read": 2, "acked": 2, "failed": 0}
+    assert [ev["external_userid"] for _, ev in applied] == ["e1"]
+    assert r.xpending(events.STREAM, events.GROUP)["pending"] == 0
+
+    events.enqueue(_ev("transfer_fail", "e2"), r)
+    entries = r.xreadgroup(events.GROUP, "c1", {events.STREAM: ">"}, count=10)[0][1]
+
+    def boom(msgs):
+        raise RuntimeError("db down")
+    monkeypatch.setattr(consumer, "_apply", boom)
+    for _ in range(consumer._MAX_FAILS - 1):
+        assert consumer.process(r, entries)["acked"] == 0
+    assert consumer.process(r, entries)["acked"] == 1
+    dead = r.xrange(events.DEAD)
+    assert json.loads(dead[0][1]["ev"])["external_userid"] == "e2"
+
+
+def test_tag_aggregator_applies_net_deltas_in_multi_row_statements():
+    class Cur:
+        def __init__(self):
+            self.calls = []
+
+        def executemany(self, sql, rows):
+            self.calls.append(("many", sql, list(rows)))
+
+        def execute(self, sql, args=None):
+            self.calls.append(("one", sql, list(args or [])))
+
+    agg = events.TagDeltaAggregator()
+    agg.add_event(_ev("change_external_tag", "e1", 1, Detail={"add": ["t1", "t2"]}))
+    agg.add_event(_ev("change_external_tag", "e1", 2, Detail={"remove": ["t1"]}))
+    agg.add_event(_ev("change_external_tag", "e2", 3, Detail={"add": ["t1"], "remove": ["t3"]}))
+    agg.add_event(_ev("change_external_tag", "e2", 4, Detail={"add": ["t3"]}))
+    assert agg.events == 4 and len(agg) == 4
+
+    cur = Cur()
+    bits = agg.apply(cur)
+    (kind1, _, adds), (kind2, sql, removes) = cur.calls
+    assert kind1 == "many" and adds == [("e1", "t2"), ("e2", "t1"), ("e2", "t3")]
+    assert kind2 == "one" and "(external_userid, tag_id) IN ((%s, %s))" in sql and removes == ["e1", "t1"]
+    assert ("e1", "tag:t1", False) in bits and ("e2", "tag:t3", True) in bits
+    assert len(agg) == 0
+
+
+
+# 企业微信官方文档的回调样例（URL 校验）
+_DOC_TOKEN = "QDG6eK"
+_DOC_ECHOSTR = "P9nAzCzyDtyTWESHep1vC5X9xho/qYX3Zpb4yKa9SKld1DsH3Iyt3tP3zNdtp+4RPcs8TgAE7OaBO+FZXvnaqQ=="
+_CIPHER = "RypEvHKD8QQKFhvQ6QleEB4J58tiPdvo+rtK1I9qca6aM/wvqnLSV5zEPeusUiX5L5X/0lWfrf0QADHHhGd3QczcdCUpj911L3vg3W/sYYvuJTs3TUUkSUXxaccAS0qh"
+
+
+def _wecom_xml(cipher):
+    return (
+        "<xml><ToUserName><![CDATA[wx5823bf96d3bd56c7]]></ToUserName>"
+        f"<Encrypt><![CDATA[{cipher}]]></Encrypt>"
+        "<AgentID><![CDATA[218]]></AgentID></xml>"
+    )
+
+
+def test_sign_matches_wecom_reference_and_covers_the_encrypt_element():
+    import hashlib
+    from app.wecom.signature import encrypted_field, sign
+
+    assert sign(_DOC_TOKEN, "1409659589", "263014780", _DOC_ECHOSTR) == "5c45ff5e21c57e6ad56bac8758b79b1d9ac89fd3"
+    body = _wecom_xml(_CIPHER)
+    assert encrypted_field(body) == _CIPHER
+    assert encrypted_field(json.dumps({"encrypt": _CIPHER})) == _CIPHER
+    assert encrypted_field("<xml><MsgType>text</MsgType></xml>") is None
+    expected = hashlib.sha1("".join(sorted([_DOC_TOKEN, "1409659813", "1372623149", _CIPHER])).encode()).hexdigest()
+    assert sign(_DOC_TOKEN, "1409659813", "1372623149", encrypted_field(body)) == expected
+
+
+def test_callback_verifies_wecom_envelope_and_ignores_debug_header_by_default(monkeypatch):
+    import time
+    from app.app import app
+    from app.wecom import routes_v1
+    from app.wecom.signature import sign
+
+    monkeypatch.setenv("WECOM_CALLBACK_TOKEN", _DOC_TOKEN)
+    monkeypatch.setattr(routes_v1.settings, "wecom_callback_debug", False)
+    monkeypatch.setattr(routes_v1.events, "enqueue", lambda ev: "1-0")
+    client = app.test_client()
+    body = _wecom_xml(_CIPHER)
+    ts, nonce = str(int(time.time())), "1372623149"
+    url = f"/api/v1/wecom/callback?timestamp={ts}&nonce={nonce}&msg_signature={sign(_DOC_TOKEN, ts, nonce, _CIPHER)}"
+
+    assert client.post("/api/v1/wecom/callback", data=body, headers={"X-Wecom-Debug": "1"}).status_code == 403
+    # 真实包体验签通过（之后按明文 JSON 解析事件，密文解密不在本层）
+    assert client.post(url, data=body).status_code != 403
+    assert client.post(url, data=_wecom_xml(_CIPHER[:-4] + "AAAA")).status_code == 403
+    # 旧的“整个请求体”签名不再被接受
+    plain = json.dumps({"Event": "transfer_fail", "ExternalUserID": "e1"})
+    url_plain = f"/api/v1/wecom/callback?timestamp={ts}&nonce={nonce}&msg_signature={sign(_DOC_TOKEN, ts, nonce, plain)}"
+    assert client.post(url_plain, data=plain).status_code == 403
@@ -0,0 +1,118 @@
+import threading
+
+import pytest
+
+from app.core import db
+
+
+class FakeConn:
+    def __init__(self):
+        self.open = True
+        self.server_status = 0
+        self.pings = 0
+        self.rollbacks = 0
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.server_status = 0
+
+    def close(self):
+        self.open = False
+
+
+class _borrow:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __enter__(self):
+        self.conn = self.pool.acquire()
+        return self.conn
+
+    def __exit__(self, *exc):
+        self.pool.release(self.conn)
+
+
+def _pool(**kw):
+    made = []
+
+    def connect():
+        made.append(FakeConn())
+        return made[-1]
+    return db.MySQLPool(connect, **kw), made
+
+
+def test_reuses_returned_connection_without_ping():
+    pool, made = _pool(max_size=2, ping_after_s=30)
+    with _borrow(pool) as c1:
+        pass
+    with _borrow(pool) as c2:
+        assert c2 is c1
+    assert len(made) == 1 and made[0].pings == 0
+    assert pool.stats()["checkouts"] == 2 and pool.stats()["in_use"] == 0
+
+
+def test_pings_only_after_idle_and_drops_expired(monkeypatch):
+    pool, made = _pool(max_size=2, idle_s=100, ping_after_s=10)
+    now = [1000.0]
+    monkeypatch.setattr(db.time, "monotonic", lambda: now[0])
+    conn = pool.acquire()
+    pool.release(conn)
+    now[0] += 20
+    assert pool.acquire() is conn and conn.pings == 1
+    pool.release(conn)
+    now[0] += 200
+    fresh = pool.acquire()
+    assert fresh is not conn and not conn.open and len(made) == 2
+
+
+def test_bounded_size_times_out_and_wakes_waiter():
+    pool, _ = _pool(max_size=1, wait_s=0.05)
+    held = pool.acquire()
+    with pytest.raises(db.PoolTimeout):
+        pool.acquire()
+
+    pool.wait_s = 2
+    got = []
+    t = threading.Thread(target=lambda: got.append(pool.acquire()))
+    t.start()
+    pool.release(held)
+    t.join(2)
+    assert got == [held] and pool.stats()["waits"] >= 1
+
+
+def test_proxy_close_returns_and_open_transaction_is_rolled_back():
+    pool, made = _pool(max_size=1)
+    proxy = db.PooledConnection(pool, pool.acquire())
+    made[0].server_status = db.SERVER_STATUS.SERVER_STATUS_IN_TRANS
+    proxy.close()
+    proxy.close()
+    assert made[0].rollbacks == 1 and made[0].open
+    assert pool.stats()["idle"] == 1
+
+
+def test_use_replica_routes_reads_and_falls_back_on_lag(monkeypatch):
+    primary, _ = _pool(max_size=2)
+    replica, replica_made = _pool(max_size=2)
+    lag = [1.0]
+    monkeypatch.setattr(db, "_pool", primary)
+    monkeypatch.setattr(db, "_replica_pool", replica)
+    monkeypatch.setattr(db, "_replica_params", lambda: {"host": "replica"})
+    monkeypatch.setattr(db, "_replica_lag", lambda conn: lag[0])
+    monkeypatch.setattr(db, "_replica_state", {"ok": False, "lag_s": None, "checked": 0.0})
+    monkeypatch.setenv("MYSQL_REPLICA_LAG_CHECK_SEC", "0")
+
+    @db.use_replica
+    def read():
+        with db.mysql_conn() as conn:
+            return conn
+
+    assert read() is replica_made[0]
+    with db.mysql_conn() as conn:
+        assert conn not in replica_made  # 未标注的调用仍走主库
+
+    lag[0] = 60.0
+    assert read() not in replica_made
+    assert db.pool_stats()["replica_ok"] is False and db.pool_stats()["replica_lag_s"] == 60.0
@@ -0,0 +1,121 @@
+import fakeredis
+import pytest
+
+from app.common import idempotency, semaphore
+from app.mass import dispatcher, repo, service, stats
+
+
+class _Queue:
+    def __init__(self):
+        self.jobs = []
+
+    def enqueue(self, fn, *args, **kwargs):
+        self.jobs.append(args)
+
+
+@pytest.fixture()
+def env(monkeypatch):
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    for mod in (dispatcher, idempotency, semaphore):
+        monkeypatch.setattr(mod, "get_redis", lambda: fake)
+    monkeypatch.setattr(semaphore, "_shas", {})
+    queue = _Queue()
+    monkeypatch.setattr(dispatcher, "_queue", lambda: queue)
+    monkeypatch.setattr(dispatcher, "take_tokens", lambda *a: (True, 0))
+
+    state = {
+        "task": {"id": 1, "status": service.STATUS_RUNNING, "content_json": {"text": "hi"},
+                 "qps_limit": 10, "concurrency_limit": 2, "agent_id": "a1"},
+        "rows": [{"id": 11, "recipient_id": "wm1"}, {"id": 12, "recipient_id": "wm2"}],
+        "pending": 0,
+        "moves": [],
+        "written": [],
+        "logs": [],
+        "status": [],
+    }
+    monkeypatch.setattr(repo, "get_task", lambda task_id: dict(state["task"]))
+    monkeypatch.setattr(repo, "claim_batch", lambda *a: list(state["rows"]))
+    monkeypatch.setattr(repo, "count_pending", lambda task_id: state["pending"])
+    monkeypatch.setattr(repo, "append_log", lambda task_id, level, msg: state["logs"].append((level, msg)))
+    monkeypatch.setattr(repo, "update_task", lambda task_id, fields: None)
+    monkeypatch.setattr(repo, "set_task_status",
+                        lambda task_id, status, extra=None: state["status"].append(status))
+
+    def _write_back(sent, failed):
+        state["written"].append((list(sent), dict(failed)))
+        return len(sent), len(failed)
+
+    monkeypatch.setattr(repo, "write_back_targets", _write_back)
+    monkeypatch.setattr(stats, "move", lambda task_id, src, dst, n: state["moves"].append((src, dst, n)))
+    monkeypatch.setattr(stats, "checkpoint", lambda task_id: None)
+    monkeypatch.setattr(stats, "reconcile", lambda task_id: None)
+    state.update(r=fake, queue=queue)
+    return state
+
+
+def test_skips_task_that_is_not_running(env, monkeypatch):
+    env["task"]["status"] = service.STATUS_PAUSED
+    monkeypatch.setattr(dispatcher, "wecom_post_json", lambda *a, **kw: pytest.fail("sent"))
+    assert dispatcher.dispatch_batch(1, 1, 1) == {"task_id": 1, "skipped": "not running"}
+    assert env["written"] == []
+
+
+def test_requeues_and_releases_claim_when_semaphores_time_out(env, monkeypatch):
+    monkeypatch.setattr(dispatcher, "_acquire_all", lambda sems, timeout_s: None)
+    monkeypatch.setattr(dispatcher, "wecom_post_json", lambda *a, **kw: pytest.fail("sent"))
+    assert dispatcher.dispatch_batch(1, 2, 3) == {"task_id": 1, "requeued": True}
+    assert env["queue"].jobs == [(1, 2, 3)]
+    assert not env["r"].exists(dispatcher._claim_key(1, 2, 3))
+
+
+def test_fail_list_maps_to_failed_rows_and_moves_stats(env, monkeypatch):
+    sent_bodies = []
+
+    def _post(url, app, body):
+        sent_bodies.append(body)
+        return {"fail_list": ["wm2"]}
+
+    monkeypatch.setattr(dispatcher, "wecom_post_json", _post)
+    env["pending"] = 3
+    out = dispatcher.dispatch_batch(1, 1, 1)
+
+    assert out == {"task_id": 1, "sent": 1, "failed": 1}
+    assert sent_bodies[0]["external_userid"] == ["wm1", "wm2"]
+    assert sent_bodies[0]["text"] == {"content": "hi"}
+    assert env["written"] == [([11], {12: "fail_list"})]
+    assert env["moves"] == [("pending", "sent", 1), ("pending", "failed", 1)]
+    assert env["logs"][0][0] == "WARN"
+    # 还有待发行：不收尾；信号量与认领都已归还
+    assert env["status"] == []
+    assert env["r"].zcard("mass:sem:task:1") == 0
+    assert not env["r"].exists(dispatcher._claim_key(1, 1, 1))
+
+
+def test_send_error_fails_whole_batch_and_last_batch_finishes_task(env, monkeypatch):
+    def _post(url, app, body):
+        raise RuntimeError("errcode=41001")
+
+    monkeypatch.setattr(dispatcher, "wecom_post_json", _post)
+    out = dispatcher.dispatch_batch(1, 1, 1)
+
+    assert out["failed"] == 2
+    assert env["written"] == [([], {11: "errcode=41001", 12: "errcode=41001"})]
+    assert env["status"] == [service.STATUS_FINISHED]
+
+
+def test_claimed_batch_is_skipped_and_foreign_claim_survives(env, monkeypatch):
+    env["r"].set(dispatcher._claim_key(1, 1, 1), "other-worker")
+    assert dispatcher.dispatch_batch(1, 1, 1) == {"task_id": 1, "skipped": "claimed"}
+    assert env["r"].get(dispatcher._claim_key(1, 1, 1)) == "other-worker"
+
+
+def test_sweep_requeues_unclaimed_pending_batches(env, monkeypatch):
+    monkeypatch.setattr(repo, "list_stale_running_tasks", lambda before: [1, 2])
+    monkeypatch.setattr(repo, "list_pending_batches",
+                        lambda task_id: [(1, 1), (1, 2)] if task_id == 1 else [])
+    env["r"].set(dispatcher._claim_key(1, 1, 1), "busy")
+
+    assert dispatcher.sweep_stale(60) == {"tasks": 1, "batches": 1}
+    assert env["queue"].jobs == [(1, 1, 2)]
+    # 任务 2 没有待发批次：直接收尾
+    assert env["status"] == [service.STATUS_FINISHED]
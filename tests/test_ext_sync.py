@@ -0,0 +1,41 @@
+import threading
+
+from app.ext import service as ext_service
+
+
+def test_contact_pages_follow_each_groups_cursor_chain_with_bounded_concurrency(monkeypatch):
+    pages = {
+        ("g0", ""): (["a1"], "c1"),
+        ("g0", "c1"): (["a2"], ""),
+        ("g1", ""): (["b1"], ""),
+        ("g2", ""): (["c1"], "x"),
+        ("g2", "x"): (["c2"], ""),
+    }
+    calls, inflight, peak = [], [0], [0]
+    lock = threading.Lock()
+
+    def _fetch(userids, cursor, limit):
+        with lock:
+            inflight[0] += 1
+            peak[0] = max(peak[0], inflight[0])
+            calls.append((userids[0], cursor, limit))
+        try:
+            return pages[(userids[0], cursor)]
+        finally:
+            with lock:
+                inflight[0] -= 1
+
+    monkeypatch.setattr(ext_service, "_fetch_batch_page", _fetch)
+    out = list(ext_service._iter_contact_pages([["g0"], ["g1"], ["g2"]], workers=2, limit=50))
+
+    by_group = {}
+    for idx, items, done in out:
+        by_group.setdefault(idx, []).append((items, done))
+    # 每组按游标链顺序产出，最后一页标记已拉完
+    assert by_group == {
+        0: [(["a1"], False), (["a2"], True)],
+        1: [(["b1"], True)],
+        2: [(["c1"], False), (["c2"], True)],
+    }
+    assert sorted(calls) == sorted((g, c, 50) for g, c in pages)
+    assert peak[0] <= 2
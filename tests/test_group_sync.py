@@ -0,0 +1,115 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+import fakeredis
+import pytest
+
+from app.group import service
+
+
+def test_member_diff_upserts_new_and_changed_and_deletes_departed():
+    t = datetime(2026, 1, 1)
+    existing = {
+        ("u1", "employee"): ("c1", "u1", "employee", t, None),
+        ("wm1", "external"): ("c1", "wm1", "external", t, None),
+        ("wm2", "external"): ("c1", "wm2", "external", t, None),
+    }
+    rows = [
+        ("c1", "u1", "employee", t, None),
+        ("c1", "wm1", "external", t, "union-1"),
+        ("c1", "wm3", "external", t, None),
+        ("c1", None, "external", t, None),
+    ]
+    upserts, gone = service.member_diff(existing, rows)
+    assert upserts == [("c1", "wm1", "external", t, "union-1"), ("c1", "wm3", "external", t, None)]
+    assert gone == [("c1", "wm2", "external")]
+
+
+def test_take_dirty_snapshots_and_keeps_leftovers_from_failed_run(monkeypatch):
+    r = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(service, "get_redis", lambda: r)
+    service.mark_dirty("c1")
+    r.sadd(service._DIRTY_SYNCING, "c0")
+    assert service._take_dirty(r) == {"c0", "c1"}
+    service.mark_dirty("c2")
+    assert r.smembers(service.DIRTY_KEY) == {"c2"}
+
+
+class _StubWriter:
+    chunk_size = 500
+
+    def __init__(self, cur):
+        pass
+
+    def register(self, *a, **kw): pass
+    def add(self, table, row): pass
+    def flush(self): pass
+
+
+class _StubFilter:
+    skipped = 0
+
+    def __init__(self, *a):
+        pass
+
+    def changed(self, details):
+        return []
+
+    def mark(self, key): pass
+
+
+def _stub_sync(monkeypatch, r, pages, fail_on_page=None):
+    """两页列表的 changed_only 同步，库里已有全部群；返回实际拉详情的群。"""
+    fetched = []
+
+    @contextmanager
+    def _cur():
+        yield object()
+
+    def _post(url, app, body):
+        page = int(body["cursor"] or 0)
+        if page == fail_on_page:
+            raise RuntimeError("boom")
+        ids, nxt = pages[page]
+        return {"group_chat_list": [{"chat_id": c} for c in ids], "next_cursor": nxt}
+
+    monkeypatch.setattr(service, "get_redis", lambda: r)
+    monkeypatch.setattr(service, "_use_cursor", _cur)
+    monkeypatch.setattr(service, "BulkUpserter", _StubWriter)
+    monkeypatch.setattr(service, "ChangeFilter", _StubFilter)
+    monkeypatch.setattr(service, "wecom_post_json", _post)
+    monkeypatch.setattr(service, "_stored_versions", lambda cur, ids: {c: "v" for c in ids})
+    monkeypatch.setattr(service, "_load_members", lambda cur, ids: {})
+    monkeypatch.setattr(service, "_fetch_detail", lambda c: fetched.append(c) or {"chat_id": c})
+    # 保存的断点指向第 2 页：changed_only 不能从这里续跑，否则第 1 页的脏群被漏掉
+    monkeypatch.setattr(service.sync_state, "get_state", lambda *a: {"sync_cursor": "1"})
+    for name in ("save_cursor", "save_progress", "mark_ok", "mark_err"):
+        monkeypatch.setattr(service.sync_state, name, lambda *a, **kw: None)
+    return fetched
+
+
+def test_changed_only_ignores_saved_cursor_and_clears_marks_per_page(monkeypatch):
+    r = fakeredis.FakeRedis(decode_responses=True)
+    pages = {0: (["c1", "c2"], "1"), 1: (["c3"], "")}
+    fetched = _stub_sync(monkeypatch, r, pages)
+    service.mark_dirty("c1")
+    service.mark_dirty("c3")
+
+    out = service.sync_groupchats(changed_only=True, workers=1)
+    assert out["resumed_from"] is None
+    assert sorted(fetched) == ["c1", "c3"]
+    assert out["skipped_clean"] == 1
+    assert not r.exists(service._DIRTY_SYNCING)
+
+
+def test_changed_only_failure_keeps_marks_of_unfetched_pages(monkeypatch):
+    r = fakeredis.FakeRedis(decode_responses=True)
+    pages = {0: (["c1", "c2"], "1"), 1: (["c3"], "")}
+    _stub_sync(monkeypatch, r, pages, fail_on_page=1)
+    service.mark_dirty("c1")
+    service.mark_dirty("c3")
+
+    with pytest.raises(RuntimeError):
+        service.sync_groupchats(changed_only=True, workers=1)
+    # 第 1 页的 c1 已落库并清除；c3 所在页失败，标记保留给下一轮
+    assert r.smembers(service._DIRTY_SYNCING) == {"c3"}
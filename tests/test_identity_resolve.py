@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+
+from app.identity import service
+
+
+class _Cur:
+    def __init__(self, table):
+        self.table = table
+        self.queries = []
+        self._rows = []
+
+    def execute(self, sql, args):
+        self.queries.append(list(args))
+        self._rows = [{"mobile_std": m, "external_userid": self.table[m]} for m in args if m in self.table]
+
+    def fetchall(self):
+        return self._rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _patch(monkeypatch, table):
+    cur = _Cur(table)
+
+    class Conn:
+        def cursor(self):
+            return cur
+
+    @contextmanager
+    def read_conn():
+        yield Conn()
+
+    monkeypatch.setattr(service, "read_conn", read_conn)
+    monkeypatch.setattr(service, "generation", lambda ns: 1)
+    monkeypatch.setattr(service, "_lru", service._MobileLRU(100, 300))
+    return cur
+
+
+def test_resolve_chunks_in_input_order_and_caches_hot_mobiles(monkeypatch):
+    cur = _patch(monkeypatch, {"13800138000": "e1", "13900139000": "e2"})
+    got = list(service.resolve_mobiles(
+        ["+86 139-0013-9000", "13800138000", "13700137000", "13800138000", ""], chunk=2))
+    assert got == [("13900139000", "e2"), ("13800138000", "e1"), ("13700137000", None)]
+    assert cur.queries == [["13900139000", "13800138000"], ["13700137000"]]
+
+    cur.queries.clear()
+    assert list(service.resolve_mobiles(["13800138000", "13700137000"])) == \
+        [("13800138000", "e1"), ("13700137000", None)]
+    assert cur.queries == []
+
+
+def test_lru_drops_entries_from_an_older_generation():
+    lru = service._MobileLRU(2, 300)
+    lru.put_many({"a": "e1", "b": None}, gen=1)
+    assert lru.get_many(["a", "b"], gen=1) == {"a": "e1", "b": None}
+    assert lru.get_many(["a"], gen=2) == {}
+    lru.put_many({"c": "e3", "d": "e4", "e": "e5"}, gen=2)
+    assert lru.get_many(["c", "d", "e"], gen=2) == {"d": "e4", "e": "e5"}
+
+
+def _lookup_sql(monkeypatch, source):
+    sqls = []
+
+    class Cur(_Cur):
+        def execute(self, sql, args):
+            sqls.append(sql)
+            super().execute(sql, args)
+
+    if source is not None:
+        monkeypatch.setattr(service.profile.settings, "member_source", source)
+    assert service._lookup(Cur({"13800138000": "e1"}), ["13800138000", "13700137000"]) == \
+        {"13800138000": "e1", "13700137000": None}
+    return sqls[0]
+
+
+def test_lookup_reads_the_view_under_the_default_source(monkeypatch):
+    # 未迁移宽表的部署（MEMBER_SOURCE 缺省）照常走视图
+    sql = _lookup_sql(monkeypatch, None)
+    assert service.profile.VIEW in sql and service.profile.TABLE not in sql
+
+
+def test_lookup_follows_member_source(monkeypatch):
+    sql = _lookup_sql(monkeypatch, "view")
+    assert service.profile.VIEW in sql and service.profile.TABLE not in sql
+    sql = _lookup_sql(monkeypatch, "table")
+    assert service.profile.TABLE in sql and service.profile.VIEW not in sql
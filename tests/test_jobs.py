@@ -0,0 +1,78 @@
+import fakeredis
+import pytest
+
+from app.common import semaphore
+from app.jobs import queues, sync
+
+CALLS = []
+
+
+def _demo(full: bool = False):
+    CALLS.append(full)
+    return {"full": full}
+
+
+@pytest.fixture()
+def r(monkeypatch):
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(semaphore, "get_redis", lambda: fake)
+    monkeypatch.setattr(semaphore, "_shas", {})
+    monkeypatch.setattr(sync, "get_redis", lambda: fake)
+    monkeypatch.setitem(sync.SYNC_JOBS, "t.demo", ("t", "demo", f"{__name__}:_demo"))
+    states = []
+    monkeypatch.setattr(sync, "_job_state", lambda domain, item, reset_progress=False, **f: states.append(f["status"]))
+    CALLS.clear()
+    fake.states = states
+    return fake
+
+
+def test_check_params_rejects_unknown_job_and_params(r):
+    assert sync.check_params("t.demo", {"full": True}) == {"full": True}
+    with pytest.raises(ValueError):
+        sync.check_params("t.demo", {"fulll": True})
+    with pytest.raises(KeyError):
+        sync.check_params("t.nope", {})
+
+
+def test_run_is_exclusive_per_domain(r):
+    lock = sync._lock("t")
+    token, _ = lock.try_acquire()
+    with pytest.raises(sync.JobConflict):
+        sync.run("t.demo", {"full": True})
+    assert CALLS == []
+    lock.release(token)
+    assert sync.run("t.demo", {"full": True}) == {"full": True}
+    assert r.states == ["running", "done"]
+    assert lock.holders() == 0
+
+
+def test_submit_dedupes_pending_job_and_takes_over_stale_marker(r, monkeypatch):
+    enqueued = []
+
+    class Q:
+        def enqueue(self, fn, *args, **kw):
+            enqueued.append(kw["job_id"])
+
+    monkeypatch.setattr(queues, "get_queue", lambda name: Q())
+    monkeypatch.setattr(queues, "is_pending", lambda job_id: True)
+    first = sync.submit("t.demo", {"full": True})
+    with pytest.raises(sync.JobConflict) as exc:
+        sync.submit("t.demo")
+    assert exc.value.job_id == first
+
+    monkeypatch.setattr(queues, "is_pending", lambda job_id: False)
+    second = sync.submit("t.demo")
+    assert enqueued == [first, second]
+    assert r.get("jobs:active:t") == second
+
+
+def test_periodic_tick_submits_once_per_interval(r, monkeypatch):
+    from app.jobs import schedule
+
+    submitted = []
+    monkeypatch.setattr(schedule, "get_redis", lambda: r)
+    monkeypatch.setattr(schedule, "PERIODIC", {"t.demo": 60, "t.off": 0})
+    monkeypatch.setattr(sync, "submit", lambda name: submitted.append(name))
+    assert schedule.tick() == ["t.demo"]
+    assert schedule.tick() == []
+    assert submitted == ["t.demo"]
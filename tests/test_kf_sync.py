@@ -0,0 +1,50 @@
+from contextlib import contextmanager
+
+from app.kf import service
+
+
+class _Conn:
+    def __init__(self, log):
+        self.log = log
+
+    def begin(self): self.log.append("begin")
+    def commit(self): self.log.append("commit")
+    def rollback(self): self.log.append("rollback")
+
+
+class _Cur:
+    def __init__(self):
+        self.log = []
+        self.connection = _Conn(self.log)
+
+    def execute(self, sql, args=()):
+        self.log.append(" ".join(sql.split()))
+
+    def executemany(self, sql, rows):
+        self.log.append((sql.split("(")[0].strip(), list(rows)))
+
+    def fetchall(self):
+        if self.log and "FROM kf_account" in str(self.log[-1]):
+            return [{"open_kfid": "kf1"}]
+        return []
+
+
+def test_servicer_list_is_replaced_inside_one_transaction(monkeypatch):
+    cur = _Cur()
+
+    @contextmanager
+    def _fake_cursor():
+        yield cur
+
+    monkeypatch.setattr(service, "_use_cursor", _fake_cursor)
+    monkeypatch.setattr(service, "wecom_get_json",
+                        lambda url, app, params: {"servicer_list": [{"userid": "u1"}, {"userid": "u2"}]})
+    monkeypatch.setattr(service.sync_state, "mark_ok", lambda *a: None)
+
+    assert service.sync_kf_servicers(full=True)["kf_servicers"] == 2
+    begin = cur.log.index("begin")
+    delete, insert = cur.log[begin + 1], cur.log[begin + 2]
+    assert delete == "DELETE FROM kf_servicer WHERE open_kfid IN (%s)"
+    assert insert[0] == "INSERT INTO kf_servicer" and insert[1] == [("kf1", "u1", 1), ("kf1", "u2", 1)]
+    assert cur.log.count("commit") == 1
+    assert not any(isinstance(e, str) and e.startswith("DELETE") for e in cur.log[:begin])
@@ -0,0 +1,52 @@
+import fakeredis
+import pytest
+
+from app.common import idempotency
+from app.mass import repo, stats
+
+
+@pytest.fixture()
+def r(monkeypatch):
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(stats, "get_redis", lambda: fake)
+    monkeypatch.setattr(idempotency, "get_redis", lambda: fake)
+    return fake
+
+
+@pytest.fixture()
+def reports(monkeypatch):
+    saved = {}
+    monkeypatch.setattr(repo, "update_task", lambda task_id, fields: saved.update({task_id: fields}))
+    monkeypatch.setattr(
+        repo,
+        "aggregate_task_stats",
+        lambda task_id: {"task_id": task_id, "total": 10, "pending": 4, "sent": 6},
+    )
+    return saved
+
+
+def test_counters_follow_state_moves(r, reports):
+    stats.reset(1, {"total": 10, "pending": 10})
+    stats.move(1, "pending", "sent", 7)
+    stats.move(1, "pending", "failed", 2)
+    stats.move(1, "failed", "pending", 1)
+    assert stats.get_stats(1) == {
+        "task_id": 1, "total": 10, "pending": 2, "sent": 7, "failed": 1, "recalled": 0,
+    }
+    assert reports == {}
+
+
+def test_missing_counters_reconcile_from_table(r, reports):
+    got = stats.get_stats(2)
+    assert got["pending"] == 4 and got["sent"] == 6 and got["failed"] == 0
+    assert reports[2]["report_stat"] == got
+    assert r.hget("mass:stat:2", "total") == "10"
+
+
+def test_checkpoint_reconciles_then_flushes(r, reports):
+    stats.reset(3, {"total": 10, "pending": 10})
+    stats.checkpoint(3)  # 首次：reconcile
+    assert reports[3]["report_stat"]["sent"] == 6
+    stats.move(3, "pending", "sent", 4)
+    stats.checkpoint(3)  # reconcile 冷却中：flush 当前计数
+    assert reports[3]["report_stat"]["sent"] == 10
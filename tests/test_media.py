@@ -0,0 +1,90 @@
+import contextlib
+import io
+
+import pytest
+
+from app.media import service
+
+
+def test_normalize_mobile_fast_path_and_cleanup():
+    assert service.normalize_mobile("13800138000") == "13800138000"
+    assert service.normalize_mobile("+86 138-0013-8000") == "13800138000"
+    assert service.normalize_mobile("8613800138000") == "13800138000"
+    assert service.normalize_mobile("12345") == ""
+    assert service.normalize_mobile("") == ""
+
+
+def test_iter_mobiles_streams_every_cell_and_chunks_dedupe():
+    raw = "﻿name,mobile\n张三,138 0013 8000\n李四,13900139000,13800138000\n".encode("utf-8")
+    mobiles = list(service.iter_mobiles(io.BytesIO(raw)))
+    assert mobiles == ["13800138000", "13900139000", "13800138000"]
+    assert list(service._chunks(mobiles, 10)) == [["13800138000", "13900139000"]]
+
+
+def test_ingest_chunk_inserts_only_new_numbers_and_counts_matches():
+    class Cur:
+        def __init__(self):
+            self.inserted = []
+            self._next = None
+
+        def execute(self, sql, args):
+            if "FROM wecom_ops.mobile_upload_item" in sql:
+                self._next = [{"mobile_std": "13800138000"}]
+            else:
+                self._next = [{"cnt": 1}]
+
+        def executemany(self, sql, rows):
+            self.inserted += rows
+
+        def fetchall(self):
+            return self._next
+
+        def fetchone(self):
+            return self._next[0]
+
+    cur = Cur()
+    added, matched = service._ingest_chunk(cur, 7, ["13800138000", "13900139000"])
+    assert (added, matched) == (1, 1)
+    assert cur.inserted == [(7, "13900139000")]
+
+
+def test_ingest_counts_view_matches_once_with_a_join(monkeypatch):
+    executed = []
+
+    class Cur:
+        def execute(self, sql, args):
+            executed.append(" ".join(sql.split()))
+
+        def executemany(self, sql, rows):
+            pass
+
+        def fetchall(self):
+            return []
+
+        def fetchone(self):
+            return {"cnt": 2}
+
+    class Conn:
+        def begin(self): pass
+        def commit(self): pass
+        def rollback(self): pass
+
+        def cursor(self):
+            return contextlib.nullcontext(Cur())
+
+    monkeypatch.setattr(service, "mysql_conn", lambda: contextlib.nullcontext(Conn()))
+    monkeypatch.setattr(service, "_progress", lambda *a, **kw: None)
+    monkeypatch.setattr(service.profile.settings, "member_source", "view")
+
+    out = service.ingest(7, ["13800138000", "13900139000", "13700137000"], chunk_size=2)
+    assert out == {"upload_id": 7, "total": 3, "valid": 2, "invalid": 1}
+    view_queries = [sql for sql in executed if service.profile.VIEW in sql]
+    assert len(view_queries) == 1 and "JOIN" in view_queries[0]
+
+
+def test_ingest_file_fails_clearly_when_spool_is_not_shared(monkeypatch, tmp_path):
+    progress = {}
+    monkeypatch.setattr(service, "_progress", lambda upload_id, **kw: progress.update(kw))
+    with pytest.raises(FileNotFoundError):
+        service.ingest_file(7, str(tmp_path / "missing.csv"))
+    assert progress["status"] == "failed"
@@ -0,0 +1,121 @@
+from contextlib import contextmanager
+
+import pytest
+
+from app.jobs import schedule, sync
+from app.members import audience, profile
+
+
+class _Conn:
+    def __init__(self):
+        self.events = []
+
+    def begin(self): self.events.append("begin")
+    def commit(self): self.events.append("commit")
+    def rollback(self): self.events.append("rollback")
+
+
+class _Cur:
+    def __init__(self, dirty=(), upto=7, fail_insert=False):
+        self.connection = _Conn()
+        self.dirty = list(dirty)
+        self.upto = upto
+        self.fail_insert = fail_insert
+        self.executed = []
+        self.rowcount = 0
+        self._last = ""
+
+    def execute(self, sql, args=()):
+        sql = " ".join(sql.split())
+        self.executed.append((sql, args))
+        self._last = sql
+        if sql.startswith("INSERT INTO wecom_ops.member_profile") and not sql.startswith("INSERT INTO wecom_ops.member_profile_dirty"):
+            if self.fail_insert:
+                raise RuntimeError("boom")
+            self.rowcount = 5
+
+    def fetchone(self):
+        if "MAX(seq)" in self._last:
+            return {"upto": self.upto}
+        return {"now": "2026-10-18 00:00:00"}
+
+    def fetchall(self):
+        return [{"external_userid": e} for e in self.dirty]
+
+
+def _patch(monkeypatch, cur, since):
+    @contextmanager
+    def _fake_cursor():
+        yield cur
+
+    bumped = []
+    monkeypatch.setattr(profile, "_use_cursor", _fake_cursor)
+    monkeypatch.setattr(profile.sync_state, "get_state", lambda *a: {"since": since})
+    monkeypatch.setattr(profile.sync_state, "mark_ok", lambda *a: None)
+    monkeypatch.setattr(profile.sync_state, "mark_err", lambda *a: None)
+    monkeypatch.setattr(profile, "bump_generation", bumped.append)
+    return bumped
+
+
+def test_incremental_refresh_reloads_dirty_contacts_with_one_insert_select(monkeypatch):
+    cur = _Cur(dirty=["e1", "e2", "e3"])
+    reindexed = []
+    bumped = _patch(monkeypatch, cur, "2026-10-17 00:00:00")
+    monkeypatch.setattr(audience, "set_bits", lambda changes: reindexed.extend(changes))
+
+    out = profile.refresh()
+    assert out == {"mode": "incremental", "contacts": 3, "rows": 5}
+    sqls = [sql for sql, _ in cur.executed]
+    # updated_at 变化的客户先并入待刷新集合，与同步写入的跟进人/标签标记一起消费
+    assert sqls[1].startswith("INSERT INTO wecom_ops.member_profile_dirty")
+    assert "FROM wecom_ops.ext_contact WHERE updated_at >= %s" in sqls[1]
+    # 视图只求值一次：整批 JOIN，不再按客户 IN 分块
+    inserts = [(sql, args) for sql, args in cur.executed if sql.startswith("INSERT INTO wecom_ops.member_profile (")]
+    assert len(inserts) == 1
+    assert "FROM wecom_ops.vw_mobile_to_external v JOIN" in inserts[0][0] and " IN (" not in inserts[0][0]
+    assert "IGNORE" not in inserts[0][0] and inserts[0][1] == (7,)
+    assert ("DELETE FROM wecom_ops.member_profile_dirty WHERE seq <= %s", (7,)) in cur.executed
+    assert cur.connection.events == ["begin", "commit"]
+    assert reindexed == [(e, audience.REINDEX, True) for e in ("e1", "e2", "e3")]
+    assert bumped == [profile.GEN_MEMBERS]
+
+
+def test_incremental_refresh_rolls_back_and_keeps_dirty_marks_on_failure(monkeypatch):
+    cur = _Cur(dirty=["e1"], fail_insert=True)
+    _patch(monkeypatch, cur, "2026-10-17 00:00:00")
+    with pytest.raises(RuntimeError):
+        profile.refresh()
+    assert cur.connection.events == ["begin", "rollback"]
+    assert not any(sql.startswith("DELETE FROM wecom_ops.member_profile_dirty") for sql, _ in cur.executed)
+
+
+def test_incremental_refresh_without_dirty_contacts_is_a_no_op(monkeypatch):
+    cur = _Cur(upto=0)
+    bumped = _patch(monkeypatch, cur, "2026-10-17 00:00:00")
+    assert profile.refresh() == {"mode": "incremental", "contacts": 0, "rows": 0}
+    assert cur.connection.events == [] and bumped == []
+
+
+def test_full_refresh_swaps_in_a_shadow_table_and_queues_audience_rebuild(monkeypatch):
+    cur = _Cur()
+    submitted = []
+    bumped = _patch(monkeypatch, cur, None)
+    monkeypatch.setattr(sync, "submit", submitted.append)
+
+    out = profile.refresh(full=True)
+    assert out == {"mode": "full", "contacts": 0, "rows": 5}
+    sqls = [sql for sql, _ in cur.executed]
+    i = sqls.index("CREATE TABLE wecom_ops.member_profile__new LIKE wecom_ops.member_profile")
+    assert sqls[i + 1].startswith("INSERT INTO wecom_ops.member_profile__new")
+    assert sqls[i + 1].endswith("FROM wecom_ops.vw_mobile_to_external v")
+    assert ("RENAME TABLE wecom_ops.member_profile TO wecom_ops.member_profile__old, "
+            "wecom_ops.member_profile__new TO wecom_ops.member_profile") in sqls
+    assert sqls.index("DROP TABLE wecom_ops.member_profile__old") > i
+    assert ("DELETE FROM wecom_ops.member_profile_dirty WHERE seq <= %s", (7,)) in cur.executed
+    assert submitted == ["audience.rebuild"]
+    assert bumped == [profile.GEN_MEMBERS]
+
+
+def test_profile_refresh_is_a_periodic_sync_job():
+    assert sync.SYNC_JOBS["members.profile"][2] == "app.members.profile:refresh"
+    assert "members.profile" in schedule.PERIODIC
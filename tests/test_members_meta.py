@@ -0,0 +1,40 @@
+import fakeredis
+import pytest
+
+from app.common import cache
+from app.members import service
+
+
+@pytest.fixture()
+def loads(monkeypatch):
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(cache, "_r", lambda: fake)
+    cache._l1_clear()
+    calls = []
+
+    def _load(only, q, unassigned, page, size):
+        calls.append((only, q, unassigned, page, size))
+        return {"n": len(calls)}
+
+    monkeypatch.setattr(service, "load_meta", _load)
+    return calls
+
+
+def test_generation_bump_invalidates_cached_facets(loads):
+    first = service.get_meta(["store", "owner"], "", None, 1, 50)
+    assert service.get_meta(["owner", "store"], "", None, 1, 50) == first
+    assert len(loads) == 1
+
+    cache.bump_generation(cache.GEN_MEMBERS)
+    assert service.get_meta(["store", "owner"], "", None, 1, 50) == {"n": 2}
+    assert loads[-1][0] == ("owner", "store")
+
+
+def test_paging_and_query_params_get_distinct_keys(loads):
+    args = [(1, 50, ""), (2, 50, ""), (1, 20, ""), (1, 50, "张")]
+    keys = {service._meta_key(0, ("store",), q, None, page, size) for page, size, q in args}
+    assert len(keys) == len(args)
+    for page, size, q in args:
+        service.get_meta(["store"], q, None, page, size)
+    assert len(loads) == len(args)
+    assert service._meta_key(0, ("store",), "", 1, 1, 50) != service._meta_key(0, ("store",), "", 0, 1, 50)
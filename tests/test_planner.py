@@ -0,0 +1,118 @@
+from contextlib import contextmanager
+
+import pytest
+
+from app.mass import planner, repo
+
+
+def test_allocate_waves_sums_to_total():
+    gray = {"waves": [{"pct": 1}, {"pct": 5}, {"pct": 20}, {"pct": 100}]}
+    qty = planner._allocate_waves(1000, gray)
+    assert qty == [10, 50, 200, 740]
+    assert sum(qty) == 1000
+
+
+def test_allocate_waves_never_overshoots():
+    qty = planner._allocate_waves(10, {"waves": [{"pct": 80}, {"pct": 80}, {"pct": 100}]})
+    assert qty == [8, 2, 0]
+    assert planner._allocate_waves(7, {}) == [7]
+
+
+class _Conn:
+    def __init__(self):
+        self.commits = 0
+
+    def begin(self): pass
+    def commit(self): self.commits += 1
+    def rollback(self): pass
+
+
+def _fake_db(monkeypatch, cur):
+    conn = _Conn()
+
+    @contextmanager
+    def _fake_cursor():
+        yield conn, cur
+
+    monkeypatch.setattr(repo, "_use_cursor", _fake_cursor)
+    return conn
+
+
+def test_plan_snapshots_inserts_in_keyset_chunks(monkeypatch):
+    executed = []
+    inserts = iter([4, 4, 2])
+
+    class _Cur:
+        rowcount = 0
+
+        def execute(self, sql, args=()):
+            executed.append((sql, args))
+            if sql.lstrip().startswith("INSERT"):
+                self.rowcount = next(inserts)
+            elif sql.lstrip().startswith("DELETE"):
+                self.rowcount = 0
+
+        def fetchone(self):
+            return {"last_rid": f"wm{len(executed)}"}
+
+    _fake_db(monkeypatch, _Cur())
+    monkeypatch.setattr(repo.settings, "mass_plan_chunk", 4)
+    inserted = repo.plan_snapshots(7, "by_tag_ids", ["t1", "t2"], 10, [10, 0, 32], 5)
+
+    assert inserted == 10
+    assert executed[0][0].startswith("DELETE")
+    chunks = [(sql, args) for sql, args in executed if sql.lstrip().startswith("INSERT")]
+    assert len(chunks) == 3
+    for sql, args in chunks:
+        assert "ROW_NUMBER() OVER" in sql
+        assert sql.count("%s") == len(args)
+    # 空的第 2 波被跳过：第 1 波 rn<=10，其余落到第 3 波；首块无 keyset 下界
+    assert chunks[0][1] == (7, 5, 10, 1, 3, 10, 0, 10, 0, "t1", "t2", 4)
+    # 后续块以上一块的最大 recipient 为下界，rn 从已插入行数续编，最后一块只取剩余量
+    assert chunks[1][1][-5:] == (4, "t1", "t2", "wm3", 4)
+    assert chunks[2][1][-5:] == (8, "t1", "t2", "wm5", 2)
+
+
+def test_plan_snapshots_stops_when_audience_runs_out(monkeypatch):
+    class _Cur:
+        rowcount = 0
+        inserts = 0
+
+        def execute(self, sql, args=()):
+            if sql.lstrip().startswith("INSERT"):
+                self.inserts += 1
+                self.rowcount = 3 if self.inserts == 1 else 0
+
+        def fetchone(self):
+            return {"last_rid": "wm_last"}
+
+    cur = _Cur()
+    _fake_db(monkeypatch, cur)
+    monkeypatch.setattr(repo.settings, "mass_plan_chunk", 4)
+    assert repo.plan_snapshots(7, "all_contacts", [], 100, [100], 50) == 3
+    assert cur.inserts == 2
+
+
+def test_clear_snapshots_deletes_in_ordered_chunks_until_short(monkeypatch):
+    executed = []
+    counts = iter([3, 3, 1])
+
+    class _Cur:
+        rowcount = 0
+
+        def execute(self, sql, args=()):
+            executed.append((sql, args))
+            self.rowcount = next(counts)
+
+    conn = _fake_db(monkeypatch, _Cur())
+    assert repo.clear_snapshots(9, chunk=3, pause_ms=0) == 7
+    assert len(executed) == 3 and conn.commits == 3
+    assert all("ORDER BY id LIMIT" in sql and args == (9, 3) for sql, args in executed)
+
+
+def test_after_id_cursor_round_trip():
+    token = repo.encode_after_id(123456789)
+    assert "123456789" not in token
+    assert repo.decode_after_id(token) == 123456789
+    with pytest.raises(ValueError):
+        repo.decode_after_id("not-a-cursor")
@@ -0,0 +1,49 @@
+import fakeredis
+import pytest
+
+from app.common import ratelimit
+
+
+@pytest.fixture()
+def r(monkeypatch):
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(ratelimit, "get_redis", lambda: fake)
+    monkeypatch.setattr(ratelimit, "_take_sha", None)
+    return fake
+
+
+def test_take_tokens_grants_up_to_capacity(r):
+    assert ratelimit.take_tokens("rl:a", 6, 10, 10) == (True, 0)
+    granted, _ = ratelimit.take_tokens("rl:a", 4, 10, 10)
+    assert granted is True
+    granted, wait_ms = ratelimit.take_tokens("rl:a", 3, 10, 10)
+    assert granted is False
+    # 10 个/秒，缺 3 个 ≈ 300ms
+    assert 200 <= wait_ms <= 300
+
+
+def test_take_token_legacy_bool(r):
+    assert ratelimit.take_token("rl:b", 1, 1) is True
+    assert ratelimit.take_token("rl:b", 1, 1) is False
+    assert r.pttl("rl:b") > 0
+
+
+def test_take_tokens_rejects_more_than_capacity(r):
+    with pytest.raises(ValueError):
+        ratelimit.take_tokens("rl:c", 11, 10, 10)
+
+
+def test_take_tokens_reloads_flushed_script(r):
+    assert ratelimit.take_token("rl:d", 5, 5) is True
+    r.script_flush()
+    assert ratelimit.take_token("rl:d", 5, 5) is True
+
+
+def test_token_bucket_acquire_waits_then_times_out(r):
+    bucket = ratelimit.TokenBucket("rl:e", rate=50, burst=1)
+    assert bucket.acquire() is True
+    # 50/s 补一个令牌约 20ms，阻塞后应能拿到
+    assert bucket.acquire(timeout=1.0) is True
+    slow = ratelimit.TokenBucket("rl:f", rate=0.5, burst=1)
+    assert slow.acquire() is True
+    assert slow.acquire(timeout=0.05) is False
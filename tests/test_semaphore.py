@@ -0,0 +1,58 @@
+import fakeredis
+import pytest
+
+from app.common import semaphore
+from app.common.semaphore import Semaphore
+
+
+@pytest.fixture()
+def r(monkeypatch):
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(semaphore, "get_redis", lambda: fake)
+    monkeypatch.setattr(semaphore, "_shas", {})
+    return fake
+
+
+def test_capacity_and_release_never_over_release(r):
+    sem = Semaphore("sem:t", capacity=2, lease_s=30)
+    a, _ = sem.try_acquire()
+    b, _ = sem.try_acquire()
+    c, wait_ms = sem.try_acquire()
+    assert a and b and c is None and wait_ms > 0
+    assert sem.release(a) is True
+    assert sem.release(a) is False
+    assert sem.holders() == 1
+    assert sem.acquire(timeout=1)
+    assert sem.holders() == 2
+
+
+def test_expired_lease_is_reclaimed(r):
+    sem = Semaphore("sem:t", capacity=1, lease_s=30)
+    token, _ = sem.try_acquire()
+    r.zadd("sem:t", {token: 1})  # 模拟持有者崩溃、租约已过期
+    assert sem.refresh(token) is False
+    other, _ = sem.try_acquire()
+    assert other and other != token
+
+
+def test_waiters_are_served_in_arrival_order(r):
+    sem = Semaphore("sem:t", capacity=1, lease_s=30)
+    holder, _ = sem.try_acquire()
+    assert sem._attempt("w1")[0] is False
+    assert sem._attempt("w2")[0] is False
+    sem.release(holder)
+    assert sem._attempt("w2")[0] is False  # 排在 w1 之后
+    assert sem._attempt("w1")[0] is True
+    assert sem.try_acquire()[0] is None
+    assert r.zrange("sem:t:q", 0, -1) == ["w2"]
+
+
+def test_acquire_timeout_leaves_queue(r):
+    sem = Semaphore("sem:t", capacity=1, lease_s=30)
+    holder = sem.acquire(timeout=0.1)
+    assert sem.acquire(timeout=0.05) is None
+    assert r.zcard("sem:t:q") == 0
+    sem.release(holder)
+    with sem.hold(timeout=0.1) as token:
+        assert token and sem.holders() == 1
+    assert sem.holders() == 0
@@ -0,0 +1,111 @@
+from contextlib import contextmanager
+
+from app.common.sync_state import ChangeFilter, row_hash
+from app.ext import service as ext_service
+
+
+class _Writer:
+    def __init__(self):
+        self.rows = []
+
+    def register(self, *a, **kw): pass
+
+    def add(self, table, row):
+        self.rows.append((table, row))
+
+
+class _Cur:
+    def __init__(self, results):
+        self.results = list(results)
+        self.executed = []
+
+    def execute(self, sql, args=()):
+        self.executed.append((sql, args))
+
+    def fetchall(self):
+        return self.results.pop(0) if self.results else []
+
+
+def test_change_filter_skips_unchanged_rows_and_marks_new_hashes():
+    cur = _Cur([[{"row_key": "a", "row_hash": row_hash({"v": 1})}]])
+    writer = _Writer()
+    flt = ChangeFilter(cur, writer, "ext", "contacts")
+    assert flt.changed({"a": {"v": 1}, "b": {"v": 2}}) == ["b"]
+    assert flt.skipped == 1
+    flt.mark("b")
+    flt.mark("b")
+    assert writer.rows == [("sync_row_hash", ("ext", "contacts", "b", row_hash({"v": 2})))]
+
+
+def test_change_filter_full_mode_ignores_stored_hashes():
+    cur = _Cur([])
+    flt = ChangeFilter(cur, _Writer(), "ext", "contacts", full=True)
+    assert flt.changed({"a": {"v": 1}}) == ["a"]
+    assert cur.executed == []
+
+
+def _stub_contact_sync(monkeypatch, cursor):
+    groups_seen = []
+
+    @contextmanager
+    def _cur():
+        yield object()
+
+    class _StubWriter(_Writer):
+        written = {}
+
+        def __init__(self, cur, chunk=None): super().__init__()
+        def flush(self): pass
+        def __enter__(self): return self
+        def __exit__(self, *exc): return False
+
+    class _StubFilter:
+        skipped = 0
+
+        def __init__(self, *a): pass
+
+    def _pages(groups, workers, limit):
+        groups_seen.extend(groups)
+        return iter(())
+
+    monkeypatch.setattr(ext_service, "_use_cursor", _cur)
+    monkeypatch.setattr(ext_service, "_employees", lambda cur: ["u3", "u1", "u2", "u4"])
+    monkeypatch.setattr(ext_service, "BulkUpserter", _StubWriter)
+    monkeypatch.setattr(ext_service, "ChangeFilter", _StubFilter)
+    monkeypatch.setattr(ext_service, "_iter_contact_pages", _pages)
+    monkeypatch.setattr(ext_service.sync_state, "get_state", lambda *a: {"sync_cursor": cursor})
+    monkeypatch.setattr(ext_service.sync_state, "mark_ok", lambda *a: None)
+    return groups_seen
+
+
+def test_contact_sync_resumes_after_saved_cursor(monkeypatch):
+    groups = _stub_contact_sync(monkeypatch, "u2")
+    out = ext_service.sync_contacts(users_per_call=1)
+    assert out["resumed_after"] == "u2"
+    assert groups == [["u3"], ["u4"]]
+
+
+def test_contact_sync_full_mode_starts_from_first_employee(monkeypatch):
+    groups = _stub_contact_sync(monkeypatch, "u2")
+    out = ext_service.sync_contacts(full=True, users_per_call=3)
+    assert out["mode"] == "full" and out["resumed_after"] is None
+    assert groups == [["u1", "u2", "u3"], ["u4"]]
+
+
+def test_removed_tags_uses_union_of_all_follow_users():
+    cur = _Cur([
+        [
+            {"external_userid": "e1", "userid": "u1", "tag_ids": '["t1", "t2"]'},
+            {"external_userid": "e1", "userid": "u2", "tag_ids": '["t3"]'},
+            {"external_userid": "e2", "userid": "u9", "tag_ids": None},
+        ],
+        [
+            {"external_userid": "e1", "tag_id": "t1"},
+            {"external_userid": "e1", "tag_id": "t2"},
+            {"external_userid": "e1", "tag_id": "t3"},
+        ],
+    ])
+    # u1 在企微侧去掉了 t2；t3 仍由 u2 打着；e2 有 tag_ids 未知的跟进人，不删
+    removed = ext_service._removed_tags(cur, {"e1": {"u1": ["t1"]}, "e2": {"u5": []}})
+    assert removed == [("e1", "t2")]
+    assert cur.executed[1][1] == ["e1"]
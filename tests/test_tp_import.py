@@ -0,0 +1,44 @@
+import io
+
+import fakeredis
+import pytest
+from flask import Flask
+
+from app.api.v1.tp_import import routes
+
+
+@pytest.fixture()
+def client(monkeypatch):
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(routes, "get_redis", lambda: fake)
+    monkeypatch.setattr(routes, "_BATCH", 2)
+    app = Flask(__name__)
+    app.register_blueprint(routes.bp)
+    return app.test_client(), fake
+
+
+def test_multipart_upload_with_header_dedupes_into_redis(client):
+    c, fake = client
+    body = "id,user_name\n1,alice\n2,bob\n3,alice\n4,\n5,carol\n".encode("utf-8-sig")
+    resp = c.post("/import/usernames/upload", data={"file": (io.BytesIO(body), "u.csv")},
+                  content_type="multipart/form-data")
+    data = resp.get_json()["data"]
+    assert data["count"] == 3 and data["rows"] == 4
+    key = routes._key(data["upload_token"])
+    assert 0 < fake.ttl(key) <= routes._TTL_S
+    assert sorted(routes.take_usernames_by_token(data["upload_token"])) == ["alice", "bob", "carol"]
+
+
+def test_raw_csv_body_without_header_uses_first_column(client):
+    c, _ = client
+    resp = c.post("/import/usernames/upload", data="dave,x\neve\n", content_type="text/csv")
+    token = resp.get_json()["data"]["upload_token"]
+    assert sorted(routes.take_usernames_by_token(token)) == ["dave", "eve"]
+
+
+def test_empty_upload_is_rejected_and_unknown_token_yields_nothing(client):
+    c, fake = client
+    resp = c.post("/import/usernames/upload", data="user_name\n\n", content_type="text/csv")
+    assert resp.status_code == 422
+    assert fake.keys("tp:upload:*") == []
+    assert list(routes.take_usernames_by_token("missing")) == []
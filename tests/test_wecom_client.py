@@ -0,0 +1,135 @@
+import json
+import time
+
+import fakeredis
+import pytest
+
+from app.common import idempotency
+from app.wecom import client
+
+
+class Resp:
+    def __init__(self, data=None, status=200):
+        self._data = data or {}
+        self.status_code = status
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"http {self.status_code}")
+
+
+class Session:
+    def __init__(self):
+        self.calls = []
+        self.replies = []          # 业务接口依次返回的响应
+        self.token_seq = 0
+        self.token_ttl = 7200
+        self.token_fail = False
+
+    def get(self, url, params=None, timeout=None):
+        if url.endswith("/cgi-bin/gettoken"):
+            self.calls.append(("token", params["corpsecret"]))
+            if self.token_fail:
+                raise RuntimeError("gettoken down")
+            self.token_seq += 1
+            return Resp({"errcode": 0, "access_token": f"T{self.token_seq}", "expires_in": self.token_ttl})
+        self.calls.append(("GET", url))
+        return self.replies.pop(0)
+
+    def post(self, url, params=None, json=None, timeout=None):
+        self.calls.append(("POST", url))
+        return self.replies.pop(0)
+
+
+@pytest.fixture()
+def env(monkeypatch):
+    fake = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(client, "get_redis", lambda: fake)
+    monkeypatch.setattr(idempotency, "get_redis", lambda: fake)
+    monkeypatch.setattr(client, "_token_cache", {})
+    monkeypatch.setattr(client, "_throttle", lambda scope: None)
+    monkeypatch.setattr(client, "_sleep_backoff", lambda i, cap=8.0: None)
+    monkeypatch.setenv("WECOM_CORP_ID", "corp")
+    monkeypatch.setenv("WECOM_EXT_SECRET", "s1")
+    session = Session()
+    monkeypatch.setattr(client, "_session", session)
+    return fake, session
+
+
+def _tokens(session):
+    return [c for c in session.calls if c[0] == "token"]
+
+
+def test_token_l1_then_l2_then_fetch_and_secret_rotation(env, monkeypatch):
+    r, session = env
+    assert client.get_token_by_secret("WECOM_EXT_SECRET") == "T1"
+    assert client.get_token_by_secret("WECOM_EXT_SECRET") == "T1"
+    client._token_cache.clear()          # 另一个进程：L1 空，L2 命中
+    assert client.get_token_by_secret("WECOM_EXT_SECRET") == "T1"
+    assert len(_tokens(session)) == 1
+
+    monkeypatch.setenv("WECOM_EXT_SECRET", "s2")
+    assert client.get_token_by_secret("WECOM_EXT_SECRET") == "T2"
+    assert _tokens(session)[-1] == ("token", "s2")
+    # 两个 secret 各一条 L2 记录，键里只有哈希不含明文
+    keys = [k for k in r.keys("wec:token:*") if not k.endswith(":lock")]
+    assert len(keys) == 2 and not any(k.endswith((":s1", ":s2")) for k in keys)
+
+
+def test_refresh_ahead_keeps_current_token_on_failure_or_foreign_lock(env):
+    r, session = env
+    session.token_ttl = client._TOKEN_REFRESH_AHEAD_S - 60   # 已进入提前刷新窗口但仍可用
+    assert client.get_token_by_secret("WECOM_EXT_SECRET") == "T1"
+
+    session.token_fail = True
+    assert client.get_token_by_secret("WECOM_EXT_SECRET") == "T1"
+    assert not r.exists(client._token_key("WECOM_EXT_SECRET") + ":lock")
+
+    session.token_fail = False
+    r.set(client._token_key("WECOM_EXT_SECRET") + ":lock", "other", ex=10)
+    assert client.get_token_by_secret("WECOM_EXT_SECRET") == "T1"
+    assert r.get(client._token_key("WECOM_EXT_SECRET") + ":lock") == "other"
+
+
+def test_release_lock_never_deletes_someone_elses_lock(env):
+    r, _ = env
+    mine = idempotency.acquire_lock("k:lock", 10)
+    assert mine and idempotency.acquire_lock("k:lock", 10) is None
+    r.set("k:lock", "other")            # 自己的锁过期后被别人拿走
+    assert idempotency.release_lock("k:lock", mine) is False
+    assert r.get("k:lock") == "other"
+
+
+def test_post_is_not_replayed_on_5xx_or_busy(env):
+    _, session = env
+    session.replies = [Resp(status=502)]
+    with pytest.raises(RuntimeError):
+        client.wecom_post_json("/cgi-bin/externalcontact/add_msg_template", body={})
+    session.replies = [Resp({"errcode": -1})]
+    with pytest.raises(RuntimeError):
+        client.wecom_post_json("/cgi-bin/externalcontact/add_msg_template", body={})
+    assert [c[0] for c in session.calls if c[0] != "token"] == ["POST", "POST"]
+
+
+def test_get_retries_5xx_and_busy_post_retries_rate_limit_and_token_errors(env):
+    _, session = env
+    session.replies = [Resp(status=503), Resp({"errcode": -1}), Resp({"errcode": 0, "ok": 1})]
+    assert client.wecom_get_json("/cgi-bin/externalcontact/get", scope="ext")["ok"] == 1
+
+    session.replies = [Resp({"errcode": 45009}), Resp({"errcode": 42001}), Resp({"errcode": 0, "ok": 2})]
+    assert client.wecom_post_json("/cgi-bin/externalcontact/add_msg_template", body={})["ok"] == 2
+    # 42001 让旧 token 失效并重新获取
+    assert len(_tokens(session)) == 2
+
+
+def test_gettoken_takes_a_token_from_the_scope_bucket(env, monkeypatch):
+    _, session = env
+    throttled = []
+    monkeypatch.setattr(client, "_throttle", lambda scope: throttled.append((scope, len(session.calls))))
+    client.get_token_by_secret("WECOM_EXT_SECRET")
+    # 先过 ext 桶，再发 gettoken
+    assert throttled == [("ext", 0)]
+    assert _tokens(session) == [("token", "s1")]